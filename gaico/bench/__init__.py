@@ -0,0 +1,9 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Gaico benchmarks
+    ~~~~~~~~~~~~~~~~
+
+    Small benchmarks used to measure the hot paths of `gaico.net`.
+
+"""
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Run the `gaico.net` benchmark suite: `python -m gaico.bench --help`.
+"""
+
+import argparse
+from gaico.bench.suite import TARGETS, run
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m gaico.bench',
+                                     description="Benchmark the gaico.net functions against "
+                                     "local stand-ins (loopback addresses and a tap device).")
+    parser.add_argument('targets', nargs='*', type=int, default=TARGETS,
+                        help="numbers of targets (default: 1000 10000 50000)")
+    parser.add_argument('-f', '--function', action='append', dest='functions',
+                        choices=['getaddrinfo', 'ping', 'arp_request', 'check_ports_state'],
+                        help="benchmark only this function (can be repeated)")
+    parser.add_argument('-c', '--count', type=int, default=1, help="pings per target")
+    parser.add_argument('-t', '--timeout', type=float, default=5, help="probe timeout")
+    parser.add_argument('-r', '--rate', type=float, help="maximum pings per second")
+    parser.add_argument('-p', '--processes', type=int,
+                        help="also run the benchmarks sharded over this number of processes")
+    parser.add_argument('--loopback', action='store_false', dest='tap', default=None,
+                        help="ping loopback addresses even when a tap device can be used")
+    args = parser.parse_args()
+
+    run(args.targets, args.functions, args.count, args.timeout, args.rate, args.tap,
+        processes=args.processes)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+"""
+    gevent versus asyncio benchmark of `ping` and `check_ports_state`.
+
+    Every address of 127.0.0.0/8 answers pings and connects on loopback, so
+    any number of distinct targets can be used without a real network. Run
+    with `python -m gaico.bench.aio [targets...]` (root, or ping sockets
+    allowed by net.ipv4.ping_group_range, is required for ping).
+"""
+
+import asyncio
+import ipaddress
+import socket
+import sys
+import threading
+import time
+from gaico.net import aio, check_ports_state, ping
+
+
+def loopback_hosts(count):
+    """ Returns `count` distinct loopback addresses. """
+
+    first = ipaddress.ip_address('127.0.0.1')
+    return [str(first + i) for i in range(count)]
+
+
+def measure(function):
+    """ Returns the result, the wall time and the CPU time of `function()`. """
+
+    started = time.perf_counter()
+    started_cpu = time.process_time()
+    result = function()
+    return result, time.perf_counter() - started, time.process_time() - started_cpu
+
+
+def count_ping_replies(results):
+    return sum(result['received'] for result in results.values() if isinstance(result, dict))
+
+
+def count_open_ports(results):
+    return sum(1 for result in results.values() if isinstance(result, dict)
+               for port, state in result.items() if state is True)
+
+
+def listen(backlog):
+    """ Returns a loopback socket accepting (and closing) connections from a thread.
+
+    A thread is used so that connections are accepted whichever backend runs
+    in the main thread.
+    """
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('0.0.0.0', 0))
+    listener.listen(backlog)
+
+    def accept():
+        while True:
+            try:
+                connection, _ = listener.accept()
+            except OSError:
+                # listener closed
+                return
+            connection.close()
+
+    threading.Thread(target=accept, daemon=True).start()
+    return listener
+
+
+def run(targets=(1000, 10000), count=3, output=sys.stdout):
+    """ Print the wall time and CPU time of both backends for each number of targets. """
+
+    for target_count in targets:
+        hosts = loopback_hosts(target_count)
+        ping_args = dict(count=count, interval=0.5, timeout=2)
+
+        runs = [
+            ('ping', 'gevent', lambda: ping(hosts, **ping_args), count_ping_replies),
+            ('ping', 'asyncio', lambda: asyncio.run(aio.ping(hosts, **ping_args)),
+             count_ping_replies),
+        ]
+
+        listener = listen(target_count)
+        port = listener.getsockname()[1]
+        hosts_ports = dict((host, [port]) for host in hosts)
+        runs.extend([
+            ('check_ports_state', 'gevent', lambda: check_ports_state(hosts_ports, timeout=5),
+             count_open_ports),
+            ('check_ports_state', 'asyncio',
+             lambda: asyncio.run(aio.check_ports_state(hosts_ports, timeout=5)),
+             count_open_ports),
+        ])
+
+        for name, backend, function, counter in runs:
+            result, wall, cpu = measure(function)
+            output.write("{:>6} targets  {:<18} {:<8} {:>8.2f}s wall {:>8.2f}s cpu  "
+                         "{} ok\n".format(target_count, name, backend, wall, cpu, counter(result)))
+
+        listener.shutdown(socket.SHUT_RDWR)
+        listener.close()
+
+
+if __name__ == '__main__':
+    run([int(arg) for arg in sys.argv[1:]] or (1000, 10000))
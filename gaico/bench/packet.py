@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Microbenchmark of the echo request building path.
+
+    Run with `python -m gaico.bench.packet`.
+"""
+
+import struct
+import sys
+import time
+from gaico.net.ping import PingPacket, get_template
+
+
+def legacy_checksum(packet):
+    """ Checksum as it was computed before templates: one `struct.unpack` per word. """
+
+    if len(packet) % 2 == 1:
+        packet = packet + b'\0'
+
+    checksum = 0
+    for count in range(0, len(packet), 2):
+        value, = struct.unpack("!H", packet[count:count+2])
+        checksum = checksum + value
+
+    checksum = (checksum >> 16) + (checksum & 0xFFFF)
+    checksum = checksum + (checksum >> 16)
+    return ~checksum & 0xFFFF
+
+
+def build_legacy(identifier, sequence, packet_size):
+    """ Build a request like `send_one_ping` did before templates. """
+
+    payload = ((packet_size - 8) - struct.calcsize("d")) * b"Q"
+    payload = struct.pack("!d", time.time()) + payload
+    packet = PingPacket(identifier, sequence, payload)
+    return packet.pack(legacy_checksum(packet.pack(checksum=0)))
+
+
+def build_packet(identifier, sequence, packet_size):
+    """ Build a request with a new `PingPacket` object for each packet. """
+
+    payload = ((packet_size - 8) - struct.calcsize("Q")) * b"Q"
+    payload = struct.pack("!Q", time.monotonic_ns()) + payload
+    return PingPacket(identifier, sequence, payload).pack()
+
+
+def build_template(identifier, sequence, packet_size):
+    """ Build a request from the shared template. """
+
+    return get_template(identifier, packet_size).build(sequence, time.monotonic_ns())
+
+
+def packets_per_second(builder, packet_size, duration):
+    """ Returns how many packets `builder` builds per second. """
+
+    identifier = 0x588a
+    packets = 0
+    started = time.perf_counter()
+    elapsed = 0
+    while elapsed < duration:
+        for sequence in range(1000):
+            builder(identifier, sequence, packet_size)
+        packets = packets + 1000
+        elapsed = time.perf_counter() - started
+
+    return packets / elapsed
+
+
+def run(packet_sizes=(64, 1500), duration=1.0, output=sys.stdout):
+    """ Print the packets/sec of each building path for each packet size. """
+
+    builders = [
+        ('legacy', build_legacy),
+        ('packet', build_packet),
+        ('template', build_template),
+    ]
+
+    for packet_size in packet_sizes:
+        baseline = None
+        for name, builder in builders:
+            rate = packets_per_second(builder, packet_size, duration)
+            if baseline is None:
+                baseline = rate
+            output.write("{:>5} bytes  {:<10} {:>12,.0f} packets/sec  x{:.1f}\n".format(
+                packet_size, name, rate, rate / baseline
+            ))
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Local stand-ins for the hosts of the benchmarks.
+
+    `TapResponder` simulates hosts answering ARP and ICMP echo requests over
+    a tap device, `Listener` accepts TCP connections on every loopback address.
+
+    A tap device is a virtual Ethernet interface whose frames are read and
+    written by a process instead of a network card: the responder process
+    answers the ARP requests and the pings sent to every address of its
+    network (but the first one, assigned to the tap device), so that
+    `arp_request` and `ping` can be benchmarked at any scale without a real
+    network. Requires root (or CAP_NET_ADMIN) and the `ip` command.
+"""
+
+import fcntl
+import ipaddress
+import multiprocessing
+import os
+import socket
+import struct
+import subprocess
+from gaico.net.arp import ARP_REPLY, ARP_REQUEST, ETH_P_ARP
+from gaico.net.ping import ICMPV4_ECHO_REPLY, ICMPV4_ECHO_REQUEST, internet_checksum
+
+# from linux/if_tun.h
+TUNSETIFF = 0x400454ca
+IFF_TAP = 0x0002
+IFF_NO_PI = 0x1000
+
+ETH_P_IP = 0x0800
+
+
+def fake_mac(ip):
+    """ Returns the MAC address of the simulated host with the IPv4 address `ip` (bytes). """
+
+    return b'\x02\x00' + ip
+
+
+def open_tap(name):
+    """ Create the tap device `name` and returns its file descriptor. """
+
+    fd = os.open('/dev/net/tun', os.O_RDWR)
+    fcntl.ioctl(fd, TUNSETIFF, struct.pack('16sH', name.encode(), IFF_TAP | IFF_NO_PI))
+    return fd
+
+
+class SimulatedNetwork(object):
+    """ The addresses of `network` except `excluded`, tested as packed bytes. """
+
+    def __init__(self, network, excluded):
+        self.first = int(network.network_address)
+        self.last = int(network.broadcast_address)
+        self.excluded = excluded.packed
+
+    def __contains__(self, ip):
+        return ip != self.excluded and self.first < int.from_bytes(ip, 'big') < self.last
+
+
+def answer(frame, network):
+    """ Returns the reply to an Ethernet `frame`, or `None` if it is not a
+    request for a simulated host of `network` (a `SimulatedNetwork`).
+    """
+
+    if len(frame) < 42:
+        return None
+
+    ethertype, = struct.unpack('!H', frame[12:14])
+
+    if ethertype == ETH_P_ARP:
+        sender_mac, sender_ip, target_ip = frame[22:28], frame[28:32], frame[38:42]
+        if frame[20:22] != ARP_REQUEST or target_ip not in network:
+            return None
+        mac = fake_mac(target_ip)
+        return sender_mac + mac + frame[12:20] + ARP_REPLY + \
+            mac + target_ip + sender_mac + sender_ip
+
+    if ethertype == ETH_P_IP and frame[23] == socket.IPPROTO_ICMP:
+        header_length = (frame[14] & 0x0F) * 4
+        icmp = frame[14 + header_length:]
+        source_ip, destination_ip = frame[26:30], frame[30:34]
+        if icmp[0] != ICMPV4_ECHO_REQUEST or destination_ip not in network:
+            return None
+        icmp = bytes([ICMPV4_ECHO_REPLY, 0, 0, 0]) + icmp[4:]
+        icmp = icmp[:2] + struct.pack('!H', internet_checksum(icmp)) + icmp[4:]
+        # swapping the addresses does not change the IP header checksum
+        return frame[6:12] + frame[0:6] + frame[12:26] + destination_ip + source_ip + \
+            frame[34:14 + header_length] + icmp
+
+    return None
+
+
+def serve(name, network, ready):
+    """ Answer the requests read from the tap device `name`, forever. """
+
+    fd = open_tap(name)
+    address = next(network.hosts())
+
+    # the network is routed through a single simulated gateway: the kernel
+    # only needs its MAC address, and not one neighbor entry per host (the
+    # neighbor table only holds net.ipv4.neigh.default.gc_thresh3 entries)
+    subprocess.check_call(['ip', 'addr', 'add', '{}/32'.format(address), 'dev', name])
+    subprocess.check_call(['ip', 'link', 'set', name, 'up'])
+    subprocess.check_call(['ip', 'route', 'add', str(network), 'via', str(address + 1),
+                           'dev', name, 'onlink'])
+
+    # the first address belongs to the tap device, not to a simulated host
+    simulated = SimulatedNetwork(network, address)
+    ready.set()
+
+    while True:
+        reply = answer(os.read(fd, 2048), simulated)
+        if reply is not None:
+            os.write(fd, reply)
+
+
+class TapResponder(object):
+    """ Runs the responder of a tap device in a child process.
+
+    The child process keeps the benchmarked process' CPU time free of the
+    responder's work. Use as a context manager:
+
+        with TapResponder('gaico0', '10.98.0.0/16') as responder:
+            arp_request(responder.hosts(1000), responder.address, 'gaico0')
+    """
+
+    def __init__(self, name='gaico0', network='10.98.0.0/16'):
+        self.name = name
+        self.network = ipaddress.IPv4Network(network)
+        self.address = str(next(self.network.hosts()))
+        self.process = None
+
+    def hosts(self, count):
+        """ Returns `count` addresses of simulated hosts. """
+
+        first = ipaddress.IPv4Address(self.address) + 1
+        return [str(first + i) for i in range(count)]
+
+    def start(self):
+        """ Create the tap device, and wait until it is ready. """
+
+        ready = multiprocessing.Event()
+        self.process = multiprocessing.Process(target=serve,
+                                               args=(self.name, self.network, ready),
+                                               daemon=True)
+        self.process.start()
+        while not ready.wait(0.1):
+            if not self.process.is_alive():
+                raise RuntimeError("Cannot create the tap device {}.".format(self.name))
+
+    def stop(self):
+        """ Stop the responder, the tap device disappears with it. """
+
+        if self.process is not None:
+            self.process.terminate()
+            self.process.join()
+            self.process = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def accept(listener):
+    """ Accept (and close) connections forever. """
+
+    while True:
+        connection, _ = listener.accept()
+        connection.close()
+
+
+class Listener(object):
+    """ Accepts TCP connections on all the addresses of 127.0.0.0/8 from a child process.
+
+    Every address of 127.0.0.0/8 is local, so any number of distinct targets
+    can have the port `port` open.
+    """
+
+    def __init__(self, backlog=socket.SOMAXCONN):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(('0.0.0.0', 0))
+        self.socket.listen(backlog)
+        self.port = self.socket.getsockname()[1]
+        self.process = None
+
+    def start(self):
+        self.process = multiprocessing.Process(target=accept, args=(self.socket,), daemon=True)
+        self.process.start()
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.join()
+            self.process = None
+        self.socket.close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Throughput benchmark of the `gaico.net` functions against local stand-ins.
+
+    Each function is run against 1k, 10k and 50k targets (by default), and
+    the following is reported:
+
+    - probes/sec: requests sent (pings, ARP requests, connects or lookups)
+      per second of wall time, resolution of the hosts included;
+    - cpu/probe: CPU time of the benchmark process per probe (the stand-ins
+      run in child processes, and are not accounted);
+    - p99 overhead: 99th percentile of the round trip times measured by
+      `ping`, minus the median round trip time of a single target, i.e. the
+      latency added by gaico itself when it handles many targets at once
+      (ping only, the other functions do not measure round trip times);
+    - ok: number of targets that answered.
+
+    Run with `python -m gaico.bench`, see `--help` for the options.
+"""
+
+import ipaddress
+import os
+import sys
+import time
+from gaico.bench.responder import Listener, TapResponder
+from gaico.net import arp_request, check_ports_state, getaddrinfo, ping
+from gaico.net.socket import Resolver, numeric_getaddrinfo
+from gaico.net.stats import LatencyHistogram
+
+TARGETS = (1000, 10000, 50000)
+
+
+class Measure(object):
+    """ Wall time and CPU time of a `with` block. """
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        self.started_cpu = time.process_time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.wall = time.perf_counter() - self.started
+        self.cpu = time.process_time() - self.started_cpu
+
+
+def loopback_hosts(count):
+    """ Returns `count` distinct loopback addresses. """
+
+    first = ipaddress.ip_address('127.0.0.1')
+    return [str(first + i) for i in range(count)]
+
+
+def tap_available():
+    """ Returns `True` if a `TapResponder` can be created. """
+
+    return os.geteuid() == 0 and os.path.exists('/dev/net/tun')
+
+
+class Report(object):
+    """ Writes one line per benchmark run. """
+
+    header = "{:<18} {:<10} {:>7} {:>9} {:>8} {:>12} {:>10} {:>13} {:>7}\n"
+    line = "{:<18} {:<10} {:>7} {:>9} {:>8.2f} {:>12,.0f} {:>8.1f}us {:>13} {:>7}\n"
+
+    def __init__(self, output):
+        self.output = output
+        output.write(self.header.format('function', 'variant', 'targets', 'probes', 'wall(s)',
+                                        'probes/sec', 'cpu/probe', 'p99 overhead', 'ok'))
+
+    def add(self, function, variant, targets, probes, measure, ok, overhead=None):
+        if overhead is None:
+            overhead = '-'
+        else:
+            overhead = '{:.2f}ms'.format(overhead * 1000)
+        self.output.write(self.line.format(function, variant, targets, probes, measure.wall,
+                                           probes / measure.wall,
+                                           measure.cpu * 1000000 / probes, overhead, ok))
+        self.output.flush()
+
+
+def bench_getaddrinfo(report, hosts):
+    """ Resolve a name for each of `hosts` with a cold `Resolver`, then from its cache.
+
+    Literal addresses never reach the resolver, and the system resolver would
+    measure the DNS server: the names are resolved by a stub lookup instead.
+    """
+
+    addresses = dict(('host-{}.bench.invalid'.format(i), host) for i, host in enumerate(hosts))
+    names = list(addresses)
+
+    def lookup(host, port, family=0, socktype=0, proto=0, flags=0):
+        return numeric_getaddrinfo(addresses[host], port, family, socktype, proto, flags)
+
+    resolver = Resolver(maxsize=len(names), lookup=lookup)
+    for variant in ('cold', 'cached'):
+        with Measure() as measure:
+            results = getaddrinfo(names, None, resolver=resolver)
+        ok = sum(1 for result in results.values() if not isinstance(result, Exception))
+        report.add('getaddrinfo', variant, len(names), len(names), measure, ok)
+
+
+def shards(variant, processes):
+    """ Returns the name of a `variant` run over `processes` processes. """
+
+    if processes is None or processes < 2:
+        return variant
+    return '{}/{}p'.format(variant, processes)
+
+
+def bench_ping(report, variant, hosts, count, timeout, rate, processes=None):
+    """ Ping `hosts`, and report the p99 overhead over the RTT of a single target. """
+
+    baseline = ping(hosts[:1], count=5, interval=0.01, timeout=timeout)[hosts[0]]['p50']
+
+    with Measure() as measure:
+        results = ping(hosts, count=count, interval=1, timeout=timeout, rate=rate,
+                       processes=processes)
+
+    histogram = LatencyHistogram()
+    ok = 0
+    for result in results.values():
+        if isinstance(result, dict):
+            histogram.merge(result['histogram'])
+            ok = ok + (result['received'] > 0)
+
+    overhead = None
+    if baseline is not None and histogram.count:
+        overhead = histogram.percentile(99) - baseline
+    report.add('ping', shards(variant, processes), len(hosts), len(hosts) * count, measure, ok,
+               overhead)
+
+
+def bench_arp_request(report, responder, hosts, timeout, processes=None):
+    """ Send one ARP request to each of `hosts`, simulated by `responder`. """
+
+    with Measure() as measure:
+        results = arp_request(hosts, responder.address, responder.name, timeout=timeout,
+                              processes=processes)
+    ok = sum(1 for result in results.values() if isinstance(result, str))
+    report.add('arp_request', shards('tap', processes), len(hosts), len(hosts), measure, ok)
+
+
+def bench_check_ports_state(report, listener, hosts, method, timeout, processes=None):
+    """ Check the port of `listener` on each of `hosts`. """
+
+    hosts_ports = dict((host, [listener.port]) for host in hosts)
+    with Measure() as measure:
+        results = check_ports_state(hosts_ports, timeout=timeout, fd_budget='auto',
+                                    method=method, processes=processes)
+    ok = sum(1 for result in results.values()
+             if isinstance(result, dict) and result[listener.port] is True)
+    report.add('check_ports_state', shards(method, processes), len(hosts), len(hosts), measure,
+               ok)
+
+
+def run(targets=TARGETS, functions=None, count=1, timeout=5, rate=None, tap=None,
+        methods=('connect', 'poll'), processes=None, output=sys.stdout):
+    """ Run the benchmarks.
+
+    :param targets: numbers of targets (default: 1k, 10k and 50k)
+    :param functions: names of the functions to benchmark (default: all)
+    :param count: number of pings per target (default: 1)
+    :param timeout: timeout of a single probe in seconds (default: 5)
+    :param rate: maximum number of pings per second (default: no limit)
+    :param tap: ping the hosts simulated on a tap device instead of loopback
+    addresses; ARP requests always need the tap device (default: when root)
+    :param methods: `check_ports_state` methods (default: connect and poll)
+    :param processes: also run the benchmarks sharded over this number of
+    processes (default: a single process only)
+    """
+
+    if functions is None:
+        functions = ('getaddrinfo', 'ping', 'arp_request', 'check_ports_state')
+    if tap is None:
+        tap = tap_available()
+
+    responder = None
+    if tap and ('ping' in functions or 'arp_request' in functions):
+        responder = TapResponder()
+        responder.start()
+
+    listener = None
+    if 'check_ports_state' in functions:
+        listener = Listener()
+        listener.start()
+
+    variants = [None]
+    if processes is not None and processes > 1:
+        variants.append(processes)
+
+    report = Report(output)
+    try:
+        for target_count in targets:
+            hosts = loopback_hosts(target_count)
+
+            if 'getaddrinfo' in functions:
+                bench_getaddrinfo(report, hosts)
+
+            for shard_count in variants:
+                if 'ping' in functions:
+                    if responder is not None:
+                        bench_ping(report, 'tap', responder.hosts(target_count), count, timeout,
+                                   rate, shard_count)
+                    else:
+                        bench_ping(report, 'loopback', hosts, count, timeout, rate, shard_count)
+
+                if 'arp_request' in functions:
+                    if responder is not None:
+                        bench_arp_request(report, responder, responder.hosts(target_count),
+                                          timeout, shard_count)
+                    else:
+                        output.write("arp_request        skipped, requires root and "
+                                     "/dev/net/tun\n")
+
+                if 'check_ports_state' in functions:
+                    for method in methods:
+                        bench_check_ports_state(report, listener, hosts, method, timeout,
+                                                shard_count)
+    finally:
+        if responder is not None:
+            responder.stop()
+        if listener is not None:
+            listener.stop()
@@ -3,7 +3,8 @@
 from gaico.net.socket import getaddrinfo
 from gaico.net.arp import arp_request
 from gaico.net.checks import check_ports_state
-from gaico.net.ping import ping
+from gaico.net.ping import ping, ping_iter
+from gaico.net.traceroute import traceroute
 
 
-__all__ = ['getaddrinfo', 'arp_request', 'check_ports_state', 'ping']
+__all__ = ['getaddrinfo', 'arp_request', 'check_ports_state', 'ping', 'ping_iter', 'traceroute']
@@ -0,0 +1,412 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import socket
+import time
+import weakref
+from gaico.net import metrics
+from gaico.net.arp import ETH_P_ARP, ARPTimeoutException, build_request, parse_reply
+from gaico.net.ping import BaseICMPEngine, PingStatistics, TRANSPORT_AUTO, pick_identifier
+from gaico.net.scheduler import SendScheduler
+
+"""
+    asyncio versions of the `gaico.net` functions.
+
+    The packets are built and parsed by the same code as the gevent versions,
+    only the waiting part is implemented with asyncio (`loop.add_reader`,
+    `loop.sock_sendto`, ...).
+"""
+
+
+async def sock_sendto(loop, sock, data, address):
+    """ Same as `loop.sock_sendto` (Python 3.11 or later), on every supported version. """
+
+    if hasattr(loop, 'sock_sendto'):
+        return await loop.sock_sendto(sock, data, address)
+
+    while True:
+        try:
+            return sock.sendto(data, address)
+        except (BlockingIOError, InterruptedError):
+            pass
+
+        # wait until the socket has room for the datagram
+        writable = loop.create_future()
+        loop.add_writer(sock.fileno(), lambda: writable.done() or writable.set_result(None))
+        try:
+            await writable
+        finally:
+            loop.remove_writer(sock.fileno())
+
+
+async def getaddrinfo(hosts, port, family=0, socktype=0, proto=0, flags=0):
+    """ Same as `gaico.net.getaddrinfo`, with `loop.getaddrinfo`. """
+
+    loop = asyncio.get_running_loop()
+
+    async def worker(host):
+        try:
+            return await loop.getaddrinfo(host, port, family=family, type=socktype, proto=proto,
+                                          flags=flags)
+        except Exception as e:
+            return e
+
+    results = await asyncio.gather(*[worker(host) for host in hosts])
+
+    return dict(zip(hosts, results))
+
+
+class AsyncSendScheduler(SendScheduler):
+    """ `gaico.net.scheduler.SendScheduler` for asyncio tasks. """
+
+    def __init__(self, *args, **kwargs):
+        super(AsyncSendScheduler, self).__init__(*args, **kwargs)
+        self.wakeup = asyncio.Event()
+
+    async def wait(self, when):
+        """ Wait until `when` (a `time.monotonic()` value) and a send token is available. """
+
+        now = time.monotonic()
+        if when <= now and not self.backlog and self._take_token(now):
+            # fast path: no need to go through the timer wheel
+            return
+
+        event = asyncio.Event()
+        self._schedule(when, event)
+
+        if self.driver is None or self.driver.done():
+            self.driver = asyncio.ensure_future(self._run())
+        if self._wakes_up_later(when):
+            self.wakeup.set()
+
+        await event.wait()
+
+    async def _run(self):
+        """ Drive the timer wheel, sleeping until the next waiter is due. """
+
+        while True:
+            now = time.monotonic()
+            delay = self._next_delay(now)
+            self.wakeup.clear()
+            if delay is None:
+                self.next_wakeup = None
+                await self.wakeup.wait()
+                continue
+
+            # `wait` wakes the driver up early for a waiter due sooner
+            self.next_wakeup = now + delay
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+            self._release(time.monotonic())
+
+    def close(self):
+        """ Stop the driver task. """
+
+        if self.driver is not None:
+            self.driver.cancel()
+
+
+class AsyncICMPEngine(BaseICMPEngine):
+    """ ICMP engine for asyncio: replies are read from a `loop.add_reader` callback. """
+
+    socket_module = socket
+
+    def __init__(self, family, transport=TRANSPORT_AUTO, loop=None):
+        super(AsyncICMPEngine, self).__init__(family, transport)
+        self.socket.setblocking(False)
+        self.loop = loop or asyncio.get_running_loop()
+        self.reading = False
+
+    async def ping(self, addr_info, identifier, sequence, timeout, packet_size):
+        """ Returns either the delay (in seconds) or `None` on timeout. """
+
+        key = (identifier, sequence, addr_info[4][0])
+        waiter = self.loop.create_future()
+        self.waiters.setdefault(key, []).append(waiter)
+
+        if not self.reading:
+            self.loop.add_reader(self.socket.fileno(), self._read_ready)
+            self.reading = True
+
+        try:
+            request = self.build_request(identifier, sequence, packet_size)
+            await sock_sendto(self.loop, self.socket, request, addr_info[4])
+            if metrics.enabled:
+                metrics.count('icmp.sent')
+            return await asyncio.wait_for(waiter, timeout)
+        except asyncio.TimeoutError:
+            if metrics.enabled:
+                metrics.count('icmp.timeouts')
+            return None
+        finally:
+            self.remove_waiter(key, waiter)
+            if not self.waiters:
+                self._stop_reading()
+                self.collect_filtered()
+
+    def _read_ready(self):
+        """ Read all the pending replies and wake up the matching waiters. """
+
+        while True:
+            packets = self.receiver.receive()
+            for received_packet, addr, time_received in packets:
+                self.dispatch(received_packet, addr, time_received)
+            if len(packets) < self.receiver.batch:
+                return
+
+    def _stop_reading(self):
+        if self.reading:
+            self.loop.remove_reader(self.socket.fileno())
+            self.reading = False
+
+    def wake(self, waiter, delay):
+        """ Wake up `waiter` with the `delay` of its reply. """
+
+        if not waiter.done():
+            waiter.set_result(delay)
+
+    def close(self):
+        """ Stop reading and close the socket. """
+
+        self._stop_reading()
+        super(AsyncICMPEngine, self).close()
+
+
+# one set of engines per event loop
+_engines = weakref.WeakKeyDictionary()
+
+
+def get_engine(family, transport=TRANSPORT_AUTO):
+    """ Returns the shared `AsyncICMPEngine` of the running loop. """
+
+    loop = asyncio.get_running_loop()
+    engines = _engines.setdefault(loop, {})
+
+    engine = engines.get((family, transport))
+    if engine is None:
+        engine = engines[(family, transport)] = AsyncICMPEngine(family, transport, loop)
+    return engine
+
+
+def close_engines():
+    """ Close all the shared ICMP engines of the running loop. """
+
+    engines = _engines.pop(asyncio.get_running_loop(), {})
+    for engine in engines.values():
+        engine.close()
+
+
+async def ping_worker(addr_info, timeout, count, packet_size, interval, deadline,
+                      transport=TRANSPORT_AUTO, scheduler=None):
+    """ Same as `gaico.net.ping.ping_worker`, as a coroutine. """
+
+    own_scheduler = scheduler is None
+    if own_scheduler:
+        scheduler = AsyncSendScheduler()
+
+    engine = get_engine(addr_info[0], transport)
+    statistics = PingStatistics()
+
+    deadline_time = None
+    if deadline is not None:
+        deadline_time = time.time() + deadline
+
+    identifier = pick_identifier(int(time.time() * 1000000))
+
+    try:
+        next_ping = scheduler.start_time()
+        for sequence in range(count):
+            await scheduler.wait(next_ping)
+            next_ping = time.monotonic() + interval
+
+            delay = await engine.ping(addr_info, identifier, sequence, timeout, packet_size)
+            statistics.add(delay)
+
+            if deadline_time is not None and deadline_time < time.time():
+                # deadline reached
+                break
+    finally:
+        if own_scheduler:
+            scheduler.close()
+
+    return statistics.result(addr_info[4][0])
+
+
+async def ping(hosts, timeout=10, count=10, packet_size=64, interval=1, deadline=None,
+               transport=TRANSPORT_AUTO, rate=None, jitter=0):
+    """ Same as `gaico.net.ping`, as a coroutine. """
+
+    addresses_info = await getaddrinfo(hosts, None)
+    scheduler = AsyncSendScheduler(rate, jitter)
+
+    async def worker(addr_info):
+        try:
+            return await ping_worker(addr_info, timeout, count, packet_size, interval,
+                                     deadline, transport, scheduler)
+        except Exception as e:
+            return e
+
+    jobs = {}
+    failures = {}
+    for host in hosts:
+        addr_info = addresses_info[host]
+        if addr_info is None or isinstance(addr_info, Exception):
+            failures[host] = addr_info
+            continue
+        jobs[host] = worker(addr_info[0])
+
+    try:
+        ping_results = await asyncio.gather(*jobs.values())
+    finally:
+        scheduler.close()
+
+    results = dict(zip(jobs.keys(), ping_results))
+    results.update(failures)
+
+    return results
+
+
+async def arp_request(hosts, source, interface, timeout=10, count=1):
+    """ Same as `gaico.net.arp_request`, as a coroutine.
+
+    All the requests are sent from a single packet socket, and a single
+    reader callback dispatches the replies.
+    """
+
+    loop = asyncio.get_running_loop()
+
+    addresses_info = await getaddrinfo(hosts, None, socket.AF_INET)
+    src_addr_info = (await getaddrinfo([source], None, socket.AF_INET))[source]
+    if isinstance(src_addr_info, Exception):
+        raise src_addr_info
+
+    source_ip = socket.inet_pton(socket.AF_INET, src_addr_info[0][4][0])
+
+    try:
+        my_socket = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(ETH_P_ARP))
+    except PermissionError:
+        msg = "ARP requests can only be sent from processes running as root."
+        raise PermissionError(msg)
+
+    my_socket.bind((interface, ETH_P_ARP))
+    my_socket.setblocking(False)
+    source_mac = my_socket.getsockname()[4]
+
+    # waiters are indexed by the IP address of the target (several hosts
+    # can have the same address)
+    waiters = {}
+
+    def read_ready():
+        while True:
+            try:
+                frame = my_socket.recv(1024)
+            except (BlockingIOError, InterruptedError):
+                return
+
+            reply = parse_reply(frame)
+            if reply is None:
+                continue
+
+            src_hw, src_ip, dst_ip = reply
+            if dst_ip != source_ip:
+                continue
+            for waiter in waiters.get(src_ip, ()):
+                if not waiter.done():
+                    waiter.set_result(src_hw.hex())
+
+    async def worker(destination):
+        destination_ip = socket.inet_pton(socket.AF_INET, destination[4][0])
+        waiter = loop.create_future()
+        ip_waiters = waiters.setdefault(destination_ip, [])
+        ip_waiters.append(waiter)
+        try:
+            for i in range(count):
+                request = build_request(source_mac, source_ip, destination_ip)
+                await loop.sock_sendall(my_socket, request)
+                try:
+                    return await asyncio.wait_for(asyncio.shield(waiter), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            return ARPTimeoutException()
+        finally:
+            ip_waiters.remove(waiter)
+            if not ip_waiters:
+                del waiters[destination_ip]
+
+    loop.add_reader(my_socket.fileno(), read_ready)
+
+    jobs = {}
+    failures = {}
+    try:
+        for host in hosts:
+            addr_info = addresses_info[host]
+            if isinstance(addr_info, Exception):
+                failures[host] = addr_info
+                continue
+            jobs[host] = worker(addr_info[0])
+
+        arp_results = await asyncio.gather(*jobs.values())
+    finally:
+        loop.remove_reader(my_socket.fileno())
+        my_socket.close()
+
+    results = dict(zip(jobs.keys(), arp_results))
+    results.update(failures)
+
+    return results
+
+
+async def _check_port_state(addr_info, port, timeout):
+    """ Check the state of a single `port` on `host`. """
+
+    loop = asyncio.get_running_loop()
+
+    s = socket.socket(addr_info[0], socket.SOCK_STREAM)
+    s.setblocking(False)
+
+    host = addr_info[4][0]
+
+    try:
+        await asyncio.wait_for(loop.sock_connect(s, (host, port)), timeout)
+    except asyncio.TimeoutError:
+        return socket.timeout('timed out')
+    except Exception as e:
+        return e
+    finally:
+        s.close()
+
+    return True
+
+
+async def check_ports_state(hosts_ports, timeout=10):
+    """ Same as `gaico.net.check_ports_state`, as a coroutine. """
+
+    addresses_info = await getaddrinfo(hosts_ports.keys(), None)
+
+    jobs = []
+    failures = {}
+    for host, ports in hosts_ports.items():
+        addr_info = addresses_info[host]
+        if isinstance(addr_info, Exception):
+            failures[host] = addr_info
+            continue
+        for port in ports:
+            jobs.append((host, port, addr_info[0]))
+
+    states = await asyncio.gather(*[
+        _check_port_state(addr_info, port, timeout) for host, port, addr_info in jobs
+    ])
+
+    results = {}
+    for (host, port, addr_info), state in zip(jobs, states):
+        res = results.get(host, {})
+        res[port] = state
+        res['host'] = addr_info[4][0]
+        results[host] = res
+
+    results.update(failures)
+
+    return results
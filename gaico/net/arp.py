@@ -3,70 +3,82 @@
 import gevent
 import struct
 import time
-from gevent import select, socket
+from collections import OrderedDict
+from gevent import socket
+from gevent.event import AsyncResult
+from gevent.socket import wait_read
+from gevent.pool import Pool
 from gaico import GaicoException
-from gaico.net import getaddrinfo
+from gaico.net import getaddrinfo, metrics
+from gaico.net.batch import BatchReceiver, BatchSender
+from gaico.net.socket import default_resolver, getaddrinfo_iter
+from gaico.net.bpf import FilterCounter, PacketCounter, arp_reply_filter, attach_filter
+from gaico.net.ping import RECEIVE_BUFFER_SIZE
+from gaico.net.shard import run_shards, split
+from gaico.net.targets import expand_hosts
+from gaico.net.timeouts import get_adaptive, wait as wait_reply
 
 """
     Pure python ARP request implementation.
+
+    A `NeighborCache` keeps the MAC addresses found for a while, so that the
+    next calls only send requests for the hosts that are missing or stale.
 """
 
-ARP_PROTO = struct.pack('!H', 0x0806)
+ETH_P_ARP = 0x0806
+ARP_PROTO = struct.pack('!H', ETH_P_ARP)
 ARP_REQUEST = struct.pack('!H', 0x0001)
 ARP_REPLY = struct.pack('!H', 0x0002)
 
+# complete entry of the kernel neighbor table
+ATF_COM = 0x02
+
 
 class ARPTimeoutException(GaicoException):
     """ Raised when no reply are received after the given timeout. """
     pass
 
 
-def receive_reply(my_socket, source_ip, destination_ip, timeout):
-    """ Wait for an ARP Reply. """
-    time_left = timeout
-    while True:
-        started_select = time.time()
-        what_ready = select.select([my_socket], [], [], time_left)
-        how_long_in_select = (time.time() - started_select)
-        if what_ready[0] == []:
-            # timeout
-            return ARPTimeoutException()
+def parse_frame(frame):
+    """ Returns the (operation, sender MAC, sender IP, target IP) of an ARP packet, or `None`. """
 
-        # read from the socket
-        frame, addr = my_socket.recvfrom(1024)
+    if frame[12:14] != ARP_PROTO:
+        # not an ARP packet
+        return None
 
-        time_left = time_left - how_long_in_select
-        if time_left <= 0:
-            # timeout
-            return ARPTimeoutException()
+    operation = frame[20:22]
+
+    arp_headers = frame[18:20]
+    hlen, plen = struct.unpack('!1B1B', arp_headers)
+
+    arp_addrs = frame[22:22 + 2 * hlen + 2 * plen]
+    if len(arp_addrs) != 2 * hlen + 2 * plen:
+        # truncated frame
+        return None
 
-        if frame[12:14] != ARP_PROTO:
-            # not an ARP packet
-            continue
+    src_hw, src_ip, dst_hw, dst_ip = struct.unpack(
+        '!{hlen}s{plen}s{hlen}s{plen}s'.format(hlen=hlen, plen=plen),
+        arp_addrs
+    )
 
-        if frame[20:22] != ARP_REPLY:
-            # not an ARP reply
-            continue
+    return operation, src_hw, src_ip, dst_ip
 
-        arp_headers = frame[18:20]
-        hlen, plen = struct.unpack('!1B1B', arp_headers)
 
-        arp_addrs = frame[22:22 + 2 * hlen + 2 * plen]
-        src_hw, src_ip, dst_hw, dst_ip = struct.unpack(
-            '!{hlen}s{plen}s{hlen}s{plen}s'.format(hlen=hlen, plen=plen),
-            arp_addrs
-        )
+def parse_reply(frame):
+    """ Returns the (sender MAC, sender IP, target IP) of an ARP reply, or `None`. """
 
-        if src_ip == destination_ip and dst_ip == source_ip:
-            return src_hw.hex()
+    parsed = parse_frame(frame)
+    if parsed is None or parsed[0] != ARP_REPLY:
+        # not an ARP reply
+        return None
 
+    return parsed[1:]
 
-def send_request(my_socket, destination_ip, source_ip, interface):
-    """ Send an ARP request. """
+
+def build_request(source_mac, source_ip, destination_ip):
+    """ Returns the Ethernet frame of an ARP request. """
     bcast_mac = struct.pack('!6B', *[0xFF]*6)
-    source_mac = my_socket.getsockname()[4]
     destination_mac = struct.pack('!6B', *[0x00]*6)
-    print(destination_ip)
     arpframe = [
         # Ethernet
         bcast_mac,
@@ -85,10 +97,317 @@ def send_request(my_socket, destination_ip, source_ip, interface):
         destination_ip
     ]
 
-    my_socket.send(b''.join(arpframe))
+    return b''.join(arpframe)
+
+
+class NeighborCache(object):
+    """ In-process cache of the MAC addresses found by `arp_request`.
+
+    Entries are indexed by interface and IP address. MAC addresses are kept
+    `ttl` seconds, and hosts that did not answer `negative_ttl` seconds. At
+    most `maxsize` entries are kept, the least recently used are evicted
+    first.
+
+    The cache of an interface is seeded from the kernel neighbor table
+    (`/proc/net/arp`) the first time it is used, then the ARP engine of the
+    interface keeps it up to date with every reply read for its requests,
+    and with the gratuitous ARP packets announcing new or moved hosts seen
+    meanwhile (see `ARPEngine`).
+    """
+
+    def __init__(self, ttl=300, negative_ttl=30, maxsize=65536):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.maxsize = maxsize
+
+        # (interface, IP address) -> (expiration time, MAC address or exception)
+        self.cache = OrderedDict()
+        self.seeded = set()
+
+        self.hits = 0
+        self.misses = 0
+        self.learned = 0
+        self.evictions = 0
+
+    def get(self, interface, ip):
+        """ Returns the MAC address of `ip` (4 bytes), an `ARPTimeoutException`
+        if it did not answer recently, or `None` if it is missing or stale.
+        """
+
+        key = (interface, ip)
+        entry = self.cache.get(key)
+        if entry is not None:
+            expiration, result = entry
+            if expiration > time.monotonic():
+                self.hits = self.hits + 1
+                if metrics.enabled:
+                    metrics.count('arp.cache_hits')
+                self.cache.move_to_end(key)
+                return result
+            del self.cache[key]
+
+        self.misses = self.misses + 1
+        if metrics.enabled:
+            metrics.count('arp.cache_misses')
+        return None
+
+    def add(self, interface, ip, result):
+        """ Cache `result` (a MAC address, or an exception) for `ip`. """
+
+        ttl = self.negative_ttl if isinstance(result, Exception) else self.ttl
+        if not ttl:
+            return
+
+        key = (interface, ip)
+        self.cache[key] = (time.monotonic() + ttl, result)
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.maxsize:
+            self.cache.popitem(last=False)
+            self.evictions = self.evictions + 1
+
+    def learn(self, interface, ip, mac_address):
+        """ Cache the MAC address of a host seen on the network. """
+
+        self.learned = self.learned + 1
+        if metrics.enabled:
+            metrics.count('arp.learned')
+        self.add(interface, ip, mac_address)
+
+    def seed(self, interface, path='/proc/net/arp'):
+        """ Add the complete entries of the kernel neighbor table for `interface`, once. """
+
+        if interface in self.seeded:
+            return
+        self.seeded.add(interface)
+
+        try:
+            with open(path) as table:
+                lines = table.readlines()[1:]
+        except OSError:
+            return
+
+        for line in lines:
+            fields = line.split()
+            if len(fields) < 6 or fields[5] != interface:
+                continue
+            # the kernel does not give the age of its entries
+            if int(fields[2], 16) & ATF_COM:
+                ip = socket.inet_pton(socket.AF_INET, fields[0])
+                self.add(interface, ip, fields[3].replace(':', ''))
+
+    def stats(self):
+        """ Returns the counters of the cache. """
+
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'learned': self.learned,
+            'evictions': self.evictions,
+            'size': len(self.cache),
+        }
+
+    def clear(self):
+        """ Remove all the entries from the cache. """
+
+        self.cache.clear()
+        self.seeded.clear()
+
+
+class ARPEngine(object):
+    """ Packet socket bound to an interface, shared by all the ARP requests sent on it.
+
+    A single reader greenlet parses the ARP replies and wakes up the greenlets
+    waiting for the sender IP address. Frames are sent and read a batch at a
+    time (see `gaico.net.batch`). With `bpf`, a socket filter drops
+    everything but the ARP replies sent to our MAC address in the kernel, and
+    the ARP frames of the interface that never reach Python are counted as
+    `arp.filtered` (see `gaico.net.bpf.FilterCounter`).
+
+    The requests made with a `NeighborCache` update it with every reply, and
+    every gratuitous ARP packet, read while they are in flight: the filter
+    also accepts gratuitous packets. Like without a cache, the reader stops
+    once no request is waiting.
+    """
+
+    def __init__(self, interface, bpf=True):
+        self.interface = interface
 
+        try:
+            self.socket = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, 0)
+        except PermissionError:
+            msg = "ARP requests can only be sent from processes running as root."
+            raise PermissionError(msg)
 
-def arp_worker(destination, source, interface, timeout, count):
+        # replies to a burst of requests arrive all at once
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER_SIZE)
+        if metrics.enabled:
+            metrics.count('arp.socket_opens')
+
+        # the protocol is only set at bind time, to only receive ARP frames
+        # from this interface
+        self.socket.bind((interface, ETH_P_ARP))
+        self.mac_address = self.socket.getsockname()[4]
+
+        # frames received before the filter is attached are discarded by `dispatch`
+        self.filter_counter = None
+        if bpf:
+            attach_filter(self.socket, arp_reply_filter(self.mac_address, gratuitous=True))
+            # the ARP frames of the interface, which the socket would receive without the filter
+            self.filter_counter = FilterCounter(PacketCounter(interface, ETH_P_ARP))
+
+        self.receiver = BatchReceiver(self.socket, addresses=False)
+        self.sender = BatchSender(self.socket)
+
+        # waiters are indexed by (IP address of the target, IP address used as source)
+        self.waiters = {}
+        self.reader = None
+
+        # caches of the requests in flight -> number of these requests
+        self.caches = {}
+
+    def request(self, source_ip, destination_ip, timeout, count, adaptive=None, cache=None):
+        """ Returns the MAC address of `destination_ip`, or an ARPTimeoutException.
+
+        With `adaptive` (a `gaico.net.timeouts.AdaptiveTimeout`), each request
+        times out as soon as the round trip times observed allow it. With
+        `cache` (a `NeighborCache`), the frames read until the request is done
+        update it.
+        """
+
+        waiter = AsyncResult()
+        key = (destination_ip, source_ip)
+        waiters = self.waiters.setdefault(key, [])
+        waiters.append(waiter)
+        if cache is not None:
+            self.caches[cache] = self.caches.get(cache, 0) + 1
+
+        self.start()
+
+        address = socket.inet_ntop(socket.AF_INET, destination_ip)
+        try:
+            for i in range(count):
+                self.sender.send(build_request(self.mac_address, source_ip, destination_ip),
+                                 on_error=waiter.set_exception)
+                if metrics.enabled:
+                    metrics.count('arp.sent')
+                time_sent = time.monotonic()
+                try:
+                    mac_address = wait_reply(waiter, address, timeout, adaptive)
+                except gevent.Timeout:
+                    continue
+                if adaptive is not None:
+                    adaptive.add(address, time.monotonic() - time_sent)
+                return mac_address
+            if metrics.enabled:
+                metrics.count('arp.timeouts')
+            return ARPTimeoutException()
+        finally:
+            if cache is not None:
+                self.caches[cache] = self.caches[cache] - 1
+                if not self.caches[cache]:
+                    del self.caches[cache]
+            waiters.remove(waiter)
+            if not waiters:
+                del self.waiters[key]
+                if not self.waiters:
+                    self.collect_filtered()
+                    # the reader would otherwise wait for the next frame; the
+                    # next request starts a new one
+                    reader, self.reader = self.reader, None
+                    reader.kill(block=False)
+
+    def start(self):
+        """ Start the reader greenlet, if it is not running. """
+
+        if self.reader is None or self.reader.dead:
+            self.reader = gevent.spawn(self._read_loop)
+
+    def _read_loop(self):
+        """ Read replies from the socket and wake up the matching waiters. """
+
+        fd = self.socket.fileno()
+        while self.waiters:
+            wait_read(fd)
+            if metrics.enabled:
+                metrics.count('arp.wakeups')
+            # drain all the pending frames before waiting again
+            while True:
+                frames = self.receiver.receive()
+                for frame, _, _ in frames:
+                    self.dispatch(frame)
+                if len(frames) < self.receiver.batch:
+                    break
+
+    def dispatch(self, frame):
+        """ Parse one frame and wake up the waiters of its sender (if any). """
+
+        if metrics.enabled:
+            metrics.count('arp.received')
+        if self.filter_counter is not None:
+            self.filter_counter.received = self.filter_counter.received + 1
+
+        parsed = parse_frame(frame)
+        waiters = None
+        if parsed is not None:
+            operation, src_hw, src_ip, dst_ip = parsed
+            if self.caches and len(src_hw) == 6 and len(src_ip) == 4 and \
+                    (operation == ARP_REPLY or src_ip == dst_ip):
+                # a reply, or a host announcing itself
+                for cache in self.caches:
+                    cache.learn(self.interface, src_ip, src_hw.hex())
+                if operation != ARP_REPLY:
+                    return
+            if operation == ARP_REPLY:
+                waiters = self.waiters.get((src_ip, dst_ip))
+
+        if not waiters:
+            # not an ARP reply, or a reply no one waits for
+            if metrics.enabled:
+                metrics.count('arp.discarded')
+            return
+
+        for waiter in waiters:
+            waiter.set(src_hw.hex())
+
+    def collect_filtered(self):
+        """ Count the frames kept from Python since the last call. """
+
+        if metrics.enabled and self.filter_counter is not None:
+            metrics.count('arp.filtered', self.filter_counter.collect())
+
+    def close(self):
+        """ Close the socket and stop the reader greenlet. """
+
+        if self.reader is not None:
+            self.reader.kill()
+        self.collect_filtered()
+        if self.filter_counter is not None:
+            self.filter_counter.total.close()
+        self.socket.close()
+
+
+_engines = {}
+
+
+def get_engine(interface, bpf=True):
+    """ Returns the shared `ARPEngine` for `interface`. """
+
+    engine = _engines.get((interface, bpf))
+    if engine is None:
+        engine = _engines[(interface, bpf)] = ARPEngine(interface, bpf)
+    return engine
+
+
+def close_engines():
+    """ Close all the shared ARP engines. """
+
+    while _engines:
+        _, engine = _engines.popitem()
+        engine.close()
+
+
+def arp_worker(destination, source, interface, timeout, count, bpf=True, cache=None,
+               adaptive=None):
     """ Worker that is run for each host. Concurrency is handled by gevent. """
 
     if destination[0] != source[0]:
@@ -99,56 +418,116 @@ def arp_worker(destination, source, interface, timeout, count):
     source_ip = socket.inet_pton(source[0], source[4][0])
     destination_ip = socket.inet_pton(destination[0], destination[4][0])
 
-    try:
-        my_socket = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.SOCK_RAW)
-    except PermissionError:
-            msg = "ARP requests can only be sent from processes running as root."
-
-            raise PermissionError(msg)
-
-    my_socket.bind((interface, socket.SOCK_RAW))
-
-    for i in range(count):
-        send_request(my_socket, destination_ip, source_ip, interface)
-        mac_address = receive_reply(my_socket, source_ip, destination_ip, timeout)
-
-        if not isinstance(mac_address, Exception):
-            return mac_address
+    if cache is not None:
+        result = cache.get(interface, destination_ip)
+        if result is not None:
+            return result
 
-    return mac_address
+    engine = get_engine(interface, bpf)
+    result = engine.request(source_ip, destination_ip, timeout, count, adaptive, cache)
+    if cache is not None and isinstance(result, ARPTimeoutException):
+        # replies are cached by the engine, silent hosts here
+        cache.add(interface, destination_ip, result)
+    return result
 
 
-def arp_request(hosts, source, interface, timeout=10, count=1):
+def arp_request(hosts, source, interface, timeout=10, count=1, bpf=True,
+                resolver=default_resolver, concurrency=None, processes=None, cache=None,
+                adaptive=None):
     """ Pure Python implementation of ARP request.
 
-    :param hosts: targets of the ARP requests (ip address or hostname)
+    :param hosts: targets of the ARP requests (ip address, hostname, CIDR block
+    or range, see `gaico.net.targets`)
     :param source: the source of the ARP request (ip address or hostname)
     :param interface: the name of the network interface where the ARP request will be sent
     :param timeout: how many seconds to wait for a reply (default: 10)
     :param count: maximum number of ARP requests to send, stops after the first reply (default: 1)
+    :param bpf: attach a socket filter so that the kernel only delivers ARP
+    replies (default: True)
+    :param resolver: `gaico.net.socket.Resolver` used to resolve the hosts, or
+    `None` to bypass the cache (default: the shared resolver cache)
+    :param concurrency: maximum number of hosts requested at once (default: no limit)
+    :param processes: split the hosts between this number of processes, see
+    `gaico.net.shard`; `concurrency` is then shared, and each process resolves
+    its hosts with its own cache (default: a single process)
+    :param cache: `NeighborCache` answering for the hosts found (or silent)
+    recently, requests are only sent for the other hosts; it also learns
+    from the gratuitous ARP packets seen while the requests are in flight
+    (default: no cache, every host is requested)
+    :param adaptive: `True`, or a `gaico.net.timeouts.AdaptiveTimeout` shared
+    by several calls, to time each request out as soon as the round trip
+    times observed for the host (or its subnet) allow it, `timeout` being an
+    upper bound; with `processes`, each process has its own estimates
+    (default: a fixed timeout)
 
     Returns a dictionary with hosts as keys and the MAC address of the host or
     an Exception.
     """
 
-    addresses_info = getaddrinfo(hosts, None, socket.AF_INET)
-    src_addr_info = getaddrinfo([source], None, socket.AF_INET)[source]
+    src_addr_info = getaddrinfo([source], None, socket.AF_INET, resolver=resolver)[source]
     if isinstance(src_addr_info, Exception):
         raise src_addr_info
 
-    jobs = []
-    failures = {}
-    for host in hosts:
-        addr_info = addresses_info[host]
+    if cache is not None:
+        cache.seed(interface)
+
+    if processes is not None and processes > 1:
+        results = {}
+        hosts = list(dict.fromkeys(expand_hosts(hosts)))
+
+        # the cache stays in this process: only the other hosts are sharded
+        addresses = {}
+        if cache is not None:
+            pending = []
+            for host, addr_info in getaddrinfo_iter(hosts, None, socket.AF_INET,
+                                                    resolver=resolver):
+                if isinstance(addr_info, Exception):
+                    results[host] = addr_info
+                    continue
+                ip = addresses[host] = socket.inet_pton(socket.AF_INET, addr_info[0][4][0])
+                result = cache.get(interface, ip)
+                if result is None:
+                    pending.append(host)
+                else:
+                    results[host] = result
+            hosts = pending
+            if not hosts:
+                return results
+
+        parts = [part for part in split(hosts, processes) if part]
+        kwargs = dict(source=src_addr_info[0][4][0], interface=interface, timeout=timeout,
+                      count=count, bpf=bpf, adaptive=bool(adaptive))
+        if concurrency is not None:
+            kwargs['concurrency'] = max(1, concurrency // len(parts))
+        if resolver is None:
+            kwargs['resolver'] = None
+
+        for shard_results in run_shards(arp_request, parts, kwargs):
+            results.update(shard_results)
+            if cache is not None:
+                for host, result in shard_results.items():
+                    if isinstance(result, (str, ARPTimeoutException)):
+                        cache.add(interface, addresses[host], result)
+        return results
+
+    results = {}
+    adaptive = get_adaptive(adaptive)
+
+    def worker(host, addr_info):
+        try:
+            results[host] = arp_worker(addr_info, src_addr_info[0], interface, timeout, count,
+                                       bpf, cache, adaptive)
+        except Exception as e:
+            results[host] = e
+
+    # hosts are resolved a chunk at a time, and requested as they come
+    jobs = Pool(concurrency)
+    for host, addr_info in getaddrinfo_iter(expand_hosts(hosts), None, socket.AF_INET,
+                                            resolver=resolver):
         if isinstance(addr_info, Exception):
-            failures[host] = addr_info
-            continue
-        jobs.append(gevent.spawn(arp_worker, addr_info[0], src_addr_info[0], interface,
-                                 timeout, count))
-    gevent.joinall(jobs)
-
-    arp_results = [job.value for job in jobs]
-    results = dict(zip(hosts, arp_results))
-    results.update(failures)
+            results[host] = addr_info
+        else:
+            jobs.spawn(worker, host, addr_info[0])
+    jobs.join()
 
     return results
@@ -0,0 +1,472 @@
+# -*- coding: utf-8 -*-
+
+import ctypes
+import ctypes.util
+import errno
+import gevent
+import os
+import socket
+import struct
+import sys
+import time
+from gevent.lock import Semaphore
+from gevent.socket import wait_write
+
+"""
+    Batched datagram I/O with recvmmsg and sendmmsg.
+
+    Reading one packet per wakeup and per system call costs more than the
+    parsing of the packet itself at tens of thousands of packets per second.
+    `BatchReceiver` reads every pending packet of a socket, up to a whole
+    ring of preallocated buffers per `recvmmsg` call, and `BatchSender`
+    queues the packets sent during an iteration of the event loop and sends
+    them with a single `sendmmsg` call.
+
+    Both fall back to one system call per packet when libc does not provide
+    `recvmmsg`/`sendmmsg` (they are Linux specific).
+
+    With `timestamps`, `BatchReceiver` also returns the time the kernel
+    received each packet (`SO_TIMESTAMPNS`), so that round trip times do not
+    include the time a reply waits for the process to read it. Kernel
+    timestamps are on the wall clock: they are converted to the
+    `time.monotonic_ns()` clock, which the senders use, when they are read.
+"""
+
+# packets read or sent per system call
+BATCH_SIZE = 64
+
+# large enough for an Ethernet frame, or an ICMP reply of a 1472 bytes ping
+BUFFER_SIZE = 2048
+
+# large enough for any socket address (struct sockaddr_storage)
+NAME_SIZE = 128
+
+# receive timestamps as a struct timespec control message; older socket
+# modules lack the constant, use the asm-generic value of Linux (x86, arm)
+# there, and the time of the read elsewhere
+SO_TIMESTAMPNS = getattr(socket, 'SO_TIMESTAMPNS',
+                         35 if sys.platform.startswith('linux') else None)
+SCM_TIMESTAMPNS = SO_TIMESTAMPNS
+
+# struct cmsghdr followed by a struct timespec
+_TIMESTAMP_MESSAGE = struct.Struct('@Niill')
+CONTROL_SIZE = socket.CMSG_SPACE(struct.calcsize('@ll'))
+
+# errors meaning that the socket has nothing to read, or no room to send
+WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [
+        ('iov_base', ctypes.c_void_p),
+        ('iov_len', ctypes.c_size_t),
+    ]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_name', ctypes.c_void_p),
+        ('msg_namelen', ctypes.c_uint32),
+        ('msg_iov', ctypes.POINTER(iovec)),
+        ('msg_iovlen', ctypes.c_size_t),
+        ('msg_control', ctypes.c_void_p),
+        ('msg_controllen', ctypes.c_size_t),
+        ('msg_flags', ctypes.c_int),
+    ]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_hdr', msghdr),
+        ('msg_len', ctypes.c_uint),
+    ]
+
+
+def _load_libc():
+    """ Returns the `recvmmsg` and `sendmmsg` functions of libc, or `None`. """
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        recvmmsg, sendmmsg = libc.recvmmsg, libc.sendmmsg
+    except (OSError, AttributeError):
+        return None, None
+
+    recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int,
+                         ctypes.c_void_p]
+    sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int]
+    return recvmmsg, sendmmsg
+
+
+_recvmmsg, _sendmmsg = _load_libc()
+
+
+def encode_address(address, family):
+    """ Returns the `struct sockaddr` of a Python socket `address`. """
+
+    if family == socket.AF_INET:
+        return struct.pack('=H', family) + struct.pack('!H', address[1]) + \
+            socket.inet_pton(family, address[0]) + b'\x00' * 8
+
+    if family == socket.AF_INET6:
+        flowinfo, scope_id = (tuple(address[2:4]) + (0, 0))[:2]
+        return struct.pack('=H', family) + struct.pack('!HI', address[1], flowinfo) + \
+            socket.inet_pton(family, address[0]) + struct.pack('=I', scope_id)
+
+    raise ValueError("Unsupported address family: {}".format(family))
+
+
+def decode_address(name):
+    """ Returns the Python socket address of a `struct sockaddr`, or `None`. """
+
+    if len(name) < 2:
+        return None
+
+    family, = struct.unpack('=H', name[:2])
+    if family == socket.AF_INET:
+        port, = struct.unpack('!H', name[2:4])
+        return socket.inet_ntop(family, name[4:8]), port
+
+    if family == socket.AF_INET6:
+        port, flowinfo = struct.unpack('!HI', name[2:8])
+        scope_id, = struct.unpack('=I', name[24:28])
+        return socket.inet_ntop(family, name[8:24]), port, flowinfo, scope_id
+
+    return None
+
+
+def _raise_errno():
+    error = ctypes.get_errno()
+    raise OSError(error, os.strerror(error))
+
+
+# offsets of the fields written and read for each message
+MESSAGE_SIZE = ctypes.sizeof(mmsghdr)
+NAME_OFFSET = mmsghdr.msg_hdr.offset + msghdr.msg_name.offset
+NAMELEN_OFFSET = mmsghdr.msg_hdr.offset + msghdr.msg_namelen.offset
+CONTROLLEN_OFFSET = mmsghdr.msg_hdr.offset + msghdr.msg_controllen.offset
+LEN_OFFSET = mmsghdr.msg_len.offset
+IOV_LEN_OFFSET = iovec.iov_len.offset
+
+# (msg_namelen, msg_controllen, msg_len) of each message
+_LENGTHS = struct.Struct('@{}xI{}xN{}xI{}x'.format(
+    NAMELEN_OFFSET, CONTROLLEN_OFFSET - NAMELEN_OFFSET - 4,
+    LEN_OFFSET - CONTROLLEN_OFFSET - struct.calcsize('N'), MESSAGE_SIZE - LEN_OFFSET - 4))
+
+# address caches are cleared when they reach this size
+ADDRESS_CACHE_SIZE = 65536
+
+
+class _MessageRing(object):
+    """ Preallocated buffers, addresses and headers of `batch` messages.
+
+    The fields are read and written through memoryviews: going through the
+    ctypes structures costs more than the system calls saved.
+    """
+
+    def __init__(self, my_socket, batch, size):
+        self.socket = my_socket
+        self.batch = batch
+        self.size = size
+
+        self.buffers = ctypes.create_string_buffer(batch * size)
+        self.names = ctypes.create_string_buffer(batch * NAME_SIZE)
+        self.iovecs = (iovec * batch)()
+        self.messages = (mmsghdr * batch)()
+
+        buffers = ctypes.addressof(self.buffers)
+        self.names_address = ctypes.addressof(self.names)
+        for i in range(batch):
+            self.iovecs[i].iov_base = buffers + i * size
+            self.iovecs[i].iov_len = size
+            header = self.messages[i].msg_hdr
+            header.msg_iov = ctypes.pointer(self.iovecs[i])
+            header.msg_iovlen = 1
+            header.msg_name = self.names_address + i * NAME_SIZE
+            header.msg_namelen = NAME_SIZE
+
+        self.buffers_view = memoryview(self.buffers).cast('B')
+        self.names_view = memoryview(self.names).cast('B')
+        self.iovecs_view = memoryview(self.iovecs).cast('B')
+        self.messages_view = memoryview(self.messages).cast('B')
+
+        # address <-> struct sockaddr
+        self.addresses = {}
+
+
+def kernel_timestamp(level, message_type, data):
+    """ Returns the timestamp (in ns) of a `SCM_TIMESTAMPNS` control message, or `None`. """
+
+    if level != socket.SOL_SOCKET or message_type != SCM_TIMESTAMPNS:
+        return None
+
+    seconds, nanoseconds = struct.unpack_from('@ll', data)
+    return seconds * 1000000000 + nanoseconds
+
+
+class BatchReceiver(_MessageRing):
+    """ Reads all the pending datagrams of a non-blocking socket, a batch per system call.
+
+    The datagrams are read into a ring of `batch` preallocated buffers of
+    `size` bytes, then copied out as `bytes`.
+    """
+
+    def __init__(self, my_socket, batch=BATCH_SIZE, size=BUFFER_SIZE, addresses=True,
+                 timestamps=False):
+        """
+        :param my_socket: the socket to read, it must not block
+        :param batch: maximum number of datagrams read per system call
+        :param size: maximum size of a datagram, longer datagrams are truncated
+        :param addresses: also return the source address of the datagrams
+        :param timestamps: enable `SO_TIMESTAMPNS` on the socket, and also
+        return the time the datagrams were received
+        """
+
+        super(BatchReceiver, self).__init__(my_socket, batch, size)
+        self.with_addresses = addresses
+
+        self.with_timestamps = timestamps
+        if timestamps:
+            if SO_TIMESTAMPNS is not None:
+                my_socket.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+            self.controls = ctypes.create_string_buffer(batch * CONTROL_SIZE)
+            self.controls_view = memoryview(self.controls).cast('B')
+            controls = ctypes.addressof(self.controls)
+            for i in range(batch):
+                header = self.messages[i].msg_hdr
+                header.msg_control = controls + i * CONTROL_SIZE
+                header.msg_controllen = CONTROL_SIZE
+
+        # number of messages filled by the last call
+        self.used = 0
+
+    def receive(self):
+        """ Returns a list of (data, address, timestamp) of the pending datagrams (up to `batch`).
+
+        The list is empty when nothing is pending. `address` is `None` without
+        `addresses`, and `timestamp` is `None` without `timestamps`: else it is
+        the `time.monotonic_ns()` time the kernel received the datagram (or
+        the time it was read, when the kernel did not timestamp it).
+        """
+
+        if _recvmmsg is None:
+            return self._receive_one()
+
+        messages = self.messages_view
+        for i in range(self.used):
+            # the kernel set the actual size of the addresses and control messages
+            struct.pack_into('I', messages, i * MESSAGE_SIZE + NAMELEN_OFFSET, NAME_SIZE)
+            if self.with_timestamps:
+                struct.pack_into('N', messages, i * MESSAGE_SIZE + CONTROLLEN_OFFSET,
+                                 CONTROL_SIZE)
+
+        count = _recvmmsg(self.socket.fileno(), self.messages, self.batch, socket.MSG_DONTWAIT,
+                          None)
+        if count < 0:
+            self.used = 0
+            if ctypes.get_errno() in WOULD_BLOCK:
+                return []
+            _raise_errno()
+        self.used = count
+
+        buffers = self.buffers_view
+        names = self.names_view
+        cache = self.addresses
+        size = self.size
+
+        if self.with_timestamps:
+            # kernel timestamps are converted to the monotonic clock
+            now = time.monotonic_ns()
+            clock_offset = time.time_ns() - now
+
+        packets = []
+        lengths = _LENGTHS.iter_unpack(messages[:count * MESSAGE_SIZE])
+        for i, (namelen, controllen, length) in enumerate(lengths):
+            data = bytes(buffers[i * size:i * size + length])
+
+            address = None
+            if self.with_addresses:
+                name = bytes(names[i * NAME_SIZE:i * NAME_SIZE + namelen])
+                address = cache.get(name)
+                if address is None:
+                    if len(cache) >= ADDRESS_CACHE_SIZE:
+                        cache.clear()
+                    address = cache[name] = decode_address(name)
+
+            timestamp = None
+            if self.with_timestamps:
+                timestamp = now
+                if controllen >= _TIMESTAMP_MESSAGE.size:
+                    _, level, message_type, seconds, nanoseconds = \
+                        _TIMESTAMP_MESSAGE.unpack_from(self.controls_view, i * CONTROL_SIZE)
+                    if level == socket.SOL_SOCKET and message_type == SCM_TIMESTAMPNS:
+                        # never later than now, should the wall clock step back
+                        received = seconds * 1000000000 + nanoseconds - clock_offset
+                        timestamp = min(received, now)
+
+            packets.append((data, address, timestamp))
+        return packets
+
+    def _receive_one(self):
+        """ Same as `receive`, but reads a single datagram.
+
+        A gevent socket waits for a datagram if none is pending.
+        """
+
+        try:
+            data, ancillary_data, _, address = self.socket.recvmsg(self.size, CONTROL_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return []
+
+        timestamp = None
+        if self.with_timestamps:
+            now = time.monotonic_ns()
+            timestamp = now
+            for level, message_type, control in ancillary_data:
+                received = kernel_timestamp(level, message_type, control)
+                if received is not None:
+                    timestamp = min(received - (time.time_ns() - now), now)
+
+        return [(data, address if self.with_addresses else None, timestamp)]
+
+
+class BatchSender(_MessageRing):
+    """ Queues the datagrams sent on a socket, and sends them a batch per system call.
+
+    The queue is flushed by a greenlet started once the current greenlet
+    yields, or as soon as `batch` datagrams are queued, so that a datagram
+    waits for the others of a burst at most, and never for a timer.
+
+    Datagrams can also be queued as functions returning them, called when
+    the batch is sent: a timestamp in the payload then does not include the
+    time spent in the queue.
+    """
+
+    def __init__(self, my_socket, batch=BATCH_SIZE, size=BUFFER_SIZE):
+        """
+        :param my_socket: the socket to send on, it must not block
+        :param batch: maximum number of datagrams sent per system call
+        :param size: maximum size of a datagram sent in a batch, longer
+        datagrams are sent with a system call of their own
+        """
+
+        super(BatchSender, self).__init__(my_socket, batch, size)
+        self.messages_address = ctypes.addressof(self.messages)
+
+        # (datagram size, address size) written in the headers of each message
+        self.slots = [None] * batch
+
+        # (data, address, on_error) of the datagrams waiting to be sent
+        self.queue = []
+        self.scheduled = False
+
+        # the buffers are shared: one batch at a time
+        self.lock = Semaphore()
+
+    def send(self, data, address=None, on_error=None):
+        """ Queue `data` for `address` (`None` for a connected or bound socket).
+
+        `data` is either bytes, or a function returning them. `on_error` is
+        called with the `OSError` raised if `data` cannot be sent (the error
+        is raised by `flush` without `on_error`).
+        """
+
+        self.queue.append((data, address, on_error))
+        if len(self.queue) >= self.batch:
+            self.flush()
+        elif not self.scheduled:
+            self.scheduled = True
+            gevent.spawn(self.flush)
+
+    def flush(self):
+        """ Send all the queued datagrams. """
+
+        self.scheduled = False
+        while self.queue:
+            queue = self.queue[:self.batch]
+            del self.queue[:self.batch]
+            with self.lock:
+                self._send_batch(queue)
+
+    def _send_batch(self, queue):
+        """ Send up to `batch` datagrams, and report the datagrams that failed. """
+
+        if _sendmmsg is None:
+            for data, address, on_error in queue:
+                self._send_one(data() if callable(data) else data, address, on_error)
+            return
+
+        buffers = self.buffers_view
+        names = self.names_view
+        iovecs = self.iovecs_view
+        messages = self.messages_view
+        iovec_size = ctypes.sizeof(iovec)
+        cache = self.addresses
+        size = self.size
+
+        slots = self.slots
+        # `on_error` of the datagrams copied in the ring
+        batched = []
+        for data, address, on_error in queue:
+            if callable(data):
+                data = data()
+            if len(data) > size:
+                self._send_one(data, address, on_error)
+                continue
+
+            i = len(batched)
+            batched.append(on_error)
+            buffers[i * size:i * size + len(data)] = data
+
+            # bursts are mostly of datagrams of the same size, sent to the
+            # same kind of address: only write the lengths that changed
+            name = None
+            if address is not None:
+                name = cache.get(address)
+                if name is None:
+                    if len(cache) >= ADDRESS_CACHE_SIZE:
+                        cache.clear()
+                    name = cache[address] = encode_address(address, self.socket.family)
+                names[i * NAME_SIZE:i * NAME_SIZE + len(name)] = name
+
+            namelen = 0 if name is None else len(name)
+            if slots[i] != (len(data), namelen):
+                slots[i] = (len(data), namelen)
+                struct.pack_into('N', iovecs, i * iovec_size + IOV_LEN_OFFSET, len(data))
+                struct.pack_into('P', messages, i * MESSAGE_SIZE + NAME_OFFSET,
+                                 0 if name is None else self.names_address + i * NAME_SIZE)
+                struct.pack_into('I', messages, i * MESSAGE_SIZE + NAMELEN_OFFSET, namelen)
+
+        fd = self.socket.fileno()
+        sent = 0
+        while sent < len(batched):
+            first = ctypes.cast(self.messages_address + sent * MESSAGE_SIZE,
+                                ctypes.POINTER(mmsghdr))
+            count = _sendmmsg(fd, first, len(batched) - sent, socket.MSG_DONTWAIT)
+            if count >= 0:
+                sent = sent + count
+                continue
+
+            error = ctypes.get_errno()
+            if error in WOULD_BLOCK:
+                wait_write(fd)
+                continue
+
+            # the datagram that failed is the first one not sent
+            self._fail(batched[sent], OSError(error, os.strerror(error)))
+            sent = sent + 1
+
+    def _send_one(self, data, address, on_error):
+        """ Send a single datagram, with a system call of its own. """
+
+        try:
+            if address is None:
+                self.socket.send(data)
+            else:
+                self.socket.sendto(data, address)
+        except OSError as e:
+            self._fail(on_error, e)
+
+    def _fail(self, on_error, exception):
+        if on_error is None:
+            raise exception
+        on_error(exception)
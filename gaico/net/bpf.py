@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+
+import ctypes
+import struct
+from gevent import socket
+
+"""
+    Classic BPF socket filters, so that the kernel drops the packets we are
+    not interested in before they reach Python.
+"""
+
+# from linux/filter.h
+SO_ATTACH_FILTER = 26
+SO_DETACH_FILTER = 27
+
+# from linux/if_packet.h (struct tpacket_stats: packets received, including
+# the dropped ones, and packets dropped)
+SOL_PACKET = 263
+PACKET_STATISTICS = 6
+
+# instruction classes
+BPF_LD = 0x00
+BPF_LDX = 0x01
+BPF_ALU = 0x04
+BPF_JMP = 0x05
+BPF_RET = 0x06
+BPF_MISC = 0x07
+
+# sizes
+BPF_W = 0x00
+BPF_H = 0x08
+BPF_B = 0x10
+
+# addressing modes
+BPF_IMM = 0x00
+BPF_ABS = 0x20
+BPF_IND = 0x40
+BPF_MSH = 0xa0
+
+# jumps
+BPF_JA = 0x00
+BPF_JEQ = 0x10
+BPF_JGT = 0x20
+BPF_JGE = 0x30
+BPF_JSET = 0x40
+
+# sources
+BPF_K = 0x00
+BPF_X = 0x08
+
+# misc operations
+BPF_TAX = 0x00
+
+# accept the whole packet, or drop it
+ACCEPT = 0x40000
+DROP = 0
+
+
+def stmt(code, k):
+    """ Returns a BPF statement. """
+
+    return (code, 0, 0, k)
+
+
+def jump(code, k, jt, jf):
+    """ Returns a BPF jump: `jt` or `jf` instructions are skipped if the test is true or false. """
+
+    return (code, jt, jf, k)
+
+
+def attach_filter(my_socket, program):
+    """ Attach the BPF `program` (a list of instructions) to `my_socket`. """
+
+    # struct sock_filter { __u16 code; __u8 jt; __u8 jf; __u32 k; }
+    instructions = b''.join(struct.pack('HBBI', *instruction) for instruction in program)
+    buffer = ctypes.create_string_buffer(instructions, len(instructions))
+
+    # struct sock_fprog { unsigned short len; struct sock_filter *filter; }
+    fprog = struct.pack('HL', len(program), ctypes.addressof(buffer))
+    my_socket.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
+
+
+def detach_filter(my_socket):
+    """ Remove the BPF program attached to `my_socket`. """
+
+    my_socket.setsockopt(socket.SOL_SOCKET, SO_DETACH_FILTER, 0)
+
+
+def arp_reply_filter(mac_address=None, gratuitous=False):
+    """ Returns a program accepting only the ARP replies of an Ethernet packet socket.
+
+    With `mac_address` (6 bytes), only the replies sent to this address are
+    accepted. With `gratuitous`, gratuitous ARP packets (requests or replies
+    with the same sender and target IP addresses) are also accepted, whoever
+    they are sent to.
+    """
+
+    # (load, value) pairs, the packet is dropped as soon as a value differs
+    checks = [
+        # Ethernet type
+        (stmt(BPF_LD | BPF_H | BPF_ABS, 12), 0x0806),
+        # ARP operation
+        (stmt(BPF_LD | BPF_H | BPF_ABS, 20), 2),
+    ]
+    if mac_address is not None:
+        # target hardware address
+        high, low = struct.unpack('!IH', mac_address)
+        checks.append((stmt(BPF_LD | BPF_W | BPF_ABS, 32), high))
+        checks.append((stmt(BPF_LD | BPF_H | BPF_ABS, 36), low))
+
+    # the checks are followed by the accept, then by the gratuitous test
+    accept = 2 * len(checks)
+    drop = accept + 1
+    if gratuitous:
+        drop = accept + 6
+
+    program = []
+    for i, (load, value) in enumerate(checks):
+        # past the Ethernet type, a failed check may still be a gratuitous packet
+        failed = accept + 1 if i > 0 else drop
+        program.append(load)
+        program.append(jump(BPF_JMP | BPF_JEQ | BPF_K, value, 0, failed - 2 * i - 2))
+    program.append(stmt(BPF_RET | BPF_K, ACCEPT))
+    if gratuitous:
+        program.extend([
+            # sender IP address == target IP address
+            stmt(BPF_LD | BPF_W | BPF_ABS, 28),
+            stmt(BPF_MISC | BPF_TAX, 0),
+            stmt(BPF_LD | BPF_W | BPF_ABS, 38),
+            jump(BPF_JMP | BPF_JEQ | BPF_X, 0, 0, 1),
+            stmt(BPF_RET | BPF_K, ACCEPT),
+        ])
+    program.append(stmt(BPF_RET | BPF_K, DROP))
+
+    return program
+
+
+def icmp_reply_filter(message_type, identifiers, ip_header=True):
+    """ Returns a program accepting only the ICMP messages of type `message_type`
+    with an identifier in `identifiers` (a range), for a raw ICMP socket.
+
+    IPv4 raw sockets receive the IP header, set `ip_header` to `False` for IPv6.
+    """
+
+    if ip_header:
+        # X = length of the IP header
+        load_offset = stmt(BPF_LDX | BPF_B | BPF_MSH, 0)
+    else:
+        load_offset = stmt(BPF_LDX | BPF_W | BPF_IMM, 0)
+
+    return [
+        load_offset,
+        # ICMP type
+        stmt(BPF_LD | BPF_B | BPF_IND, 0),
+        jump(BPF_JMP | BPF_JEQ | BPF_K, message_type, 0, 4),
+        # identifier
+        stmt(BPF_LD | BPF_H | BPF_IND, 4),
+        jump(BPF_JMP | BPF_JGE | BPF_K, identifiers[0], 0, 2),
+        jump(BPF_JMP | BPF_JGT | BPF_K, identifiers[-1], 1, 0),
+        stmt(BPF_RET | BPF_K, ACCEPT),
+        stmt(BPF_RET | BPF_K, DROP),
+    ]
+
+
+def icmp_error_filter(message_type, error_types, identifiers, ip_header=True):
+    """ Returns a program accepting the ICMP messages accepted by
+    `icmp_reply_filter`, and the ICMP error messages of type `error_types`
+    (two types: time exceeded and destination unreachable), for a raw ICMP socket.
+    """
+
+    reply_filter = icmp_reply_filter(message_type, identifiers, ip_header)
+    first_error, second_error = error_types
+
+    return reply_filter[:2] + [
+        # errors quote a packet of any sender: they are sorted out in Python
+        jump(BPF_JMP | BPF_JEQ | BPF_K, first_error, 5, 0),
+        jump(BPF_JMP | BPF_JEQ | BPF_K, second_error, 4, 0),
+    ] + reply_filter[2:]
+
+
+def icmp_messages(ipv6=False):
+    """ Returns the number of ICMP messages received by the host, or `None` if
+    the kernel counters are not available.
+    """
+
+    path, name = '/proc/net/snmp', 'Icmp:'
+    if ipv6:
+        path, name = '/proc/net/snmp6', 'Icmp6InMsgs'
+
+    try:
+        with open(path) as counters:
+            lines = [line.split() for line in counters if line.startswith(name)]
+    except OSError:
+        return None
+
+    if ipv6:
+        return int(lines[0][1])
+    # a line with the names of the counters, then a line with the values
+    return int(lines[1][lines[0].index('InMsgs')])
+
+
+class PacketCounter(object):
+    """ Counts the frames of `protocol` seen on `interface`, i.e. the frames a
+    packet socket bound to them receives without a filter.
+
+    An unfiltered shadow socket, never read, is bound to the same interface
+    and protocol: its receive buffer is full after a few frames, and the
+    kernel then drops (and counts) the other ones without copying them.
+    """
+
+    def __init__(self, interface, protocol):
+        self.socket = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, 0)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 0)
+        self.socket.bind((interface, protocol))
+        self.total = 0
+
+    def __call__(self):
+        """ Returns the number of frames seen since the counter was created. """
+
+        # the kernel resets its counters when they are read
+        packets, _ = struct.unpack('II', self.socket.getsockopt(SOL_PACKET, PACKET_STATISTICS,
+                                                                 8))
+        self.total = self.total + packets
+        return self.total
+
+    def close(self):
+        """ Close the shadow socket. """
+
+        self.socket.close()
+
+
+class FilterCounter(object):
+    """ Counts the packets a socket filter kept from Python.
+
+    The kernel does not count the packets dropped by a socket filter: they
+    are estimated as the packets the socket would have received without a
+    filter (from the kernel counters returned by `total`), minus the packets
+    actually received.
+    """
+
+    def __init__(self, total):
+        """
+        :param total: function returning the packets the socket would have
+        received without a filter since boot, or `None`
+        """
+
+        self.total = total
+        self.baseline = total()
+        self.received = 0
+
+    def collect(self):
+        """ Returns the packets filtered since the last call. """
+
+        if self.baseline is None:
+            return 0
+
+        total = self.total()
+        filtered = max(0, total - self.baseline - self.received)
+        self.baseline = total
+        self.received = 0
+        return filtered
@@ -1,21 +1,77 @@
 # -*- coding: utf-8 -*-
 
-import gevent
+import itertools
+import os
+import resource
+import time
 from gevent import socket
-from gaico.net import getaddrinfo
+from gevent.lock import BoundedSemaphore
+from gevent.pool import Pool
+from gaico.net import getaddrinfo, metrics
+from gaico.net.probes import run_probes
+from gaico.net.socket import (ADDRESSES_ALL, ADDRESSES_FIRST, ADDRESSES_RACE, CHUNK_SIZE,
+                              default_resolver, race, sort_addresses)
+from gaico.net.scan import METHOD_CONNECT, get_scanner
+from gaico.net.shard import run_shards, split
+from gaico.net.targets import expand_host, expand_ports
+from gaico.net.timeouts import get_adaptive
 
 
-def _check_port_state(addr_info, port, timeout):
-    """ Check the state of a single `port` on `host`. """
+# file descriptors left for the rest of the process by `fd_budget='auto'`
+FD_RESERVE = 64
+
+
+def _connect(s, address, timeout, adaptive):
+    """ Connect `s` to `address`, timing out as soon as the round trip times
+    observed allow it (see `gaico.net.timeouts`).
+
+    An accepted or a refused connection is a round trip of the host.
+    """
+
+    host = address[0]
+    started = time.monotonic()
+    while True:
+        step = adaptive.check_after(host, time.monotonic() - started, timeout)
+        if step <= 0:
+            raise socket.timeout('timed out')
+
+        # the connect goes on in the kernel between two attempts
+        s.settimeout(step)
+        try:
+            s.connect(address)
+        except socket.timeout:
+            continue
+        except ConnectionRefusedError:
+            adaptive.add(host, time.monotonic() - started)
+            raise
+        adaptive.add(host, time.monotonic() - started)
+        return
+
+
+def _check_port_state(addr_info, port, timeout, adaptive=None, probes=None):
+    """ Check the state of a single `port` on `host`.
+
+    With `probes`, returns the state of the port and the results of the
+    probes run on the connection (`None` if the port is not open).
+    """
 
     s = socket.socket(addr_info[0], socket.SOCK_STREAM)
     s.settimeout(timeout)
+    if metrics.enabled:
+        metrics.count('tcp.socket_opens')
 
     host = addr_info[4][0]
 
     try:
-        s.connect((host, port))
+        if adaptive is None:
+            s.connect((host, port))
+        else:
+            _connect(s, (host, port), timeout, adaptive)
+        if probes is not None:
+            return True, run_probes(s, probes)
     except Exception as e:
+        if probes is not None:
+            return e, None
         return e
     finally:
         s.close()
@@ -23,46 +79,251 @@ def _check_port_state(addr_info, port, timeout):
     return True
 
 
-def check_ports_state(hosts_ports, timeout=10):
+def _race_port_state(addresses_info, port, timeout, adaptive=None, probes=None):
+    """ Check `port` on each address in turn until one answers (happy eyeballs).
+
+    An open port or a refused connection are both answers from the host.
+    Returns the address info that answered (the first one if none did) and
+    the state of the port (and the results of the `probes`, see
+    `_check_port_state`).
+    """
+
+    def attempt(addr_info):
+        value = _check_port_state(addr_info, port, timeout, adaptive, probes)
+        state = value if probes is None else value[0]
+        return state is True or isinstance(state, ConnectionRefusedError), value
+
+    return race(addresses_info, attempt)
+
+
+def available_fds(reserve=FD_RESERVE):
+    """ Returns how many file descriptors can still be opened, minus `reserve`. """
+
+    soft_limit, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft_limit == resource.RLIM_INFINITY:
+        soft_limit = 65536
+
+    try:
+        opened = len(os.listdir('/proc/self/fd'))
+    except OSError:
+        opened = 0
+
+    return max(1, soft_limit - opened - reserve)
+
+
+def _interleave(hosts_ports):
+    """ Yields (host, port) pairs, one port per host at a time. """
+
+    iterators = [(host, iter(ports)) for host, ports in hosts_ports]
+    while iterators:
+        remaining = []
+        for host, ports in iterators:
+            for port in ports:
+                yield host, port
+                remaining.append((host, ports))
+                break
+        iterators = remaining
+
+
+def _expand_hosts_ports(hosts_ports):
+    """ Yields (host, ports) for each host of the CIDR blocks and ranges of `hosts_ports`. """
+
+    for hosts, ports in hosts_ports.items():
+        # the ports of a block are expanded once for all its hosts
+        ports = list(expand_ports(ports))
+        for host in expand_host(hosts):
+            yield host, ports
+
+
+def _check_ports_greenlets(targets, pairs, timeout, concurrency, per_host, adaptive=None,
+                           probes=None):
+    """ Check each port with a blocking connect in its own greenlet.
+
+    `pairs` yields (host, port) tuples, and `targets` is a dictionary with the
+    address info of each host (filled as `pairs` is consumed).
+    Returns a dictionary with (host, port) as keys and the port states as
+    values (with `probes`, the port states and the results of the probes).
+    """
+
+    host_semaphores = {}
+    results = {}
+
+    def worker(host, addr_info, port, semaphore):
+        # the results are stored here, so that the pool does not keep the greenlets
+        if semaphore is None:
+            results[host, port] = _check_port_state(addr_info, port, timeout, adaptive, probes)
+            return
+        with semaphore:
+            results[host, port] = _check_port_state(addr_info, port, timeout, adaptive, probes)
+
+    # spawn blocks while the pool is full, ports are interleaved to spread
+    # the checks over all the hosts
+    pool = Pool(concurrency)
+    for host, port in pairs:
+        semaphore = None
+        if per_host is not None:
+            semaphore = host_semaphores.get(host)
+            if semaphore is None:
+                semaphore = host_semaphores[host] = BoundedSemaphore(per_host)
+        pool.spawn(worker, host, targets[host], port, semaphore)
+    pool.join()
+
+    return results
+
+
+def check_ports_state(hosts_ports, timeout=10, concurrency=None, per_host=None, fd_budget=None,
+                      method=METHOD_CONNECT, resolver=default_resolver,
+                      addresses=ADDRESSES_FIRST, processes=None, adaptive=None, probes=None):
     """ Check if the given `ports` are open on all `hosts`.
 
-    :param hosts_ports: dictionay with hosts (ip address or hostname) as key,
-    and a list of ports as value
+    :param hosts_ports: dictionay with hosts (ip address, hostname, CIDR block
+    or range, see `gaico.net.targets`) as key, and a list of ports (or port
+    ranges such as `1-1024`) as value
     :param timeout: timeout in second to wait for a reply (default: 10)
+    :param concurrency: maximum number of ports checked at the same time (default: no limit)
+    :param per_host: maximum number of ports checked at the same time on a
+    single host (default: no limit)
+    :param fd_budget: maximum number of sockets opened at the same time, or
+    `auto` to use the file descriptors left by the RLIMIT_NOFILE limit (default: no limit)
+    :param method: `connect` to check each port with a connect in its own
+    greenlet, `poll` to issue non-blocking connects completed by a single poll
+    loop, or `syn` to send half-open SYN probes from a raw socket (IPv4 only,
+    requires root) (default: connect)
+    :param resolver: `gaico.net.socket.Resolver` used to resolve the hosts, or
+    `None` to bypass the cache (default: the shared resolver cache)
+    :param addresses: which resolved addresses of a host are checked: `first`,
+    `all` (concurrently), or `race` (happy eyeballs: the first port is tried on
+    each address in turn every 250ms, and the address that answers first is
+    used for the other ports) (default: first)
+    :param processes: split the hosts between this number of processes, see
+    `gaico.net.shard`; `concurrency` and `fd_budget` are then shared, and each
+    process resolves its hosts with its own cache (default: a single process)
+    :param adaptive: `True`, or a `gaico.net.timeouts.AdaptiveTimeout` shared
+    by several calls, to time each check out as soon as the round trip times
+    observed for the host (or its subnet) allow it, `timeout` being an upper
+    bound; with `processes`, each process has its own estimates (default: a
+    fixed timeout)
+    :param probes: list of service probes (see `gaico.net.probes`) run in
+    turn on the connection of each open port, before it is closed; only with
+    the `connect` method (default: no probes)
 
     Returns a dictionary for each host with the following fields:
         `host`: *string*; the IP address used
         port number 1: `True`, if the port is open, or an Exception
         port number 2: `True`, if the port is open, or an Exception
         ...
+        `services`: *dict*; only with `probes`, a dictionary for each open
+        port with the names of the probes as keys, and their results (or an
+        Exception) as values
+
+    With `addresses` set to `all`, the value of a host is a dictionary with
+    the IP addresses as keys, and the dictionary above for each address.
+
+    CIDR blocks and ranges are expanded lazily, and hosts are resolved a chunk
+    at a time, as the checks are started.
     """
 
-    addresses_info = getaddrinfo(hosts_ports.keys(), None)
+    if addresses not in (ADDRESSES_FIRST, ADDRESSES_ALL, ADDRESSES_RACE):
+        raise ValueError("Unknown addresses mode: {}".format(addresses))
+    if probes is not None and method != METHOD_CONNECT:
+        raise ValueError("Service probes need the connect method.")
+
+    if processes is not None and processes > 1:
+        # a host of several blocks is checked once, with the ports of its last block
+        hosts_ports = list(dict(_expand_hosts_ports(hosts_ports)).items())
+        parts = [dict(part) for part in split(hosts_ports, processes) if part]
+        kwargs = dict(timeout=timeout, per_host=per_host, method=method, addresses=addresses,
+                      adaptive=bool(adaptive), probes=probes)
+        if concurrency is not None:
+            kwargs['concurrency'] = max(1, concurrency // len(parts))
+        if fd_budget == 'auto':
+            # each process has its own RLIMIT_NOFILE limit
+            kwargs['fd_budget'] = fd_budget
+        elif fd_budget is not None:
+            kwargs['fd_budget'] = max(1, fd_budget // len(parts))
+        if resolver is None:
+            kwargs['resolver'] = None
+
+        results = {}
+        for shard_results in run_shards(check_ports_state, parts, kwargs):
+            results.update(shard_results)
+        return results
+
+    adaptive = get_adaptive(adaptive)
 
-    jobs = []
+    if fd_budget == 'auto':
+        fd_budget = available_fds()
+    if fd_budget is not None:
+        # each check uses a single socket
+        concurrency = fd_budget if concurrency is None else min(concurrency, fd_budget)
+
+    # the ports are checked on targets: hosts, or (host, address) with `all`
+    targets = {}
+    states = {}
     failures = {}
-    for host, ports in hosts_ports.items():
-        addr_info = addresses_info[host]
-        if isinstance(addr_info, Exception):
-            failures[host] = addr_info
-            continue
-        for port in ports:
-            job = gevent.spawn(_check_port_state, addr_info[0], port, timeout)
-            job.host = host
-            job.port = port
-            job.resolved_host = addr_info[0][4][0]
-            jobs.append(job)
-    gevent.joinall(jobs)
+
+    def resolve():
+        """ Yields the (target, port) pairs to check, a chunk of hosts at a time. """
+
+        expanded = _expand_hosts_ports(hosts_ports)
+        while True:
+            chunk = list(itertools.islice(expanded, CHUNK_SIZE))
+            if not chunk:
+                return
+
+            addresses_info = getaddrinfo([host for host, ports in chunk], None,
+                                         resolver=resolver)
+            resolved = []
+            races = []
+            for host, ports in chunk:
+                addr_info = addresses_info[host]
+                if isinstance(addr_info, Exception):
+                    failures[host] = addr_info
+                    continue
+
+                if addresses == ADDRESSES_ALL:
+                    for address_info in sort_addresses(addr_info):
+                        key = (host, address_info[4][0])
+                        targets[key] = address_info
+                        resolved.append((key, ports))
+                elif addresses == ADDRESSES_RACE and ports:
+                    races.append((host, sort_addresses(addr_info), ports))
+                else:
+                    targets[host] = addr_info[0]
+                    resolved.append((host, ports))
+
+            if races:
+                # the first port of each host chooses the address used for the others
+                pool = Pool(concurrency)
+                jobs = [(host, ports, pool.spawn(_race_port_state, host_addresses, ports[0],
+                                                 timeout, adaptive, probes))
+                        for host, host_addresses, ports in races]
+                pool.join()
+                for host, ports, job in jobs:
+                    targets[host], states[(host, ports[0])] = job.value
+                    resolved.append((host, ports[1:]))
+
+            yield from _interleave(resolved)
+
+    if method == METHOD_CONNECT:
+        states.update(_check_ports_greenlets(targets, resolve(), timeout, concurrency, per_host,
+                                             adaptive, probes))
+    else:
+        scanner = get_scanner(method, timeout, concurrency, per_host, adaptive)
+        states.update(scanner.scan((key, targets[key], port) for key, port in resolve()))
 
     results = {}
-    for job in jobs:
-        host = job.host
-        port = job.port
-
-        res = results.get(host, {})
-        res[port] = job.value
-        res['host'] = job.resolved_host
-        results[host] = res
+    for (key, port), state in states.items():
+        address = targets[key][4][0]
+        if addresses == ADDRESSES_ALL:
+            res = results.setdefault(key[0], {}).setdefault(address, {'host': address})
+        else:
+            res = results.setdefault(key, {'host': address})
+        if probes is not None:
+            state, port_services = state
+            if port_services is not None:
+                res.setdefault('services', {})[port] = port_services
+        res[port] = state
 
     results.update(failures)
 
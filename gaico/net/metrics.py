@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+import time
+from contextlib import contextmanager
+
+"""
+    Opt-in counters and timers of the `gaico.net` hot paths.
+
+    Instrumentation is disabled by default, and every instrumented place
+    only checks `metrics.enabled` then, so it costs a single attribute
+    lookup. Once enabled:
+
+        from gaico.net import metrics
+        metrics.enable()
+        ping(hosts)
+        print(metrics.snapshot())
+
+    Counters:
+        `icmp.socket_opens`, `icmp.sent`, `icmp.received`, `icmp.discarded`
+        (replies that no one waits for, or foreign ICMP traffic),
+        `icmp.timeouts`, `icmp.filtered` (ICMP messages of the host dropped
+        by the socket filter of raw sockets, before they reach Python),
+        `icmp.wakeups` (reader wakeups, each one reads all the pending replies),
+        `arp.socket_opens`, `arp.sent`, `arp.received`, `arp.discarded`,
+        `arp.timeouts`, `arp.wakeups`, `arp.filtered` (ARP frames of the interface that never
+        reached Python thanks to the socket filter), `arp.cache_hits`,
+        `arp.cache_misses`, `arp.learned` (replies and gratuitous packets
+        added to a `NeighborCache`), `tcp.socket_opens`
+        (connects of `check_ports_state`), `tcp.probes` (service probes run
+        on these connections), `scan.wakeups` (poll or SYN
+        scanner wakeups),
+        `scheduler.wakeups` (timer wheel ticks of a `SendScheduler`),
+        `resolver.hits`, `resolver.misses`
+
+    Timers (in seconds):
+        `resolver.lookup` (queries to the system resolver),
+        `scheduler.lag` (delay between the time a packet should have been
+        sent and the time its greenlet was woken up: greenlet scheduling, and
+        the wait for a send token with a rate limit)
+"""
+
+enabled = False
+
+counters = {}
+timers = {}
+hooks = []
+
+
+def enable():
+    """ Start collecting metrics. """
+
+    global enabled
+    enabled = True
+
+
+def disable():
+    """ Stop collecting metrics, the collected values are kept. """
+
+    global enabled
+    enabled = False
+
+
+def reset():
+    """ Forget all the collected values. """
+
+    counters.clear()
+    timers.clear()
+
+
+def count(name, value=1):
+    """ Add `value` to the counter `name`. """
+
+    counters[name] = counters.get(name, 0) + value
+    for hook in hooks:
+        hook(name, value)
+
+
+def record(name, duration):
+    """ Record a `duration` (in seconds) for the timer `name`. """
+
+    timer = timers.get(name)
+    if timer is None:
+        timer = timers[name] = [0, 0.0, 0.0]
+    timer[0] = timer[0] + 1
+    timer[1] = timer[1] + duration
+    if duration > timer[2]:
+        timer[2] = duration
+    for hook in hooks:
+        hook(name, duration)
+
+
+@contextmanager
+def timed(name):
+    """ Context manager recording the duration of its block for the timer `name`. """
+
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - started)
+
+
+def add_hook(hook):
+    """ Call `hook` with the name and the value of each counter increment and
+    each timer duration.
+    """
+
+    hooks.append(hook)
+
+
+def remove_hook(hook):
+    """ Stop calling `hook`. """
+
+    hooks.remove(hook)
+
+
+def merge(values):
+    """ Add the values of a `snapshot` (of another process for instance) to the collected ones. """
+
+    for name, value in values['counters'].items():
+        count(name, value)
+
+    for name, other in values['timers'].items():
+        timer = timers.get(name)
+        if timer is None:
+            timer = timers[name] = [0, 0.0, 0.0]
+        timer[0] = timer[0] + other['count']
+        timer[1] = timer[1] + other['total']
+        timer[2] = max(timer[2], other['max'])
+
+
+def snapshot():
+    """ Returns the collected values: counters, and the count, total and maximum of timers. """
+
+    return {
+        'counters': dict(counters),
+        'timers': dict((name, {'count': timer[0], 'total': timer[1], 'max': timer[2]})
+                       for name, timer in timers.items()),
+    }
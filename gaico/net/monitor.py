@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+
+import gevent
+import itertools
+import random
+import time
+from gevent import socket
+from gevent.pool import Group
+from gaico.net.ping import TRANSPORT_AUTO, do_one_ping, pick_identifier
+from gaico.net.scheduler import SendScheduler
+from gaico.net.socket import default_resolver
+from gaico.net.stats import RollingStatistics
+
+"""
+    Continuous monitoring of a changing set of hosts.
+"""
+
+
+class _Target(object):
+    """ A monitored host, and the state kept between its round trips. """
+
+    __slots__ = ('host', 'addr_info', 'identifier', 'sequence', 'statistics', 'error')
+
+    def __init__(self, host, identifier, window):
+        self.host = host
+        self.addr_info = None
+        self.identifier = identifier
+        self.sequence = 0
+        self.statistics = RollingStatistics(window)
+        self.error = None
+
+
+class PingMonitor(object):
+    """ Pings a set of hosts every `interval` seconds, until stopped.
+
+    Hosts can be added and removed while the monitor is running. Each host
+    keeps its ICMP identifier and its sequence counter, the ICMP sockets are
+    shared by all the hosts, and the statistics cover the last `window` round
+    trips only, so a monitor can run forever in constant memory per host.
+
+        monitor = PingMonitor(['example.com'], interval=5)
+        monitor.start()
+        monitor.add('example.org')
+        ...
+        print(monitor.results())
+        monitor.stop()
+    """
+
+    def __init__(self, hosts=(), interval=1, timeout=1, packet_size=64, window=100,
+                 transport=TRANSPORT_AUTO, rate=None, jitter=None, resolver=default_resolver,
+                 on_probe=None):
+        """
+        :param hosts: hosts to ping (ip addresses or hostnames)
+        :param interval: wait interval seconds between two packets sent to a host (default: 1)
+        :param timeout: timeout in second for a single ping round trip (default: 1)
+        :param packet_size: the number of bytes to send (default: 64)
+        :param window: number of round trips used to compute the statistics of a
+        host (default: 100)
+        :param transport: `dgram`, `raw` or `auto`, see `ping` (default: auto)
+        :param rate: maximum number of packets per second sent to all the hosts
+        (default: no limit)
+        :param jitter: the first packet of each host is sent after a random delay
+        of up to `jitter` seconds (default: `interval`)
+        :param resolver: `gaico.net.socket.Resolver` used to resolve the hosts, or
+        `None` to bypass the cache (default: the shared resolver cache)
+        :param on_probe: called with the host, the sequence and the delay (or
+        `None` on timeout) of each round trip (default: None)
+        """
+
+        self.interval = interval
+        self.timeout = timeout
+        self.packet_size = packet_size
+        self.window = window
+        self.transport = transport
+        self.resolver = resolver
+        self.on_probe = on_probe
+
+        if jitter is None:
+            jitter = interval
+        self.scheduler = SendScheduler(rate, jitter)
+
+        # consecutive identifiers, so that two hosts only share one when
+        # there are more hosts than identifiers
+        self.identifiers = itertools.count(random.randint(0, 0xFFFF))
+
+        self.targets = {}
+        self.workers = {}
+        self.jobs = Group()
+        self.running = False
+
+        for host in hosts:
+            self.add(host)
+
+    @property
+    def hosts(self):
+        """ The monitored hosts. """
+
+        return list(self.targets)
+
+    def add(self, host):
+        """ Start monitoring `host` (does nothing if `host` is already monitored). """
+
+        if host in self.targets:
+            return
+
+        self.targets[host] = _Target(host, pick_identifier(next(self.identifiers)), self.window)
+        if self.running:
+            self._spawn(host)
+
+    def remove(self, host):
+        """ Stop monitoring `host`, and forget its statistics. """
+
+        self.targets.pop(host, None)
+        worker = self.workers.pop(host, None)
+        if worker is not None:
+            worker.kill(block=False)
+
+    def start(self):
+        """ Start pinging the hosts in background greenlets. """
+
+        if self.running:
+            return
+
+        self.running = True
+        for host in self.targets:
+            self._spawn(host)
+
+    def stop(self):
+        """ Stop pinging the hosts. The statistics are kept. """
+
+        self.running = False
+        self.workers.clear()
+        self.jobs.kill()
+        self.scheduler.close()
+
+    def result(self, host):
+        """ Returns the statistics of `host`: a dictionary like the ones returned by
+        `ping` (for the last `window` round trips) with an additional `jitter`
+        field, or the Exception raised when resolving or pinging `host`.
+        """
+
+        target = self.targets[host]
+        if target.error is not None:
+            return target.error
+        if target.addr_info is None:
+            return target.statistics.result(None)
+        return target.statistics.result(target.addr_info[4][0])
+
+    def results(self):
+        """ Returns the statistics of all the hosts (see `result`). """
+
+        return dict((host, self.result(host)) for host in self.targets)
+
+    def _spawn(self, host):
+        self.workers[host] = self.jobs.spawn(self._worker, self.targets[host])
+
+    def _resolve(self, target):
+        """ Resolve `target`, retrying every `interval` seconds until it succeeds. """
+
+        while target.addr_info is None:
+            try:
+                if self.resolver is None:
+                    addr_info = socket.getaddrinfo(target.host, None)
+                else:
+                    addr_info = self.resolver.getaddrinfo(target.host, None)
+            except Exception as e:
+                target.error = e
+                gevent.sleep(self.interval)
+            else:
+                target.addr_info = addr_info[0]
+                target.error = None
+
+    def _worker(self, target):
+        """ Ping `target` every `interval` seconds, forever. """
+
+        self._resolve(target)
+
+        next_ping = self.scheduler.start_time()
+        while True:
+            self.scheduler.wait(next_ping)
+            next_ping = time.monotonic() + self.interval
+
+            sequence = target.sequence
+            target.sequence = (sequence + 1) & 0xFFFF
+
+            try:
+                delay = do_one_ping(target.addr_info, target.identifier, sequence, self.timeout,
+                                    self.packet_size, self.transport)
+            except PermissionError as e:
+                # neither ping sockets nor raw sockets are allowed
+                target.error = e
+                return
+            except OSError:
+                # unreachable network, ... the request is lost
+                delay = None
+            target.statistics.add(delay)
+
+            if self.on_probe is not None:
+                self.on_probe(target.host, sequence, delay)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
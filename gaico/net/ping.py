@@ -1,14 +1,64 @@
 # -*- coding: utf-8 -*-
 
+import functools
 import gevent
+import math
+import random
 import struct
 import time
-from gevent import select, sleep, socket
-from gaico.net import getaddrinfo
+from collections import namedtuple
+from gevent import socket
+from gevent.event import AsyncResult
+from gevent.socket import wait_read
+from gevent.pool import Pool
+from gevent.queue import Queue
+from gaico.net import metrics
+from gaico.net.batch import BatchReceiver, BatchSender
+from gaico.net.bpf import FilterCounter, attach_filter, icmp_messages, icmp_reply_filter
+from gaico.net.results import PingResults
+from gaico.net.socket import (ADDRESSES_ALL, ADDRESSES_FIRST, ADDRESSES_RACE, default_resolver,
+                              getaddrinfo_iter, race, sort_addresses)
+from gaico.net.stats import LatencyHistogram, update_jitter
+from gaico.net.scheduler import SendScheduler
+from gaico.net.shard import run_shards, split
+from gaico.net.targets import expand_hosts
+from gaico.net.timeouts import get_adaptive, wait as wait_reply
 
 
 ICMPV4_ECHO_REQUEST = 8
 ICMPV6_ECHO_REQUEST = 128
+ICMPV4_ECHO_REPLY = 0
+ICMPV6_ECHO_REPLY = 129
+
+# payload starts with the send time (`time.monotonic_ns()`) and the identifier
+# of the request
+PAYLOAD_HEADER_FORMAT = "!QH"
+PAYLOAD_HEADER_SIZE = struct.calcsize(PAYLOAD_HEADER_FORMAT)
+
+# identifiers of the echo requests: a random window of the 16-bit space per
+# process, so that the socket filter of raw sockets also drops the replies to
+# other processes (the window is split between the processes of a sharded
+# sweep, see `gaico.net.shard`)
+IDENTIFIER_WINDOW = 1024
+_first_identifier = random.randrange(0x10000 - IDENTIFIER_WINDOW + 1)
+identifiers = range(_first_identifier, _first_identifier + IDENTIFIER_WINDOW)
+
+# how ICMP packets are sent and received: unprivileged ping sockets (dgram),
+# raw sockets (raw, requires root), or ping sockets if available, else raw (auto)
+TRANSPORT_AUTO = 'auto'
+TRANSPORT_DGRAM = 'dgram'
+TRANSPORT_RAW = 'raw'
+
+# events yielded by `ping_iter`
+EVENT_PROBE = 'probe'
+EVENT_SUMMARY = 'summary'
+EVENT_ERROR = 'error'
+
+PingEvent = namedtuple('PingEvent', ['type', 'host', 'sequence', 'delay', 'result', 'address'],
+                       defaults=[None])
+
+# receive buffer of the shared sockets, large enough to absorb reply bursts
+RECEIVE_BUFFER_SIZE = 4 * 1024 * 1024
 
 
 class PingPacket(object):
@@ -33,15 +83,17 @@ class PingPacket(object):
     def pack(self, checksum=None):
         """ Create the packet. """
 
-        if checksum is None:
-            checksum = self.checksum
-
         # header is type (8), code (8), checksum (16), id (16), sequence (16)
         header = struct.pack(
-            "!BBHHH", self.message_type, self.code, checksum, self.identifier, self.sequence
+            "!BBHHH", self.message_type, self.code, checksum or 0, self.identifier, self.sequence
         )
+        packet = header + self.payload
 
-        return header + self.payload
+        if checksum is None and not self.ipv6:
+            checksum = internet_checksum(packet)
+            packet = packet[:2] + struct.pack("!H", checksum) + packet[4:]
+
+        return packet
 
     @property
     def checksum(self):
@@ -52,24 +104,8 @@ class PingPacket(object):
             # just returns 0
             return 0
 
-        # get a dummy packet with a 0 checksum
-        packet = self.pack(checksum=0)
-
-        if len(packet) % 2 == 1:
-            # padding to have an even number of bytes
-            packet = packet + '\0'
-
-        checksum = 0
-        for count in range(0, len(packet), 2):
-            value, = struct.unpack("!H", packet[count:count+2])
-            checksum = checksum + value
-
-        checksum = (checksum >> 16) + (checksum & 0xFFFF)
-        checksum = checksum + (checksum >> 16)
-        checksum = ~checksum
-        checksum = checksum & 0xFFFF
-
-        return checksum
+        # checksum of a dummy packet with a 0 checksum
+        return internet_checksum(self.pack(checksum=0))
 
     @classmethod
     def fromdata(cls, data):
@@ -90,149 +126,676 @@ class PingPacket(object):
         return packet
 
 
-def receive_one_ping(my_socket, addr_info, identifier, sequence, timeout):
-    """ Wait for a ping reply from `host`. """
+class PacketTemplate(object):
+    """ Preallocated echo request for a given packet size and identifier.
 
-    host = addr_info[4][0]
+    Only the sequence, the timestamp and the checksum change from one request
+    to the other: they are patched in a reusable buffer, and the checksum is
+    updated from the precomputed sum of the constant words.
+    """
 
-    # is ipv6?
-    ipv6 = my_socket.family == socket.AF_INET6
+    def __init__(self, identifier, packet_size, ipv6=False, checksum=True):
+        self.identifier = identifier
+        self.packet_size = packet_size
+        self.ipv6 = ipv6
 
-    time_left = timeout
-    while True:
-        started_select = time.time()
-        what_ready = select.select([my_socket], [], [], time_left)
-        how_long_in_select = (time.time() - started_select)
-        if what_ready[0] == []:
-            # Timeout
-            return
+        # ICMPv6 and ping sockets have the kernel calculate the checksum for us
+        self.compute_checksum = checksum and not ipv6
 
-        time_received = time.time()
-        received_packet, addr = my_socket.recvfrom(1024)
+        payload = ((packet_size - 8) - PAYLOAD_HEADER_SIZE) * b"Q"
+        payload = struct.pack(PAYLOAD_HEADER_FORMAT, 0, identifier) + payload
+        packet = PingPacket(identifier, 0, payload, ipv6).pack(checksum=0)
+
+        self.buffer = bytearray(packet)
+
+        # sequence and timestamp are 0: this is the sum of the constant words
+        if len(packet) % 2 == 1:
+            packet = packet + b'\0'
+        self.partial_sum = int.from_bytes(packet, 'big') % 0xFFFF
+
+    def build(self, sequence, timestamp):
+        """ Returns the echo request with the given `sequence` and `timestamp` (in ns). """
+
+        buffer = self.buffer
+        struct.pack_into("!H", buffer, 6, sequence)
+        struct.pack_into("!Q", buffer, 8, timestamp)
+
+        checksum = 0
+        if self.compute_checksum:
+            # the timestamp is 16 bits aligned, its 4 words fold like the packet
+            total = self.partial_sum + sequence + int.from_bytes(buffer[8:16], 'big')
+            total = total % 0xFFFF or 0xFFFF
+            checksum = ~total & 0xFFFF
+        struct.pack_into("!H", buffer, 2, checksum)
 
-        if not ipv6:
-            # IP header is included only with IPv4 (remove it)
-            received_packet = received_packet[20:]
+        return bytes(buffer)
+
+
+def pick_identifier(seed):
+    """ Returns one of `identifiers`, chosen by the integer `seed`. """
+
+    return identifiers[seed % len(identifiers)]
+
+
+@functools.lru_cache(maxsize=4096)
+def get_template(identifier, packet_size, ipv6=False, checksum=True):
+    """ Returns the shared `PacketTemplate` for the given parameters. """
+
+    return PacketTemplate(identifier, packet_size, ipv6, checksum)
+
+
+def internet_checksum(data):
+    """ Compute the internet checksum (RFC 1071) of `data`.
+
+    The one's complement sum of the 16 bits words is the remainder of the
+    whole data, read as a big integer, divided by 0xFFFF (as 0x10000 is 1
+    modulo 0xFFFF), except that a non zero sum is never folded to 0.
+    """
+
+    if len(data) % 2 == 1:
+        # padding to have an even number of bytes
+        data = bytes(data) + b'\0'
+
+    value = int.from_bytes(data, 'big')
+    total = value % 0xFFFF
+    if total == 0 and value:
+        total = 0xFFFF
+
+    return ~total & 0xFFFF
+
+
+class BaseICMPEngine(object):
+    """ Long-lived ICMP socket shared by every ping of an address family.
+
+    Echo requests are sent on a single socket and the replies are dispatched
+    to the waiting pings, using the (identifier, sequence, source address) of
+    the reply. Several pings can wait for the same key (two hosts resolving to
+    the same address, or wrapped identifiers): each reply wakes up the oldest
+    of them. Subclasses implement the waiting part for a concurrency
+    framework (`ICMPEngine` for gevent, `gaico.net.aio.AsyncICMPEngine` for
+    asyncio).
+
+    The socket is either a raw socket (requires root) or, with the `dgram`
+    transport, an unprivileged Linux "ping socket": the kernel then fills in
+    the identifier and the checksum and only delivers the replies to our own
+    requests. As the kernel replaces the identifier, the original identifier
+    is also stored in the payload, right after the timestamp.
+
+    Replies are read a batch at a time (see `gaico.net.batch`). Round trip
+    times are measured on the monotonic clock, from the time the request is
+    handed to the kernel to the time the kernel received the reply
+    (`SO_TIMESTAMPNS`): the time a reply waits for a busy process to read it
+    is not included, and wall clock steps do not matter.
+
+    A raw socket receives every ICMP message of the host: a socket filter
+    drops in the kernel everything but the echo replies with one of our
+    `identifiers`, and the dropped messages are counted as `icmp.filtered`
+    (see `gaico.net.bpf.FilterCounter`).
+    """
+
+    # module providing the `socket` class used by the engine
+    socket_module = socket
+
+    def __init__(self, family, transport=TRANSPORT_AUTO):
+        self.family = family
+        self.ipv6 = family == socket.AF_INET6
+        self.socket, self.transport = self._open_socket(transport)
+        self.receiver = BatchReceiver(self.socket, timestamps=True)
+        # waiters are indexed by (identifier, sequence, IP address of the target)
+        self.waiters = {}
+
+        self.filter_counter = None
+        if self.transport == TRANSPORT_RAW:
+            self.filter_counter = FilterCounter(functools.partial(icmp_messages, self.ipv6))
+
+    def _open_socket(self, transport):
+        """ Create the socket used to send requests and receive replies. """
+
+        if transport not in (TRANSPORT_AUTO, TRANSPORT_DGRAM, TRANSPORT_RAW):
+            raise ValueError("Unknown ICMP transport: {}".format(transport))
+
+        icmp = socket.getprotobyname('icmp')
+        if self.ipv6:
+            icmp = socket.getprotobyname('ipv6-icmp')
+
+        my_socket = None
+        if transport in (TRANSPORT_AUTO, TRANSPORT_DGRAM):
+            try:
+                my_socket = self.socket_module.socket(self.family, socket.SOCK_DGRAM, icmp)
+                transport = TRANSPORT_DGRAM
+            except OSError:
+                # ping sockets are not supported, or not allowed for our group
+                # (see the net.ipv4.ping_group_range sysctl)
+                if transport == TRANSPORT_DGRAM:
+                    raise
+
+        if my_socket is None:
+            try:
+                my_socket = self.socket_module.socket(self.family, socket.SOCK_RAW, icmp)
+                transport = TRANSPORT_RAW
+            except PermissionError:
+                msg = "ICMP requests can only be sent from processes running as root."
+                raise PermissionError(msg)
+
+            reply_type = ICMPV6_ECHO_REPLY if self.ipv6 else ICMPV4_ECHO_REPLY
+            attach_filter(my_socket, icmp_reply_filter(reply_type, identifiers, not self.ipv6))
+
+        # every reply of every host goes through this socket
+        my_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER_SIZE)
+
+        if metrics.enabled:
+            metrics.count('icmp.socket_opens')
+        return my_socket, transport
+
+    def build_request(self, identifier, sequence, packet_size):
+        """ Returns an echo request, with the current timestamp in the payload. """
+
+        # ping sockets have the kernel calculate the checksum for us
+        checksum = self.transport == TRANSPORT_RAW
+        template = get_template(identifier, packet_size, self.ipv6, checksum)
+        return template.build(sequence, time.monotonic_ns())
+
+    def dispatch(self, received_packet, addr, time_received):
+        """ Parse one packet and wake up the waiter it replies to (if any).
+
+        `time_received` is the `time.monotonic_ns()` time of the reception.
+        """
+
+        if metrics.enabled:
+            metrics.count('icmp.received')
+        if self.filter_counter is not None:
+            self.filter_counter.received = self.filter_counter.received + 1
+
+        if not self.ipv6 and self.transport == TRANSPORT_RAW:
+            # IP header is included only with IPv4 raw sockets (remove it)
+            header_length = (received_packet[0] & 0x0F) * 4
+            received_packet = received_packet[header_length:]
+
+        if len(received_packet) < 8 or \
+                received_packet[0] not in (ICMPV4_ECHO_REPLY, ICMPV6_ECHO_REPLY):
+            # our own requests or unrelated ICMP traffic
+            if metrics.enabled:
+                metrics.count('icmp.discarded')
+            return
 
         # contruct a PING packet
         packet = PingPacket.fromdata(received_packet)
+        if len(packet.payload) < PAYLOAD_HEADER_SIZE:
+            if metrics.enabled:
+                metrics.count('icmp.discarded')
+            return
 
-        # is this the reply we are looking for?
-        if packet.identifier == identifier and packet.sequence == sequence and addr[0] == host:
-            # extract the timestamp from the payload
-            bytes_size = struct.calcsize("d")
-            time_sent, = struct.unpack(
-                "!d",
-                packet.payload[0:bytes_size]
-            )
-            return time_received - time_sent
-
-        time_left = time_left - how_long_in_select
-        if time_left <= 0:
-            # Timeout
+        # extract the timestamp and the identifier from the payload
+        time_sent, identifier = struct.unpack(
+            PAYLOAD_HEADER_FORMAT,
+            packet.payload[0:PAYLOAD_HEADER_SIZE]
+        )
+        if self.transport == TRANSPORT_RAW:
+            identifier = packet.identifier
+
+        # is this a reply someone is waiting for?
+        key = (identifier, packet.sequence, addr[0])
+        waiters = self.waiters.get(key)
+        if not waiters:
+            # late reply, or a reply to another process
+            if metrics.enabled:
+                metrics.count('icmp.discarded')
             return
 
+        waiter = waiters.pop(0)
+        if not waiters:
+            del self.waiters[key]
+        self.wake(waiter, (time_received - time_sent) / 1e9)
+
+    def remove_waiter(self, key, waiter):
+        """ Forget `waiter`, if its reply was not dispatched yet. """
+
+        waiters = self.waiters.get(key)
+        if waiters is not None and waiter in waiters:
+            waiters.remove(waiter)
+            if not waiters:
+                del self.waiters[key]
+
+    def wake(self, waiter, delay):
+        """ Wake up `waiter` with the `delay` of its reply. """
+
+        raise NotImplementedError()
+
+    def collect_filtered(self):
+        """ Count the messages dropped by the socket filter since the last call. """
+
+        if metrics.enabled and self.filter_counter is not None:
+            metrics.count('icmp.filtered', self.filter_counter.collect())
+
+    def close(self):
+        """ Close the socket. """
+
+        self.collect_filtered()
+        self.socket.close()
+
+
+class ICMPEngine(BaseICMPEngine):
+    """ ICMP engine for gevent: a single reader greenlet wakes up the waiting greenlets.
+
+    The requests sent during an iteration of the event loop are sent
+    together (see `gaico.net.batch.BatchSender`). The reader stops when the
+    last waiter is woken up or times out.
+    """
+
+    def __init__(self, family, transport=TRANSPORT_AUTO):
+        super(ICMPEngine, self).__init__(family, transport)
+        self.sender = BatchSender(self.socket)
+        self.reader = None
+
+    def send(self, addr_info, identifier, sequence, packet_size):
+        """ Send an echo request and return the key and the waiter of its reply. """
+
+        key = (identifier, sequence, addr_info[4][0])
+        waiter = AsyncResult()
+        self.waiters.setdefault(key, []).append(waiter)
+
+        if self.reader is None or self.reader.dead:
+            self.reader = gevent.spawn(self._read_loop)
+
+        # the request is built (and timestamped) when it leaves the send
+        # queue, and if it cannot be sent, its error is raised in `wait`
+        request = functools.partial(self.build_request, identifier, sequence, packet_size)
+        self.sender.send(request, addr_info[4], waiter.set_exception)
+        if metrics.enabled:
+            metrics.count('icmp.sent')
+
+        return key, waiter
+
+    def wait(self, key, waiter, timeout, adaptive=None):
+        """ Returns either the delay (in seconds) or `None` on timeout.
+
+        With `adaptive` (a `gaico.net.timeouts.AdaptiveTimeout`), the request
+        times out as soon as the round trip times observed allow it, and the
+        delay of the reply updates the estimates.
+        """
+
+        try:
+            delay = wait_reply(waiter, key[2], timeout, adaptive)
+            if adaptive is not None:
+                adaptive.add(key[2], delay)
+            return delay
+        except gevent.Timeout:
+            if metrics.enabled:
+                metrics.count('icmp.timeouts')
+            return None
+        finally:
+            self.remove_waiter(key, waiter)
+            if not self.waiters:
+                self.stop_reading()
+
+    def ping(self, addr_info, identifier, sequence, timeout, packet_size, adaptive=None):
+        """ Returns either the delay (in seconds) or `None` on timeout. """
+
+        key, waiter = self.send(addr_info, identifier, sequence, packet_size)
+        return self.wait(key, waiter, timeout, adaptive)
+
+    def _read_loop(self):
+        """ Read replies from the socket and wake up the matching waiters. """
+
+        fd = self.socket.fileno()
+        while self.waiters:
+            wait_read(fd)
+            if metrics.enabled:
+                metrics.count('icmp.wakeups')
+            # drain all the pending replies before waiting again
+            while True:
+                packets = self.receiver.receive()
+                for received_packet, addr, time_received in packets:
+                    self.dispatch(received_packet, addr, time_received)
+                if len(packets) < self.receiver.batch:
+                    break
+
+    def stop_reading(self):
+        """ Stop the reader greenlet, once no reply is awaited. """
+
+        self.collect_filtered()
+        if self.reader is not None:
+            # the reader would otherwise wait for the next reply; the next
+            # request starts a new one
+            reader, self.reader = self.reader, None
+            reader.kill(block=False)
+
+    def wake(self, waiter, delay):
+        """ Wake up `waiter` with the `delay` of its reply. """
+
+        waiter.set(delay)
+
+    def close(self):
+        """ Close the socket and stop the reader greenlet. """
+
+        if self.reader is not None:
+            self.reader.kill()
+        super(ICMPEngine, self).close()
+
+
+_engines = {}
+
+
+def get_engine(family, transport=TRANSPORT_AUTO):
+    """ Returns the shared `ICMPEngine` for the given address family and transport. """
+
+    engine = _engines.get((family, transport))
+    if engine is None:
+        engine = _engines[(family, transport)] = ICMPEngine(family, transport)
+    return engine
+
+
+def close_engines():
+    """ Close all the shared ICMP engines. """
+
+    while _engines:
+        _, engine = _engines.popitem()
+        engine.close()
+
 
 def send_one_ping(my_socket, addr_info, identifier, sequence, packet_size):
     """ Send one ping request the given `addr_info`. """
 
-    # add the current timestamp in the payload
-    bytes_size = struct.calcsize("d")
-    payload = ((packet_size - 8) - bytes_size) * "Q"
-    payload = struct.pack("!d", time.time()) + payload
-
     # is ipv6?
     ipv6 = my_socket.family == socket.AF_INET6
 
-    # our PING packet
-    packet = PingPacket(identifier, sequence, payload, ipv6)
+    # ping sockets have the kernel calculate the checksum for us
+    checksum = my_socket.type != socket.SOCK_DGRAM
+
+    # our PING packet, with the current timestamp in the payload
+    template = get_template(identifier, packet_size, ipv6, checksum)
+    packet = template.build(sequence, time.monotonic_ns())
 
     # send the packet on the wire
-    my_socket.sendto(packet.pack(), addr_info[4])
+    my_socket.sendto(packet, addr_info[4])
 
 
-def do_one_ping(addr_info, identifier, sequence, timeout, packet_size):
+def do_one_ping(addr_info, identifier, sequence, timeout, packet_size, transport=TRANSPORT_AUTO,
+                adaptive=None):
     """ Returns either the delay (in seconds) or `None` on timeout. """
 
-    icmp = socket.getprotobyname('icmp')
-    if addr_info[0] == socket.AF_INET6:
-        icmp = socket.getprotobyname('ipv6-icmp')
+    engine = get_engine(addr_info[0], transport)
+    return engine.ping(addr_info, identifier, sequence, timeout, packet_size, adaptive)
 
-    try:
-        my_socket = socket.socket(addr_info[0], socket.SOCK_RAW, icmp)
-    except PermissionError:
-        msg = "ARP requests can only be sent from processes running as root."
-        raise PermissionError(msg)
 
-    send_one_ping(my_socket, addr_info, identifier, sequence, packet_size)
-    delay = receive_one_ping(my_socket, addr_info, identifier, sequence, timeout)
+def race_one_ping(addresses_info, identifier, timeout, packet_size, transport=TRANSPORT_AUTO,
+                  adaptive=None):
+    """ Ping the addresses one after the other until one answers (happy eyeballs).
 
-    my_socket.close()
+    Returns the address info that answered (the first one if none did) and
+    the delay (or `None` on timeout).
+    """
 
-    return delay
+    def attempt(addr_info):
+        try:
+            delay = do_one_ping(addr_info, identifier, 0, timeout, packet_size, transport,
+                                adaptive)
+        except OSError:
+            # unreachable network, ...
+            return False, None
+        return delay is not None, delay
 
+    return race(addresses_info, attempt)
 
-def ping_worker(addr_info, timeout, count, packet_size, interval, deadline):
-    """ Worker that is run for each host. Concurrency is handled by gevent. """
 
-    minping = None
-    avgping = None
-    maxping = None
-    replies = []
+class PingStatistics(object):
+    """ Running statistics of the ping round trips to a host.
 
-    deadline_time = None
-    if deadline is not None:
-        deadline_time = time.time() + deadline
+    Percentiles come from a `LatencyHistogram`, so memory does not grow with
+    the number of round trips.
+    """
 
-    identifier = int(time.time() * 1000000) & 0xFFFF
+    def __init__(self):
+        self.sent = 0
+        self.received = 0
+        self.total_delay = 0
+        self.total_square = 0
+        self.minping = None
+        self.maxping = None
+        self.last_delay = None
+        self.jitter = None
+        self.histogram = LatencyHistogram()
 
-    sent_packets = 0
-    for sequence in range(count):
-        time_ping_sent = time.time()
-        delay = do_one_ping(addr_info, identifier, sequence, timeout, packet_size)
+    def add(self, delay):
+        """ Record a round trip: its `delay` in seconds, or `None` on timeout. """
 
-        sent_packets = sent_packets + 1
+        self.sent = self.sent + 1
 
-        if delay is not None:
-            # we got a reply
-            replies.append(delay)
+        if delay is None:
+            return
 
-        if deadline_time is not None and deadline_time < time.time():
-            # deadline reached
-            break
+        # we got a reply
+        self.received = self.received + 1
+        self.total_delay = self.total_delay + delay
+        self.total_square = self.total_square + delay * delay
+        if self.minping is None or delay < self.minping:
+            self.minping = delay
+        if self.maxping is None or delay > self.maxping:
+            self.maxping = delay
+
+        if self.last_delay is not None:
+            self.jitter = update_jitter(self.jitter, self.last_delay, delay)
+        self.last_delay = delay
+        self.histogram.add(delay)
+
+    def result(self, host):
+        """ Returns the result dictionary of `ping` for `host`. """
+
+        percent_lost = None
+        if self.sent:
+            percent_lost = 100 - (self.received * 100 / self.sent)
+
+        avgping = mdev = None
+        if self.received:
+            avgping = self.total_delay / self.received
+            # same as the mdev of the ping command (standard deviation)
+            mdev = math.sqrt(max(0, self.total_square / self.received - avgping * avgping))
+
+        return {
+            'host': host,
+            'sent': self.sent,
+            'received': self.received,
+            'minping': self.minping,
+            'maxping': self.maxping,
+            'avgping': avgping,
+            'packet_loss': percent_lost,
+            'mdev': mdev,
+            'jitter': self.jitter,
+            'p50': self.histogram.percentile(50),
+            'p95': self.histogram.percentile(95),
+            'p99': self.histogram.percentile(99),
+            'histogram': self.histogram,
+        }
+
+
+def ping_worker(addr_info, timeout, count, packet_size, interval, deadline,
+                transport=TRANSPORT_AUTO, on_probe=None, scheduler=None, alternatives=None,
+                adaptive=None):
+    """ Worker that is run for each host. Concurrency is handled by gevent.
+
+    If given, `on_probe` is called with the sequence, the delay (or `None`
+    on timeout) and the IP address of each ping round trip. Requests are sent
+    when `scheduler` (a `SendScheduler` shared by all the workers of a sweep)
+    allows it.
+
+    With `alternatives` (other addresses of the same host), the first round
+    trip races all the addresses (see `gaico.net.socket.race`), and the
+    address that answers first is used for the following round trips.
+
+    With `adaptive` (a `gaico.net.timeouts.AdaptiveTimeout`), each round trip
+    times out as soon as the round trip times observed allow it.
+    """
 
-        time_delta = time.time() - time_ping_sent
-        if time_delta < interval:
-            sleep(interval - time_delta)
+    own_scheduler = scheduler is None
+    if own_scheduler:
+        scheduler = SendScheduler()
 
-    percent_lost = 100 - (len(replies) * 100 / sent_packets)
+    statistics = PingStatistics()
 
-    if replies:
-        minping = min(replies)
-        maxping = max(replies)
-        avgping = sum(replies) / len(replies)
+    deadline_time = None
+    if deadline is not None:
+        deadline_time = time.time() + deadline
 
-    return {
-        'host': addr_info[4][0],
-        'sent': sent_packets,
-        'received': len(replies),
-        'minping': minping,
-        'maxping': maxping,
-        'avgping': avgping,
-        'packet_loss': percent_lost,
-    }
+    identifier = pick_identifier(int(time.time() * 1000000))
 
+    try:
+        next_ping = scheduler.start_time()
+        for sequence in range(count):
+            scheduler.wait(next_ping)
+            next_ping = time.monotonic() + interval
+
+            if sequence == 0 and alternatives:
+                addr_info, delay = race_one_ping([addr_info] + list(alternatives), identifier,
+                                                 timeout, packet_size, transport, adaptive)
+            else:
+                delay = do_one_ping(addr_info, identifier, sequence, timeout, packet_size,
+                                    transport, adaptive)
+            statistics.add(delay)
+
+            if on_probe is not None:
+                on_probe(sequence, delay, addr_info[4][0])
+
+            if deadline_time is not None and deadline_time < time.time():
+                # deadline reached
+                break
+    finally:
+        if own_scheduler:
+            scheduler.close()
+
+    return statistics.result(addr_info[4][0])
+
+
+def ping_iter(hosts, timeout=10, count=10, packet_size=64, interval=1, deadline=None,
+              transport=TRANSPORT_AUTO, rate=None, jitter=0, resolver=default_resolver,
+              addresses=ADDRESSES_FIRST, max_pending=10000, probes=True, concurrency=None,
+              adaptive=None):
+    """ Same as `ping`, but yields the results as soon as they are available.
+
+    :param probes: yield an event for each round trip, and not only one event
+    per host (default: True)
+    :param max_pending: maximum number of events waiting to be consumed; the
+    workers are paused when this limit is reached (default: 10000)
+
+    See `ping` for the other parameters.
+
+    Yields a `PingEvent` namedtuple with the following fields:
+        `type`: *string*; `probe` for a single round trip, `summary` when
+        all the round trips for a host are done, or `error`
+        `host`: *string*; the host, as given in `hosts`
+        `sequence`: *int*; the sequence of the round trip (`probe` only)
+        `delay`: *float*; the round trip time in seconds, or `None` if the
+        request timed out (`probe` only)
+        `result`: the dictionary returned by `ping` for this host (`summary`),
+        or the Exception (`error`)
+        `address`: *string*; the IP address pinged (`None` when the host could
+        not be resolved)
+
+    With `addresses` set to `all`, a host has one worker, and thus one
+    summary, per address.
+
+    Events are not stored once yielded, so results can be consumed on the fly
+    for any number of hosts. Closing the generator stops all the workers.
+
+    `hosts` is consumed lazily, and resolved a chunk at a time: together with
+    `concurrency`, a sweep of a large network (or a generator of hosts) only
+    holds the hosts being pinged in memory.
+    """
+
+    if addresses not in (ADDRESSES_FIRST, ADDRESSES_ALL, ADDRESSES_RACE):
+        raise ValueError("Unknown addresses mode: {}".format(addresses))
+
+    events = Queue(max_pending)
+    scheduler = SendScheduler(rate, jitter)
+    adaptive = get_adaptive(adaptive)
+
+    def worker(host, addr_info, alternatives=None):
+        def on_probe(sequence, delay, address):
+            events.put(PingEvent(EVENT_PROBE, host, sequence, delay, None, address))
+
+        try:
+            result = ping_worker(addr_info, timeout, count, packet_size, interval, deadline,
+                                 transport, on_probe if probes else None, scheduler,
+                                 alternatives, adaptive)
+        except Exception as e:
+            events.put(PingEvent(EVENT_ERROR, host, None, None, e, addr_info[4][0]))
+        else:
+            events.put(PingEvent(EVENT_SUMMARY, host, None, None, result, result['host']))
+
+    # the pool blocks the feeder while `concurrency` workers are running
+    jobs = Pool(concurrency)
+
+    def feed():
+        try:
+            for host, addr_info in getaddrinfo_iter(expand_hosts(hosts), None,
+                                                    resolver=resolver):
+                if addr_info is None or isinstance(addr_info, Exception):
+                    events.put(PingEvent(EVENT_ERROR, host, None, None, addr_info))
+                elif addresses == ADDRESSES_FIRST:
+                    jobs.spawn(worker, host, addr_info[0])
+                elif addresses == ADDRESSES_ALL:
+                    for address_info in sort_addresses(addr_info):
+                        jobs.spawn(worker, host, address_info)
+                else:
+                    address_infos = sort_addresses(addr_info)
+                    jobs.spawn(worker, host, address_infos[0], address_infos[1:])
+
+            # no more events once all the workers are done
+            jobs.join()
+        finally:
+            events.put(StopIteration)
+    feeder = gevent.spawn(feed)
 
-def ping(hosts, timeout=10, count=10, packet_size=64, interval=1, deadline=None):
+    try:
+        for event in events:
+            yield event
+        # errors of `hosts` itself, e.g. a failing generator
+        feeder.get()
+    finally:
+        feeder.kill()
+        jobs.kill()
+        scheduler.close()
+
+
+def ping(hosts, timeout=10, count=10, packet_size=64, interval=1, deadline=None,
+         transport=TRANSPORT_AUTO, rate=None, jitter=0, resolver=default_resolver,
+         addresses=ADDRESSES_FIRST, columnar=False, keep_delays=False, concurrency=None,
+         processes=None, adaptive=None):
     """ Pure Python implementation of the ping command.
 
-    :param hosts: hosts to ping (ip addresses or hostnames)
+    :param hosts: hosts to ping (ip addresses, hostnames, CIDR blocks such as
+    `192.0.2.0/24`, or ranges such as `192.0.2.1-254`, see `gaico.net.targets`)
     :param timeout: timeout in second for a single ping round trip (default: 10)
     :param count: number of ping round trips (default 10)
     :param packet_size: the number of bytes to send (default: 64)
     :param interval: wait interval seconds between sending two packets (default: 1)
     :param deadline: timeout in second, before `ping` returns regardless of how
     many packets have been sent or received (default: no deadline)
+    :param transport: `dgram` to use unprivileged ping sockets, `raw` to use raw
+    sockets (requires root), or `auto` to use ping sockets when the system allows
+    them and raw sockets otherwise (default: auto)
+    :param rate: maximum number of packets per second sent to all the hosts
+    (default: no limit)
+    :param jitter: the first packet of each host is sent after a random delay
+    of up to `jitter` seconds, to avoid a burst of packets (default: 0)
+    :param resolver: `gaico.net.socket.Resolver` used to resolve the hosts, or
+    `None` to bypass the cache (default: the shared resolver cache)
+    :param addresses: which resolved addresses of a host are pinged: `first`,
+    `all` (concurrently), or `race` (happy eyeballs: the first round trip is
+    tried on each address in turn every 250ms, and the address that answers
+    first is used for the following round trips) (default: first)
+    :param columnar: return a `gaico.net.results.PingResults`, which stores the
+    results of large sweeps in arrays instead of dictionaries (default: False)
+    :param keep_delays: with `columnar`, also keep the delay of every round
+    trip (default: False)
+    :param concurrency: maximum number of hosts pinged at once (default: no limit)
+    :param processes: split the hosts between this number of processes, see
+    `gaico.net.shard`; `rate` and `concurrency` are then shared, and each
+    process resolves its hosts with its own cache (default: a single process)
+    :param adaptive: `True`, or a `gaico.net.timeouts.AdaptiveTimeout` shared
+    by several calls, to time each round trip out as soon as the round trip
+    times observed for the host (or its subnet) allow it, `timeout` being an
+    upper bound; with `processes`, each process has its own estimates
+    (default: a fixed timeout)
 
     Returns an Exception or a dictionary for each host with the following fields:
         `host`: *string*; the IP address used to ping the target
@@ -242,24 +805,65 @@ def ping(hosts, timeout=10, count=10, packet_size=64, interval=1, deadline=None)
         `avgping`: *float*; the average round trip ping time in seconds
         `maxping`: *float*; the maximum (slowest) round trip ping time in seconds
         `packet_loss`: *float*; percentage of lost packets
+        `mdev`: *float*; standard deviation of the round trip times in seconds
+        `jitter`: *float*; smoothed mean deviation of consecutive round trip
+        times in seconds (RFC 3550)
+        `p50`, `p95`, `p99`: *float*; percentiles of the round trip times in seconds
+        `histogram`: `gaico.net.stats.LatencyHistogram`; all the round trip
+        times, can be merged with the histograms of other hosts
+
+    With `addresses` set to `all`, the value of a host is a dictionary with
+    the IP addresses as keys, and the dictionary above for each address.
+
+    With `columnar`, only the fields up to `packet_loss` are available.
+
+    Use `ping_iter` to get the results as soon as they are available.
     """
 
-    addresses_info = getaddrinfo(hosts, None)
-
-    jobs = []
-    failures = {}
-    for host in hosts:
-        addr_info = addresses_info[host]
-        if addr_info is None or isinstance(addr_info, Exception):
-            failures[host] = addr_info
-            continue
-        if len(addr_info) >= 1:
-            jobs.append(gevent.spawn(ping_worker, addr_info[0], timeout, count, packet_size,
-                                     interval, deadline))
-    gevent.joinall(jobs)
-
-    ping_results = [job.value for job in jobs]
-    results = dict(zip(hosts, ping_results))
-    results.update(failures)
+    if columnar and addresses == ADDRESSES_ALL:
+        raise ValueError("Columnar results have a single address per host.")
+
+    if processes is not None and processes > 1:
+        hosts = list(dict.fromkeys(expand_hosts(hosts)))
+        parts = [part for part in split(hosts, processes) if part]
+        kwargs = dict(timeout=timeout, count=count, packet_size=packet_size, interval=interval,
+                      deadline=deadline, transport=transport, addresses=addresses,
+                      jitter=jitter, columnar=columnar, keep_delays=keep_delays,
+                      adaptive=bool(adaptive))
+        if rate is not None:
+            kwargs['rate'] = rate / len(parts)
+        if concurrency is not None:
+            kwargs['concurrency'] = max(1, concurrency // len(parts))
+        if resolver is None:
+            kwargs['resolver'] = None
+
+        shard_results = run_shards(ping, parts, kwargs)
+        if columnar:
+            return PingResults.concatenate(shard_results)
+        results = {}
+        for shard_result in shard_results:
+            results.update(shard_result)
+        return results
+
+    if columnar:
+        results = PingResults(list(expand_hosts(hosts)), count, keep_delays)
+        hosts = results.hosts
+    else:
+        results = {}
+
+    events = ping_iter(hosts, timeout, count, packet_size, interval, deadline, transport,
+                       rate, jitter, resolver, addresses, probes=columnar,
+                       concurrency=concurrency, adaptive=adaptive)
+    for event in events:
+        if addresses == ADDRESSES_ALL and event.address is not None:
+            results.setdefault(event.host, {})[event.address] = event.result
+        elif not columnar:
+            results[event.host] = event.result
+        elif event.type == EVENT_PROBE:
+            results.add(event.host, event.sequence, event.delay)
+        elif event.type == EVENT_SUMMARY:
+            results.addresses[results.index[event.host]] = event.result['host']
+        else:
+            results.errors[event.host] = event.result
 
     return results
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+
+import time
+from gevent import socket, ssl
+from gaico import GaicoException
+from gaico.net import metrics
+
+"""
+    Service probes run by `check_ports_state` on the connections it opened.
+
+    Once a port is open, the probes given with the `probes` parameter are
+    run in turn on the same connection (no second connection is opened to
+    identify the service): each probe has its own timeout, and reads at
+    most `size` bytes.
+
+    A probe is an object with a `name` and a `run(s)` method, where `s` is
+    the connected socket; its result (or the exception it raised) is
+    returned in the `services` field of the host. Subclass `Probe` for other
+    protocols.
+
+    `TLSProbe` takes the connection over: it must be the last probe.
+"""
+
+
+class ProbeException(GaicoException):
+    """ Raised when a service does not answer with the expected protocol. """
+    pass
+
+
+def read(s, size, timeout, terminator=None):
+    """ Read from `s` until `terminator` is received, `size` bytes are read,
+    the connection is closed, or `timeout` seconds have passed.
+
+    Returns the bytes read; raises `socket.timeout` if nothing was received.
+    """
+
+    data = b''
+    deadline = time.monotonic() + timeout
+    while len(data) < size:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            if data:
+                break
+            raise socket.timeout('timed out')
+
+        s.settimeout(remaining)
+        try:
+            chunk = s.recv(size - len(data))
+        except socket.timeout:
+            if data:
+                break
+            raise
+        if not chunk:
+            # connection closed
+            break
+
+        data = data + chunk
+        if terminator is not None and terminator in data:
+            break
+
+    return data
+
+
+class Probe(object):
+    """ Base class of the service probes. """
+
+    name = None
+
+    def __init__(self, timeout=5, size=4096):
+        """
+        :param timeout: timeout in second of the probe (default: 5)
+        :param size: maximum number of bytes read (default: 4096)
+        """
+
+        self.timeout = timeout
+        self.size = size
+
+    def run(self, s):
+        """ Returns the result of the probe on the connected socket `s`. """
+
+        raise NotImplementedError()
+
+
+class BannerProbe(Probe):
+    """ Returns what the service sends first (SSH, SMTP, FTP, ...), up to the end of a line.
+
+    With `payload`, it is sent first, for services waiting for the client to
+    speak.
+    """
+
+    name = 'banner'
+
+    def __init__(self, timeout=2, size=1024, payload=None):
+        """
+        :param timeout: timeout in second to wait for the banner (default: 2)
+        :param size: maximum number of bytes read (default: 1024)
+        :param payload: bytes sent before reading (default: nothing)
+        """
+
+        super(BannerProbe, self).__init__(timeout, size)
+        self.payload = payload
+
+    def run(self, s):
+        if self.payload:
+            s.settimeout(self.timeout)
+            s.sendall(self.payload)
+        return read(s, self.size, self.timeout, b'\n')
+
+
+class HTTPProbe(Probe):
+    """ Sends an HTTP request, and returns the status and the headers of the response.
+
+    The result is a dictionary with the following fields:
+        `version`: *string*; the HTTP version of the response
+        `status`: *int*; the status code
+        `reason`: *string*; the reason phrase
+        `headers`: *dict*; the headers (with lower case names)
+    """
+
+    name = 'http'
+
+    def __init__(self, timeout=5, size=8192, method='HEAD', path='/', host=None):
+        """
+        :param timeout: timeout in second of the request (default: 5)
+        :param size: maximum number of bytes read (default: 8192)
+        :param method: method of the request (default: HEAD)
+        :param path: path of the request (default: /)
+        :param host: value of the `Host` header (default: the IP address and
+        port connected to)
+        """
+
+        super(HTTPProbe, self).__init__(timeout, size)
+        self.method = method
+        self.path = path
+        self.host = host
+
+    def request(self, s):
+        """ Returns the request sent on `s`. """
+
+        host = self.host
+        if host is None:
+            address, port = s.getpeername()[:2]
+            if ':' in address:
+                address = '[{}]'.format(address)
+            host = '{}:{}'.format(address, port)
+
+        return ('{} {} HTTP/1.1\r\nHost: {}\r\nUser-Agent: gaico\r\nAccept: */*\r\n'
+                'Connection: close\r\n\r\n').format(self.method, self.path, host).encode('ascii')
+
+    def run(self, s):
+        s.settimeout(self.timeout)
+        s.sendall(self.request(s))
+        return self.parse(read(s, self.size, self.timeout, b'\r\n\r\n'))
+
+    @staticmethod
+    def parse(response):
+        """ Returns the status and the headers of an HTTP `response` (bytes). """
+
+        lines = response.split(b'\r\n\r\n', 1)[0].decode('iso-8859-1').split('\r\n')
+        status = lines[0].split(' ', 2)
+        if len(status) < 2 or not status[0].startswith('HTTP/') or not status[1].isdigit():
+            raise ProbeException("Not an HTTP response: {!r}".format(response[:64]))
+
+        headers = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(':')
+            if sep:
+                headers[name.strip().lower()] = value.strip()
+
+        return {
+            'version': status[0],
+            'status': int(status[1]),
+            'reason': status[2] if len(status) > 2 else '',
+            'headers': headers,
+        }
+
+
+class TLSProbe(Probe):
+    """ Runs a TLS handshake, and returns the parameters of the session.
+
+    The certificate is not verified. The result is a dictionary with the
+    following fields:
+        `version`: *string*; the TLS version negotiated
+        `cipher`: *string*; the cipher suite negotiated
+        `alpn`: *string*; the application protocol negotiated, or `None`
+        `certificate`: *bytes*; the certificate of the server (DER)
+
+    The connection is then used by TLS: this must be the last probe.
+    """
+
+    name = 'tls'
+
+    def __init__(self, timeout=5, server_hostname=None, alpn=('h2', 'http/1.1')):
+        """
+        :param timeout: timeout in second of the handshake (default: 5)
+        :param server_hostname: name sent in the SNI extension (default: none)
+        :param alpn: application protocols offered (default: h2 and http/1.1)
+        """
+
+        super(TLSProbe, self).__init__(timeout, 0)
+        self.server_hostname = server_hostname
+        self.alpn = alpn
+
+    def context(self):
+        """ Returns the `ssl.SSLContext` of the handshakes. """
+
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        if self.alpn:
+            context.set_alpn_protocols(list(self.alpn))
+        return context
+
+    def run(self, s):
+        s.settimeout(self.timeout)
+        tls = self.context().wrap_socket(s, server_hostname=self.server_hostname,
+                                         do_handshake_on_connect=False)
+        try:
+            tls.do_handshake()
+            return {
+                'version': tls.version(),
+                'cipher': tls.cipher()[0],
+                'alpn': tls.selected_alpn_protocol(),
+                'certificate': tls.getpeercert(binary_form=True),
+            }
+        finally:
+            tls.close()
+
+
+def run_probes(s, probes):
+    """ Run each probe of `probes` in turn on the connected socket `s`.
+
+    Returns a dictionary with the names of the probes as keys, and their
+    results (or the exceptions they raised) as values.
+    """
+
+    results = {}
+    for probe in probes:
+        if metrics.enabled:
+            metrics.count('tcp.probes')
+        try:
+            results[probe.name] = probe.run(s)
+        except Exception as e:
+            results[probe.name] = e
+    return results
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+
+import math
+from array import array
+from collections.abc import Mapping
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+"""
+    Columnar storage of the results of large ping sweeps.
+"""
+
+
+class PingResults(Mapping):
+    """ Results of `ping` for many hosts, stored in columns.
+
+    Each statistic is an `array` with one item per host, instead of one
+    dictionary per host and one boxed float per round trip. The results can
+    still be read like the dictionary returned by `ping` (`results[host]`
+    builds the dictionary of a single host on demand), or exported in bulk
+    with `columns`.
+
+    When `keep_delays` is set, the delay of every round trip is kept in a
+    single `array('d')` of `count` items per host (NaN when there was no
+    reply, or when the request was not sent because of the deadline).
+    """
+
+    def __init__(self, hosts, count, keep_delays=False):
+        """
+        :param hosts: the hosts, as given to `ping`
+        :param count: the number of round trips per host
+        :param keep_delays: keep the delay of each round trip (default: False)
+        """
+
+        self.hosts = list(dict.fromkeys(hosts))
+        self.index = dict((host, i) for i, host in enumerate(self.hosts))
+        self.count = count
+
+        size = len(self.hosts)
+        self.addresses = [None] * size
+        self.errors = {}
+        self.sent = array('I', [0]) * size
+        self.received = array('I', [0]) * size
+        self.minping = array('d', [math.nan]) * size
+        self.maxping = array('d', [math.nan]) * size
+        self.total_delay = array('d', [0]) * size
+
+        self.delays = None
+        if keep_delays:
+            self.delays = array('d', [math.nan]) * (size * count)
+
+    @classmethod
+    def concatenate(cls, parts):
+        """ Returns the results of all the hosts of `parts`, a list of
+        `PingResults` of distinct hosts and the same `count`.
+        """
+
+        count = parts[0].count if parts else 0
+        keep_delays = bool(parts) and parts[0].delays is not None
+        results = cls([], count, keep_delays)
+
+        for part in parts:
+            offset = len(results.hosts)
+            results.hosts.extend(part.hosts)
+            results.index.update((host, offset + i) for i, host in enumerate(part.hosts))
+            results.addresses.extend(part.addresses)
+            results.errors.update(part.errors)
+            for name in ('sent', 'received', 'minping', 'maxping', 'total_delay'):
+                getattr(results, name).extend(getattr(part, name))
+            if keep_delays:
+                results.delays.extend(part.delays)
+
+        return results
+
+    def add(self, host, sequence, delay):
+        """ Record a round trip: its `delay` in seconds, or `None` on timeout. """
+
+        i = self.index[host]
+        self.sent[i] = self.sent[i] + 1
+
+        if delay is None:
+            return
+
+        self.received[i] = self.received[i] + 1
+        self.total_delay[i] = self.total_delay[i] + delay
+        if not delay >= self.minping[i]:
+            # also true when minping is NaN (no reply yet)
+            self.minping[i] = delay
+        if not delay <= self.maxping[i]:
+            self.maxping[i] = delay
+
+        if self.delays is not None and sequence < self.count:
+            self.delays[i * self.count + sequence] = delay
+
+    def round_trips(self, host):
+        """ Returns the delays of all the round trips of `host` (requires `keep_delays`). """
+
+        if self.delays is None:
+            raise ValueError("Delays are only kept with keep_delays=True.")
+
+        i = self.index[host]
+        return self.delays[i * self.count:(i + 1) * self.count]
+
+    def packet_loss(self):
+        """ Returns the percentage of lost packets of each host (NaN if nothing was sent). """
+
+        return array('d', [
+            100 - (received * 100 / sent) if sent else math.nan
+            for sent, received in zip(self.sent, self.received)
+        ])
+
+    def avgping(self):
+        """ Returns the average round trip time of each host (NaN without reply). """
+
+        return array('d', [
+            total / received if received else math.nan
+            for total, received in zip(self.total_delay, self.received)
+        ])
+
+    def columns(self, use_numpy=None):
+        """ Returns all the statistics, as a dictionary of columns.
+
+        Columns are arrays in the order of `hosts`, or NumPy arrays if
+        `use_numpy` is set (default: when NumPy is installed). Hosts that could
+        not be pinged have a `None` address, and are listed in `errors`.
+        """
+
+        columns = {
+            'host': self.hosts,
+            'address': self.addresses,
+            'sent': self.sent,
+            'received': self.received,
+            'minping': self.minping,
+            'maxping': self.maxping,
+            'avgping': self.avgping(),
+            'packet_loss': self.packet_loss(),
+        }
+        if self.delays is not None:
+            columns['delays'] = self.delays
+
+        if use_numpy is None:
+            use_numpy = numpy is not None
+        if use_numpy:
+            for name, column in columns.items():
+                if isinstance(column, array):
+                    # no copy: the NumPy array shares the memory of the column
+                    columns[name] = numpy.frombuffer(column, dtype=column.typecode)
+            if self.delays is not None:
+                columns['delays'] = columns['delays'].reshape(len(self.hosts), self.count)
+
+        return columns
+
+    def __getitem__(self, host):
+        """ Returns the dictionary (or the Exception) `ping` would return for `host`. """
+
+        if host in self.errors:
+            return self.errors[host]
+
+        i = self.index[host]
+        sent = self.sent[i]
+        received = self.received[i]
+
+        def optional(value):
+            return None if math.isnan(value) else value
+
+        return {
+            'host': self.addresses[i],
+            'sent': sent,
+            'received': received,
+            'minping': optional(self.minping[i]),
+            'maxping': optional(self.maxping[i]),
+            'avgping': self.total_delay[i] / received if received else None,
+            'packet_loss': 100 - (received * 100 / sent) if sent else None,
+        }
+
+    def __iter__(self):
+        return iter(self.hosts)
+
+    def __len__(self):
+        return len(self.hosts)
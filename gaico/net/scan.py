@@ -0,0 +1,441 @@
+# -*- coding: utf-8 -*-
+
+import errno
+import heapq
+import itertools
+import os
+import random
+import select
+import socket
+import struct
+import time
+import zlib
+from collections import deque
+from gevent import select as gselect
+from gevent.socket import wait_read
+from gaico.net import metrics
+from gaico.net.ping import RECEIVE_BUFFER_SIZE, internet_checksum
+
+"""
+    Bulk TCP port scanners used by `check_ports_state`.
+"""
+
+# how `check_ports_state` checks the ports: one blocking connect per greenlet
+# (connect), non-blocking connects completed by a single poll loop (poll), or
+# half-open SYN probes sent from a raw socket (syn, IPv4 only, requires root)
+METHOD_CONNECT = 'connect'
+METHOD_POLL = 'poll'
+METHOD_SYN = 'syn'
+
+# SYN scans read the pending replies every DRAIN_INTERVAL probes sent
+DRAIN_INTERVAL = 64
+
+# source ports of the SYN scans, restricted to a part of the range in the
+# processes of a sharded sweep (see `gaico.net.shard`)
+source_ports = range(40000, 60001)
+
+TCP_SYN = 0x02
+TCP_RST = 0x04
+TCP_ACK = 0x10
+
+
+class _Probe(object):
+    """ A single (host, port) being checked. """
+
+    __slots__ = ('host', 'addr_info', 'port', 'started', 'deadline', 'done', 'socket',
+                 'sequence')
+
+    def __init__(self, host, addr_info, port, started, deadline):
+        self.host = host
+        self.addr_info = addr_info
+        self.port = port
+        self.started = started
+        self.deadline = deadline
+        self.done = False
+        self.socket = None
+        self.sequence = None
+
+
+class BaseScanner(object):
+    """ Keeps a bounded number of probes in flight and collects their results.
+
+    Subclasses start the probes (`_start`) and wait for their completions
+    (`_wait`), calling `_complete` with the state of each port.
+    """
+
+    def __init__(self, timeout, concurrency=None, per_host=None, adaptive=None):
+        """
+        :param timeout: timeout in second to wait for a reply
+        :param concurrency: maximum number of probes in flight (default: no limit)
+        :param per_host: maximum number of probes in flight for a single host (default: no limit)
+        :param adaptive: `gaico.net.timeouts.AdaptiveTimeout` timing the
+        probes out as soon as the round trip times observed allow it, with
+        `timeout` as an upper bound (default: a fixed timeout)
+        """
+
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.per_host = per_host
+        self.adaptive = adaptive
+
+    def scan(self, targets):
+        """ Check all the `targets`, an iterable of (host, addr_info, port).
+
+        Returns a dictionary with (host, port) as keys, and `True` if the port
+        is open, or an Exception as values.
+        """
+
+        self.results = {}
+        self.in_flight = 0
+        self.host_in_flight = {}
+        deferred = {}
+        ready_hosts = deque()
+        # (time of the next timeout check, order, probe)
+        expirations = []
+        order = itertools.count()
+        targets = iter(targets)
+        exhausted = False
+
+        try:
+            while True:
+                # hosts with deferred targets that can now start a new probe
+                for host in deferred:
+                    if host not in ready_hosts and self.host_in_flight[host] < self.per_host:
+                        ready_hosts.append(host)
+
+                # start new probes while there is room for them
+                while self.concurrency is None or self.in_flight < self.concurrency:
+                    if ready_hosts:
+                        host = ready_hosts.popleft()
+                        target = deferred[host].popleft()
+                        if not deferred[host]:
+                            del deferred[host]
+                    elif not exhausted:
+                        target = next(targets, None)
+                        if target is None:
+                            exhausted = True
+                            continue
+                        host = target[0]
+                        if self.per_host is not None and (
+                                host in deferred or
+                                self.host_in_flight.get(host, 0) >= self.per_host):
+                            deferred.setdefault(host, deque()).append(target)
+                            continue
+                    else:
+                        break
+
+                    now = time.monotonic()
+                    probe = _Probe(host, target[1], target[2], now, now + self.timeout)
+                    self.in_flight = self.in_flight + 1
+                    self.host_in_flight[host] = self.host_in_flight.get(host, 0) + 1
+                    heapq.heappush(expirations, (self._check_after(probe, now) + now,
+                                                 next(order), probe))
+                    self._start(probe)
+
+                # drop the probes already done from the expiration queue
+                while expirations and expirations[0][2].done:
+                    heapq.heappop(expirations)
+
+                if not expirations:
+                    if exhausted and not deferred:
+                        break
+                    continue
+
+                self._wait(max(0, expirations[0][0] - time.monotonic()))
+
+                # time the probes out, or check them again later
+                now = time.monotonic()
+                while expirations and (expirations[0][2].done or expirations[0][0] <= now):
+                    _, _, probe = heapq.heappop(expirations)
+                    if probe.done:
+                        continue
+                    step = self._check_after(probe, now)
+                    if step <= 0:
+                        self._complete(probe, socket.timeout('timed out'))
+                    else:
+                        heapq.heappush(expirations, (now + step, next(order), probe))
+        finally:
+            for _, _, probe in expirations:
+                if not probe.done:
+                    self._complete(probe, socket.timeout('timed out'))
+            self.close()
+
+        return self.results
+
+    def _check_after(self, probe, now):
+        """ Returns how long `probe` can wait before checking its timeout again, or 0. """
+
+        if self.adaptive is None:
+            return max(0, probe.deadline - now)
+        return self.adaptive.check_after(probe.addr_info[4][0], now - probe.started,
+                                         self.timeout)
+
+    def _complete(self, probe, state):
+        """ Record the `state` of `probe`, and release its resources. """
+
+        if self.adaptive is not None and (state is True or
+                                          isinstance(state, ConnectionRefusedError)):
+            # the host answered
+            self.adaptive.add(probe.addr_info[4][0], time.monotonic() - probe.started)
+
+        probe.done = True
+        self.results[(probe.host, probe.port)] = state
+        self.in_flight = self.in_flight - 1
+        self.host_in_flight[probe.host] = self.host_in_flight[probe.host] - 1
+        self._release(probe)
+
+    def _start(self, probe):
+        raise NotImplementedError()
+
+    def _wait(self, timeout):
+        raise NotImplementedError()
+
+    def _release(self, probe):
+        pass
+
+    def close(self):
+        pass
+
+
+class PollScanner(BaseScanner):
+    """ Issues non-blocking connects and collects their completions with a single poll loop.
+
+    With epoll (Linux), gevent only watches the epoll file descriptor, and a
+    wakeup only returns the sockets that completed. Elsewhere, all the
+    pending sockets go through `select`.
+
+    Open ports are closed with a RST (SO_LINGER with a 0 timeout) unless
+    `reset` is `False`, which avoids the FIN handshake and the TIME_WAIT state.
+    """
+
+    def __init__(self, timeout, concurrency=None, per_host=None, reset=True, adaptive=None):
+        super(PollScanner, self).__init__(timeout, concurrency, per_host, adaptive)
+        self.reset = reset
+        self.pending = {}
+        self.epoll = None
+        if hasattr(select, 'epoll'):
+            self.epoll = select.epoll()
+
+    def _start(self, probe):
+        addr_info = probe.addr_info
+        try:
+            s = socket.socket(addr_info[0], socket.SOCK_STREAM)
+        except OSError as e:
+            # probably out of file descriptors (EMFILE)
+            self._complete(probe, e)
+            return
+
+        s.setblocking(False)
+        probe.socket = s
+        if metrics.enabled:
+            metrics.count('tcp.socket_opens')
+
+        address = (addr_info[4][0], probe.port) + tuple(addr_info[4][2:])
+        error = s.connect_ex(address)
+        if error == 0:
+            self._complete(probe, True)
+        elif error != errno.EINPROGRESS:
+            self._complete(probe, OSError(error, os.strerror(error)))
+        else:
+            self.pending[s.fileno()] = probe
+            if self.epoll is not None:
+                self.epoll.register(s.fileno(), select.EPOLLOUT)
+
+    def _wait(self, timeout):
+        if metrics.enabled:
+            metrics.count('scan.wakeups')
+
+        if self.epoll is not None:
+            try:
+                wait_read(self.epoll.fileno(), timeout)
+            except socket.timeout:
+                return
+            ready = [fileno for fileno, _ in self.epoll.poll(0)]
+        else:
+            sockets = [probe.socket for probe in self.pending.values()]
+            _, ready, _ = gselect.select([], sockets, [], timeout)
+            ready = [s.fileno() for s in ready]
+
+        for fileno in ready:
+            probe = self.pending.get(fileno)
+            if probe is None:
+                continue
+            error = probe.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if error == 0:
+                self._complete(probe, True)
+            else:
+                self._complete(probe, OSError(error, os.strerror(error)))
+
+    def _release(self, probe):
+        s = probe.socket
+        if s is None:
+            return
+
+        fileno = s.fileno()
+        if self.pending.pop(fileno, None) is not None and self.epoll is not None:
+            self.epoll.unregister(fileno)
+
+        if self.reset:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        s.close()
+        probe.socket = None
+
+    def close(self):
+        if self.epoll is not None:
+            self.epoll.close()
+            self.epoll = None
+
+
+class SYNScanner(BaseScanner):
+    """ Sends half-open SYN probes from a raw socket (IPv4 only, requires root).
+
+    A SYN/ACK means the port is open (the kernel answers it with a RST as no
+    socket uses our source port), a RST means the port is closed. No socket
+    and no file descriptor is used per probe.
+    """
+
+    def __init__(self, timeout, concurrency=None, per_host=None, source_port=None,
+                 adaptive=None):
+        super(SYNScanner, self).__init__(timeout, concurrency, per_host, adaptive)
+
+        try:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_TCP)
+        except PermissionError:
+            msg = "SYN scans can only be done from processes running as root."
+            raise PermissionError(msg)
+        self.socket.setblocking(False)
+
+        # every TCP segment received by the host goes through this socket
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER_SIZE)
+
+        if source_port is None:
+            source_port = random.choice(source_ports)
+        self.source_port = source_port
+        self.secret = os.urandom(8)
+
+        # probes are indexed by (IP address, port) of the target, several host
+        # names can have the same address
+        self.probes = {}
+        self.source_addresses = {}
+        self.sent = 0
+
+    def source_address(self, destination):
+        """ Returns the local IP address used to reach `destination`. """
+
+        source = self.source_addresses.get(destination)
+        if source is None:
+            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                s.connect((destination, 9))
+                source = s.getsockname()[0]
+            finally:
+                s.close()
+            self.source_addresses[destination] = source
+        return source
+
+    def build_syn(self, source, destination, port, sequence):
+        """ Returns the TCP header of a SYN segment (the kernel adds the IP header). """
+
+        header = struct.pack('!HHIIBBHHH', self.source_port, port, sequence, 0, 5 << 4, TCP_SYN,
+                             65535, 0, 0)
+        pseudo_header = socket.inet_aton(source) + socket.inet_aton(destination) + \
+            struct.pack('!BBH', 0, socket.IPPROTO_TCP, len(header))
+        checksum = internet_checksum(pseudo_header + header)
+
+        return header[:16] + struct.pack('!H', checksum) + header[18:]
+
+    def _start(self, probe):
+        if probe.addr_info[0] != socket.AF_INET:
+            self._complete(probe, ValueError("SYN scans only support IPv4 addresses."))
+            return
+
+        destination = probe.addr_info[4][0]
+
+        # sequence numbers are derived from the target, to validate replies
+        probe.sequence = zlib.crc32(self.secret + destination.encode() +
+                                    struct.pack('!H', probe.port))
+
+        try:
+            segment = self.build_syn(self.source_address(destination), destination, probe.port,
+                                     probe.sequence)
+            self.socket.sendto(segment, (destination, 0))
+        except OSError as e:
+            self._complete(probe, e)
+            return
+
+        self.probes.setdefault((destination, probe.port), []).append(probe)
+
+        # read the replies while sending, large bursts would overflow the socket
+        self.sent = self.sent + 1
+        if self.sent % DRAIN_INTERVAL == 0:
+            self._drain()
+
+    def _wait(self, timeout):
+        if metrics.enabled:
+            metrics.count('scan.wakeups')
+
+        try:
+            wait_read(self.socket.fileno(), timeout)
+        except socket.timeout:
+            return
+        self._drain()
+
+    def _drain(self):
+        """ Read all the pending segments. """
+
+        while True:
+            try:
+                packet, addr = self.socket.recvfrom(1024)
+            except (BlockingIOError, InterruptedError):
+                return
+            self.dispatch(packet)
+
+    def dispatch(self, packet):
+        """ Parse one IP packet and complete the probe it replies to (if any). """
+
+        header_length = (packet[0] & 0x0F) * 4
+        segment = packet[header_length:]
+        if len(segment) < 14:
+            return
+
+        source_port, destination_port, sequence, ack, offset, flags = struct.unpack(
+            '!HHIIBB', segment[:14]
+        )
+        if destination_port != self.source_port:
+            return
+
+        source = socket.inet_ntoa(packet[12:16])
+        probes = self.probes.get((source, source_port))
+        if probes is None or ack != (probes[0].sequence + 1) & 0xFFFFFFFF:
+            return
+
+        if flags & (TCP_SYN | TCP_ACK) == TCP_SYN | TCP_ACK:
+            state = True
+        elif flags & TCP_RST:
+            state = ConnectionRefusedError(errno.ECONNREFUSED, os.strerror(errno.ECONNREFUSED))
+        else:
+            return
+
+        for probe in list(probes):
+            self._complete(probe, state)
+
+    def _release(self, probe):
+        key = (probe.addr_info[4][0], probe.port)
+        probes = self.probes.get(key)
+        if probes is not None and probe in probes:
+            probes.remove(probe)
+            if not probes:
+                del self.probes[key]
+
+    def close(self):
+        self.socket.close()
+
+
+def get_scanner(method, timeout, concurrency=None, per_host=None, adaptive=None):
+    """ Returns the scanner implementing `method` (`poll` or `syn`). """
+
+    if method == METHOD_POLL:
+        return PollScanner(timeout, concurrency, per_host, adaptive=adaptive)
+    if method == METHOD_SYN:
+        return SYNScanner(timeout, concurrency, per_host, adaptive=adaptive)
+    raise ValueError("Unknown port scan method: {}".format(method))
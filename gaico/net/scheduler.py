@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+
+import gevent
+import heapq
+import math
+import random
+import time
+from collections import deque
+from gevent.event import Event
+from gaico.net import metrics
+
+"""
+    Global send scheduler shared by the workers of a sweep.
+"""
+
+
+class SendScheduler(object):
+    """ Paces the packets sent by many greenlets.
+
+    Greenlets call `wait` with the time they want to send their next packet.
+    A single timer wheel, driven by one greenlet, wakes them up when their
+    time has come, and a token bucket limits how many packets per second are
+    sent overall. Using one timer for all the workers also avoids thousands
+    of independent `sleep()` calls, and the driver only wakes up when the
+    next waiter is due (or the next token is available).
+    """
+
+    def __init__(self, rate=None, jitter=0, burst=None, tick=0.001, slots=4096):
+        """
+        :param rate: maximum number of packets per second (default: no limit)
+        :param jitter: start times are randomly spread over `jitter` seconds (default: 0)
+        :param burst: maximum number of packets sent at once (default: 10ms of packets)
+        :param tick: resolution of the timer wheel in seconds (default: 1ms)
+        :param slots: number of slots of the timer wheel (default: 4096)
+        """
+
+        self.rate = rate
+        self.jitter = jitter
+        self.tick = tick
+
+        if burst is None and rate is not None:
+            burst = max(1, rate * 0.01)
+        self.burst = burst
+        self.tokens = burst
+        self.last_refill = time.monotonic()
+
+        self.wheel = [[] for _ in range(slots)]
+        self.current_tick = int(self.last_refill / tick)
+        self.scheduled = 0
+        # heap of the ticks of the scheduled waiters, the first one is due next
+        self.due = []
+
+        # waiters that are due, but wait for a token
+        self.backlog = deque()
+
+        self.wakeup = Event()
+        self.driver = None
+        # when the driver wakes up next, `None` while it waits for a waiter
+        self.next_wakeup = None
+
+    def start_time(self):
+        """ Returns when a worker should send its first packet. """
+
+        now = time.monotonic()
+        if self.jitter:
+            return now + random.uniform(0, self.jitter)
+        return now
+
+    def wait(self, when):
+        """ Block until `when` (a `time.monotonic()` value) and a send token is available. """
+
+        now = time.monotonic()
+        if when <= now and not self.backlog and self._take_token(now):
+            # fast path: no need to go through the timer wheel
+            return
+
+        event = Event()
+        self._schedule(when, event)
+
+        if self.driver is None or self.driver.dead:
+            self.driver = gevent.spawn(self._run)
+        if self._wakes_up_later(when):
+            self.wakeup.set()
+
+        event.wait()
+        if metrics.enabled:
+            metrics.record('scheduler.lag', time.monotonic() - when)
+
+    def _schedule(self, when, event):
+        """ Put `event` in the timer wheel, to be set at `when` (or a little later). """
+
+        # never fire early: the slot of a tick starts at tick * self.tick
+        tick_index = max(math.ceil(when / self.tick), self.current_tick)
+        self.wheel[tick_index % len(self.wheel)].append((tick_index, event))
+        self.scheduled = self.scheduled + 1
+        heapq.heappush(self.due, tick_index)
+
+    def _wakes_up_later(self, when):
+        """ Returns `True` if the driver sleeps past `when`, and must be woken up. """
+
+        return self.next_wakeup is None or when < self.next_wakeup
+
+    def _take_token(self, now):
+        """ Consume a token from the bucket, returns `False` if the bucket is empty. """
+
+        if self.rate is None:
+            return True
+
+        elapsed = now - self.last_refill
+        self.last_refill = now
+        self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+
+        if self.tokens < 1:
+            return False
+
+        self.tokens = self.tokens - 1
+        return True
+
+    def _advance(self, now):
+        """ Move all the waiters due before `now` from the wheel to the backlog. """
+
+        current = int(now / self.tick)
+        slots = len(self.wheel)
+
+        # a full turn of the wheel visits every slot
+        first = max(self.current_tick, current - slots + 1)
+        for tick_index in range(first, current + 1):
+            slot = self.wheel[tick_index % slots]
+            if not slot:
+                continue
+            later = []
+            for entry in slot:
+                if entry[0] <= current:
+                    self.backlog.append(entry[1])
+                else:
+                    later.append(entry)
+            self.scheduled = self.scheduled - (len(slot) - len(later))
+            slot[:] = later
+
+        self.current_tick = current + 1
+        while self.due and self.due[0] <= current:
+            heapq.heappop(self.due)
+
+    def _next_delay(self, now):
+        """ Returns the time until the next waiter is due, or until the next token
+        for the backlog, or `None` if nothing is waiting.
+        """
+
+        delays = []
+        if self.due:
+            delays.append(self.due[0] * self.tick - now)
+        if self.backlog and self.rate is not None:
+            tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+            delays.append((1 - tokens) / self.rate)
+        elif self.backlog:
+            delays.append(0)
+
+        if not delays:
+            return None
+        return max(0, min(delays))
+
+    def _release(self, now):
+        """ Wake up the waiters that are due, as long as there are tokens. """
+
+        self._advance(now)
+        while self.backlog and self._take_token(now):
+            self.backlog.popleft().set()
+
+    def _run(self):
+        """ Drive the timer wheel, sleeping until the next waiter is due. """
+
+        while True:
+            now = time.monotonic()
+            delay = self._next_delay(now)
+            self.wakeup.clear()
+            if delay is None:
+                self.next_wakeup = None
+                self.wakeup.wait()
+                continue
+
+            # `wait` wakes the driver up early for a waiter due sooner
+            self.next_wakeup = now + delay
+            self.wakeup.wait(delay)
+            if metrics.enabled:
+                metrics.count('scheduler.wakeups')
+
+            self._release(time.monotonic())
+
+    def close(self):
+        """ Stop the driver greenlet. """
+
+        if self.driver is not None:
+            self.driver.kill()
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+import gevent
+import importlib
+import multiprocessing
+from gevent.socket import wait_read
+from gaico import GaicoException
+from gaico.net import metrics
+
+"""
+    Sharded execution of large sweeps over several processes.
+
+    A single gevent hub runs on a single core: past some tens of thousands of
+    targets, parsing the replies keeps that core busy, and the round trip
+    times include the time replies wait to be read. With `processes=N`,
+    `ping`, `arp_request` and `check_ports_state` split their targets in N
+    contiguous parts, run each part in its own process (its own hub, its own
+    sockets), and merge the results.
+
+    Replies are delivered to the right process:
+
+    - ping sockets (`dgram` transport) and TCP connects are demultiplexed by
+      the kernel, each process only receives the replies to its own sockets;
+    - raw ICMP sockets receive a copy of every echo reply, so each process
+      uses its own range of ICMP identifiers;
+    - SYN scans use a range of source ports per process, for the same reason;
+    - ARP sockets also receive every reply, and replies from hosts of other
+      processes are discarded, as they have no waiter.
+
+    `SO_REUSEPORT` does not help here: it balances TCP and UDP flows between
+    sockets bound to the same port, but ICMP and packet sockets have no port.
+
+    Processes are started with the `spawn` method, so that they do not
+    inherit the sockets and the greenlets of the calling process: like with
+    any `multiprocessing` code, the main module of a script must be guarded by
+    `if __name__ == '__main__':`.
+"""
+
+
+class ShardException(GaicoException):
+    """ Raised when a shard process exits without returning its results. """
+    pass
+
+
+def split(items, parts):
+    """ Returns `items` (a list or a range) split in `parts` contiguous slices of the same size.
+
+    The sizes differ by one item at most.
+    """
+
+    size = len(items)
+    return [items[i * size // parts:(i + 1) * size // parts] for i in range(parts)]
+
+
+def _modules():
+    """ Returns the `gaico.net.ping` and `gaico.net.scan` modules. """
+
+    # `gaico.net.ping` is also the name of the function
+    return importlib.import_module('gaico.net.ping'), importlib.import_module('gaico.net.scan')
+
+
+def _run_shard(connection, shard, shards, function, part, kwargs, ranges, collect_metrics):
+    """ Entry point of a shard process: call `function` and send back its result. """
+
+    # the replies to another process can be told apart from ours: each shard
+    # gets a part of the identifiers and source ports of the parent process
+    ping, scan = _modules()
+    identifiers, source_ports = ranges
+    ping.identifiers = split(identifiers, shards)[shard]
+    scan.source_ports = split(source_ports, shards)[shard]
+
+    if collect_metrics:
+        metrics.enable()
+
+    try:
+        result = function(part, **kwargs)
+    except Exception as e:
+        connection.send((False, e, None))
+    else:
+        connection.send((True, result, metrics.snapshot() if collect_metrics else None))
+    finally:
+        connection.close()
+
+
+def _receive(process, connection):
+    """ Wait for the result of a shard process, without blocking the hub.
+
+    Returns whether the shard succeeded, and its result or its exception.
+    """
+
+    wait_read(connection.fileno())
+    try:
+        success, result, values = connection.recv()
+    except EOFError:
+        process.join()
+        msg = "Shard process exited with code {} before sending its results."
+        return False, ShardException(msg.format(process.exitcode))
+
+    if values is not None:
+        metrics.merge(values)
+    return success, result
+
+
+def run_shards(function, parts, kwargs):
+    """ Call `function(part, **kwargs)` for each of `parts` in its own process.
+
+    Returns the results in the order of `parts`, or raises the first exception
+    raised by a shard. When metrics are enabled, the metrics of the shards are
+    added to the metrics of this process.
+    """
+
+    ping, scan = _modules()
+    ranges = (ping.identifiers, scan.source_ports)
+
+    context = multiprocessing.get_context('spawn')
+    shards = []
+    jobs = []
+    try:
+        for shard, part in enumerate(parts):
+            reader, writer = context.Pipe(duplex=False)
+            process = context.Process(target=_run_shard,
+                                      args=(writer, shard, len(parts), function, part, kwargs,
+                                            ranges, metrics.enabled),
+                                      daemon=True)
+            process.start()
+            writer.close()
+            shards.append((process, reader))
+
+        jobs = [gevent.spawn(_receive, process, reader) for process, reader in shards]
+        gevent.joinall(jobs)
+
+        results = []
+        for job in jobs:
+            success, result = job.get()
+            if not success:
+                raise result
+            results.append(result)
+        return results
+    finally:
+        gevent.killall(jobs)
+        for process, reader in shards:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+            reader.close()
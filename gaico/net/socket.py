@@ -1,20 +1,279 @@
 # -*- coding: utf-8 -*-
 
 import gevent
+import itertools
+import socket as system_socket
+import time
+from collections import OrderedDict
 from gevent import socket
+from gevent.event import AsyncResult
+from gevent.queue import Empty, Queue
+from gaico.net import metrics
 
 
-def getaddrinfo(hosts, port, family=0, socktype=0, proto=0, flags=0):
-    """ Wrapper arround gevent.socket.getaddrinfo to handle multiple hosts. """
+# which resolved addresses of a host are probed: the first one only (first),
+# all of them concurrently (all), or the first one to answer when tried one
+# after the other every RACE_DELAY seconds (race, happy eyeballs, RFC 8305)
+ADDRESSES_FIRST = 'first'
+ADDRESSES_ALL = 'all'
+ADDRESSES_RACE = 'race'
+
+# delay between two attempts of a race (connection attempt delay of RFC 8305)
+RACE_DELAY = 0.25
+
+# number of hosts resolved at once by `getaddrinfo_iter`
+CHUNK_SIZE = 1024
+
+
+def numeric_getaddrinfo(host, port, family=0, socktype=0, proto=0, flags=0):
+    """ Returns the address info of `host` if it is a literal IP address, else `None`.
+
+    Literal addresses are converted without any DNS query, thread, or cache.
+    """
+
+    if not isinstance(host, str):
+        return None
+
+    try:
+        return system_socket.getaddrinfo(host, port, family, socktype, proto,
+                                         flags | system_socket.AI_NUMERICHOST)
+    except system_socket.gaierror:
+        return None
+
+
+def resolver_lookup(host, port, family=0, socktype=0, proto=0, flags=0):
+    """ Query the system resolver (`gevent.socket.getaddrinfo`). """
+
+    if not metrics.enabled:
+        return socket.getaddrinfo(host, port, family, socktype, proto, flags)
+
+    with metrics.timed('resolver.lookup'):
+        return socket.getaddrinfo(host, port, family, socktype, proto, flags)
+
+
+class Resolver(object):
+    """ In-process cache for `gevent.socket.getaddrinfo`.
+
+    Results are kept `ttl` seconds, and failures `negative_ttl` seconds (the
+    system resolver does not give the TTL of the DNS records). At most
+    `maxsize` entries are kept, the least recently used are evicted first.
+    Concurrent lookups of the same entry are coalesced into a single query.
+    Misses are resolved by `lookup`, called with the arguments of
+    `getaddrinfo` (default: the system resolver, see `resolver_lookup`).
+    """
+
+    def __init__(self, ttl=60, negative_ttl=10, maxsize=10000, lookup=resolver_lookup):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.maxsize = maxsize
+        self.lookup = lookup
+
+        # (host, port, family, socktype, proto, flags) -> (expiration time, result)
+        self.cache = OrderedDict()
+        self.in_flight = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def getaddrinfo(self, host, port, family=0, socktype=0, proto=0, flags=0):
+        """ Same as `gevent.socket.getaddrinfo`, from the cache when possible. """
+
+        key = (host, port, family, socktype, proto, flags)
+
+        entry = self.cache.get(key)
+        if entry is not None:
+            expiration, result = entry
+            if expiration > time.monotonic():
+                self.hits = self.hits + 1
+                if metrics.enabled:
+                    metrics.count('resolver.hits')
+                self.cache.move_to_end(key)
+                if isinstance(result, Exception):
+                    raise result
+                return result
+            del self.cache[key]
+
+        pending = self.in_flight.get(key)
+        if pending is not None:
+            # someone is already resolving this entry
+            self.coalesced = self.coalesced + 1
+            return pending.get()
+
+        self.misses = self.misses + 1
+        if metrics.enabled:
+            metrics.count('resolver.misses')
+
+        pending = self.in_flight[key] = AsyncResult()
+        try:
+            result = self.lookup(host, port, family, socktype, proto, flags)
+        except Exception as e:
+            self._store(key, e, self.negative_ttl)
+            pending.set_exception(e)
+            raise
+        else:
+            self._store(key, result, self.ttl)
+            pending.set(result)
+            return result
+        finally:
+            del self.in_flight[key]
+            if not pending.ready():
+                # the greenlet was killed (or interrupted): the coalesced
+                # lookups must not wait forever, they fail without caching
+                pending.set_exception(socket.gaierror(socket.EAI_AGAIN,
+                                                      "Lookup interrupted"))
+
+    def _store(self, key, result, ttl):
+        """ Cache `result` for `ttl` seconds. """
+
+        if not ttl:
+            return
+
+        self.cache[key] = (time.monotonic() + ttl, result)
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.maxsize:
+            self.cache.popitem(last=False)
+            self.evictions = self.evictions + 1
+
+    def stats(self):
+        """ Returns the counters of the cache. """
+
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'evictions': self.evictions,
+            'size': len(self.cache),
+        }
+
+    def clear(self):
+        """ Remove all the entries from the cache. """
+
+        self.cache.clear()
+
+
+# cache shared by all the `gaico.net` functions
+default_resolver = Resolver()
+
+
+def getaddrinfo(hosts, port, family=0, socktype=0, proto=0, flags=0, resolver=default_resolver):
+    """ Wrapper arround gevent.socket.getaddrinfo to handle multiple hosts.
+
+    Literal IP addresses are converted directly. Other lookups go through
+    `resolver`, a `Resolver` caching the results (default: the cache shared
+    by all the `gaico.net` functions). Set `resolver` to `None` to always
+    query the system resolver.
+    """
+
+    lookup = resolver_lookup
+    if resolver is not None:
+        lookup = resolver.getaddrinfo
 
     def worker(host):
         try:
-            return socket.getaddrinfo(host, port, family, socktype, proto, flags)
+            return lookup(host, port, family, socktype, proto, flags)
         except Exception as e:
             return e
 
-    jobs = [gevent.spawn(worker, host) for host in hosts]
-    gevent.joinall(jobs)
-    results = [job.value for job in jobs]
+    results = {}
+    jobs = {}
+    for host in hosts:
+        addr_info = numeric_getaddrinfo(host, port, family, socktype, proto, flags)
+        if addr_info is not None:
+            results[host] = addr_info
+        elif host not in jobs:
+            jobs[host] = gevent.spawn(worker, host)
+    gevent.joinall(jobs.values())
+
+    for host, job in jobs.items():
+        results[host] = job.value
+
+    return results
+
+
+def getaddrinfo_iter(hosts, port, family=0, socktype=0, proto=0, flags=0,
+                     resolver=default_resolver, chunk_size=CHUNK_SIZE):
+    """ Same as `getaddrinfo`, but yields (host, result) tuples in the order of `hosts`.
+
+    `hosts` can be any iterable (a generator for instance): it is consumed
+    and resolved `chunk_size` hosts at a time, so that only a chunk of hosts
+    is in memory at once.
+    """
+
+    hosts = iter(hosts)
+    while True:
+        chunk = list(itertools.islice(hosts, chunk_size))
+        if not chunk:
+            return
+
+        results = getaddrinfo(chunk, port, family, socktype, proto, flags, resolver)
+        for host in chunk:
+            yield host, results[host]
+
+
+def sort_addresses(addresses_info):
+    """ Returns the distinct addresses of `addresses_info` (as returned by
+    `getaddrinfo`), alternating address families as recommended by RFC 8305.
+    """
+
+    families = {}
+    for addr_info in addresses_info:
+        addresses = families.setdefault(addr_info[0], {})
+        addresses.setdefault(addr_info[4][0], addr_info)
+
+    # the first family is the one preferred by the system resolver
+    queues = [list(addresses.values()) for addresses in families.values()]
+    sorted_addresses = []
+    while queues:
+        for addresses in queues:
+            sorted_addresses.append(addresses.pop(0))
+        queues = [addresses for addresses in queues if addresses]
+
+    return sorted_addresses
+
+
+def race(addresses_info, attempt, delay=RACE_DELAY):
+    """ Happy eyeballs: run `attempt` on each address until one succeeds.
+
+    A new attempt is started every `delay` seconds, or as soon as the
+    previous attempts failed. `attempt` is called with an address info and
+    returns a (success, value) tuple; the other attempts are stopped as soon
+    as one succeeds. An attempt raising an exception fails, with the
+    exception as value.
+
+    Returns the address info and the value of the successful attempt, or of
+    the first attempt if they all failed.
+    """
+
+    done = Queue()
+    pending = list(addresses_info)
+    jobs = []
+    failures = {}
+
+    def worker(addr_info):
+        try:
+            done.put((addr_info, attempt(addr_info)))
+        except Exception as e:
+            done.put((addr_info, (False, e)))
+
+    try:
+        jobs.append(gevent.spawn(worker, pending.pop(0)))
+        while len(failures) < len(jobs):
+            try:
+                addr_info, (success, value) = done.get(timeout=delay if pending else None)
+            except Empty:
+                pass
+            else:
+                if success:
+                    return addr_info, value
+                failures[addr_info[4][0]] = value
+
+            # the delay expired or an attempt failed: start the next one
+            if pending:
+                jobs.append(gevent.spawn(worker, pending.pop(0)))
+    finally:
+        gevent.killall(jobs, block=False)
 
-    return dict(zip(hosts, results))
+    first = addresses_info[0]
+    return first, failures[first[4][0]]
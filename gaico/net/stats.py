@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+
+import math
+from array import array
+
+"""
+    Streaming statistics of ping round trips, in constant memory per host.
+"""
+
+
+def update_jitter(jitter, previous_delay, delay):
+    """ Returns the smoothed mean deviation of consecutive delays, as defined for RTP (RFC 3550).
+
+    `jitter` is the previous estimate, or `None` for the first pair of delays.
+    """
+
+    deviation = abs(delay - previous_delay)
+    if jitter is None:
+        return deviation
+    return jitter + (deviation - jitter) / 16
+
+
+class LatencyHistogram(object):
+    """ Fixed-bucket (HDR-style) histogram of round trip times.
+
+    Delays are counted in microsecond buckets: values below 2 ** `precision`
+    have their own bucket, larger values share a bucket with values of the
+    same magnitude, each power of two being split in 2 ** (`precision` - 1)
+    buckets. The relative error of a percentile is thus at most
+    1 / 2 ** `precision` (3% by default), whatever the number of delays
+    recorded. Delays above `highest` seconds are counted in the last bucket.
+
+    Histograms with the same `precision` can be merged, to get percentiles
+    over several hosts or several runs.
+    """
+
+    def __init__(self, precision=5, highest=120):
+        """
+        :param precision: number of bits of each bucket value (default: 5)
+        :param highest: highest delay in seconds (default: 120)
+        """
+
+        self.precision = precision
+        self.half = 1 << (precision - 1)
+
+        highest_value = int(highest * 1000000)
+        self.highest_index = self._index(highest_value)
+
+        # grown up to the highest bucket used
+        self.counts = array('I')
+        self.count = 0
+        self.min = None
+        self.max = None
+
+    def _index(self, value):
+        """ Returns the index of the bucket of `value` (in microseconds). """
+
+        exponent = max(0, value.bit_length() - self.precision)
+        return exponent * self.half + (value >> exponent)
+
+    def _bounds(self, index):
+        """ Returns the lowest and the highest+1 values (in microseconds) of a bucket. """
+
+        if index < 2 * self.half:
+            return index, index + 1
+        exponent = index // self.half - 1
+        mantissa = index - exponent * self.half
+        return mantissa << exponent, (mantissa + 1) << exponent
+
+    def add(self, delay):
+        """ Record a `delay` in seconds. """
+
+        index = min(self._index(int(delay * 1000000)), self.highest_index)
+        if index >= len(self.counts):
+            self.counts.extend([0] * (index + 1 - len(self.counts)))
+        self.counts[index] = self.counts[index] + 1
+
+        self.count = self.count + 1
+        if self.min is None or delay < self.min:
+            self.min = delay
+        if self.max is None or delay > self.max:
+            self.max = delay
+
+    def merge(self, other):
+        """ Add the counts of the `other` histogram to this one, returns `self`. """
+
+        if other.precision != self.precision:
+            raise ValueError("Histograms with different precisions cannot be merged.")
+
+        if len(other.counts) > len(self.counts):
+            self.counts.extend([0] * (len(other.counts) - len(self.counts)))
+        for index, count in enumerate(other.counts):
+            if count:
+                self.counts[index] = self.counts[index] + count
+
+        self.count = self.count + other.count
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+
+        return self
+
+    def percentile(self, percent):
+        """ Returns the delay in seconds below which `percent` % of the delays are,
+        or `None` if the histogram is empty.
+        """
+
+        if not self.count:
+            return None
+
+        rank = max(1, math.ceil(percent * self.count / 100))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen = seen + count
+            if seen >= rank:
+                break
+
+        # middle of the bucket, within the recorded range
+        low, high = self._bounds(index)
+        value = (low + high) / 2 / 1000000
+        return min(max(value, self.min), self.max)
+
+    def buckets(self):
+        """ Yields (lowest delay, highest delay, count) for each non-empty bucket. """
+
+        for index, count in enumerate(self.counts):
+            if count:
+                low, high = self._bounds(index)
+                yield low / 1000000, high / 1000000, count
+
+
+class RollingStatistics(object):
+    """ Statistics of the last `window` ping round trips to a host.
+
+    Delays are kept in a ring buffer of `window` floats (NaN for a timeout),
+    so memory does not grow with the number of round trips. The jitter is
+    computed by `update_jitter`.
+    """
+
+    def __init__(self, window=100):
+        """
+        :param window: number of round trips used to compute the statistics (default: 100)
+        """
+
+        self.window = window
+        self.delays = array('d', [math.nan]) * window
+        self.position = 0
+        self.count = 0
+
+        self.last_delay = None
+        self.jitter = None
+
+    def add(self, delay):
+        """ Record a round trip: its `delay` in seconds, or `None` on timeout. """
+
+        self.delays[self.position] = math.nan if delay is None else delay
+        self.position = (self.position + 1) % self.window
+        if self.count < self.window:
+            self.count = self.count + 1
+
+        if delay is None:
+            return
+
+        if self.last_delay is not None:
+            self.jitter = update_jitter(self.jitter, self.last_delay, delay)
+        self.last_delay = delay
+
+    def result(self, host):
+        """ Returns the result dictionary of `ping` for `host`, plus the `jitter`. """
+
+        delays = [delay for delay in self.delays[:self.count] if not math.isnan(delay)]
+
+        percent_lost = None
+        if self.count:
+            percent_lost = 100 - (len(delays) * 100 / self.count)
+
+        minping = maxping = avgping = None
+        if delays:
+            minping = min(delays)
+            maxping = max(delays)
+            avgping = math.fsum(delays) / len(delays)
+
+        return {
+            'host': host,
+            'sent': self.count,
+            'received': len(delays),
+            'minping': minping,
+            'maxping': maxping,
+            'avgping': avgping,
+            'packet_loss': percent_lost,
+            'jitter': self.jitter,
+        }
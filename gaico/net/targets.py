@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+import ipaddress
+
+"""
+    Lazy expansion of CIDR blocks, IP ranges and port ranges.
+
+    Hosts can be given as:
+
+    - a hostname or a literal IP address: '192.0.2.1', 'example.com';
+    - a CIDR block: '192.0.2.0/24' (or an `ipaddress.ip_network`), expanded
+      to its usable hosts;
+    - an IP range: '192.0.2.10-192.0.2.20', or '192.0.2.10-20' (the last
+      byte, or the last group of an IPv6 address, is replaced); a range
+      ending before its first address raises a ValueError.
+
+    Ports can be given as integers, ranges ('1-1024', or `range` objects).
+"""
+
+
+def _network_hosts(network):
+    """ Yields the usable hosts of `network`, like `hosts()` on Python 3.8 or later.
+
+    A /32 (/128) is its single address, a /31 (/127) point-to-point link its
+    two addresses; Python 3.7 yields no host at all for them.
+    """
+
+    if network.num_addresses <= 2:
+        yield from network
+    else:
+        yield from network.hosts()
+
+
+def _parse_range(host):
+    """ Returns the first and last addresses of the range `host`, or `None`. """
+
+    first, separator, last = host.partition('-')
+    if not separator:
+        return None
+
+    try:
+        first = ipaddress.ip_address(first)
+    except ValueError:
+        return None
+
+    try:
+        last = ipaddress.ip_address(last)
+    except ValueError:
+        # short form, only the last byte (or group) of the first address changes
+        separator = '.' if first.version == 4 else ':'
+        prefix = str(first).rpartition(separator)[0]
+        try:
+            last = ipaddress.ip_address(prefix + separator + last)
+        except ValueError:
+            return None
+
+    if last.version != first.version:
+        return None
+    if last < first:
+        raise ValueError("Invalid range, {} is before {}: {}".format(last, first, host))
+
+    return first, last
+
+
+def expand_host(host):
+    """ Yields the hosts of `host`: the addresses of a CIDR block or a range, else `host` itself.
+
+    Addresses are yielded as strings, one at a time.
+    """
+
+    if isinstance(host, (ipaddress.IPv4Network, ipaddress.IPv6Network)):
+        for address in _network_hosts(host):
+            yield str(address)
+        return
+
+    if isinstance(host, str):
+        if '/' in host:
+            try:
+                network = ipaddress.ip_network(host, strict=False)
+            except ValueError:
+                pass
+            else:
+                for address in _network_hosts(network):
+                    yield str(address)
+                return
+
+        elif '-' in host:
+            bounds = _parse_range(host)
+            if bounds is not None:
+                first, last = bounds
+                for offset in range(int(last) - int(first) + 1):
+                    yield str(first + offset)
+                return
+
+    yield host
+
+
+def expand_hosts(hosts):
+    """ Yields the hosts of each item of `hosts` (see `expand_host`), lazily. """
+
+    for host in hosts:
+        yield from expand_host(host)
+
+
+def expand_ports(ports):
+    """ Yields the ports of `ports`: integers, 'first-last' strings or ranges. """
+
+    for port in ports:
+        if isinstance(port, range):
+            yield from port
+        elif isinstance(port, str):
+            first, separator, last = port.partition('-')
+            if separator:
+                yield from range(int(first), int(last) + 1)
+            else:
+                yield int(port)
+        else:
+            yield port
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+
+import gevent
+import socket
+import time
+
+"""
+    Adaptive timeouts, from the round trip times observed (RFC 6298).
+
+    With a fixed timeout, every probe to a dead host waits for the whole
+    timeout. An `AdaptiveTimeout` keeps a smoothed round trip time (SRTT) and
+    its variation (RTTVAR) per host, and per subnet: a probe times out after
+    SRTT + k * RTTVAR of its host, or of its subnet for a host that never
+    answered, but never before `min_timeout`, and never after the timeout
+    given by the user.
+
+    The timeout of a probe is checked again while it waits: the probes sent
+    before the first replies came back (the first wave of a sweep) also
+    time out early, as soon as their subnet has an estimate.
+
+    `ping`, `arp_request` and `check_ports_state` take an `adaptive`
+    parameter: `True` for estimates over a single call, or an
+    `AdaptiveTimeout` shared by several calls.
+"""
+
+# gains of the estimators (RFC 6298)
+ALPHA = 1 / 8
+BETA = 1 / 4
+
+
+class RTTEstimator(object):
+    """ Smoothed round trip time and round trip time variation (RFC 6298). """
+
+    __slots__ = ('srtt', 'rttvar')
+
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+
+    def add(self, rtt):
+        """ Update the estimates with a round trip time `rtt` (in seconds). """
+
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - BETA) * self.rttvar + BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - ALPHA) * self.srtt + ALPHA * rtt
+
+    def timeout(self, k):
+        """ Returns SRTT + k * RTTVAR. """
+
+        return self.srtt + k * self.rttvar
+
+
+class AdaptiveTimeout(object):
+    """ Round trip time estimators per host and per subnet, giving the timeout of each probe.
+
+    At most `maxsize` hosts (and subnets) are tracked, the oldest are
+    forgotten first.
+    """
+
+    def __init__(self, k=4, min_timeout=1, prefix=24, prefix6=64, maxsize=65536):
+        """
+        :param k: weight of the round trip time variation (default: 4)
+        :param min_timeout: lower bound of the timeouts in seconds (default: 1)
+        :param prefix: length (in bits, rounded down to a byte) of the IPv4
+        subnets (default: 24)
+        :param prefix6: length (in bits, rounded down to a byte) of the IPv6
+        subnets (default: 64)
+        :param maxsize: maximum number of hosts tracked (default: 65536)
+        """
+
+        self.k = k
+        self.min_timeout = min_timeout
+        self.prefix = prefix // 8
+        self.prefix6 = prefix6 // 8
+        self.maxsize = maxsize
+
+        # IP address -> RTTEstimator, (subnet) bytes -> RTTEstimator
+        self.hosts = {}
+        self.subnets = {}
+
+    def subnet(self, address):
+        """ Returns the key of the subnet of `address` (an IP address string). """
+
+        # link-local IPv6 addresses may come with their scope
+        address = address.partition('%')[0]
+        if ':' in address:
+            return socket.inet_pton(socket.AF_INET6, address)[:self.prefix6]
+        return socket.inet_pton(socket.AF_INET, address)[:self.prefix]
+
+    def add(self, address, rtt):
+        """ Record a round trip time `rtt` (in seconds) of `address`. """
+
+        for estimators, key in ((self.hosts, address), (self.subnets, self.subnet(address))):
+            estimator = estimators.get(key)
+            if estimator is None:
+                if len(estimators) >= self.maxsize:
+                    del estimators[next(iter(estimators))]
+                estimator = estimators[key] = RTTEstimator()
+            estimator.add(rtt)
+
+    def timeout(self, address, timeout):
+        """ Returns the current timeout of a probe to `address`, at most `timeout`. """
+
+        estimator = self.hosts.get(address)
+        if estimator is None:
+            estimator = self.subnets.get(self.subnet(address))
+            if estimator is None:
+                # nothing known yet
+                return timeout
+
+        return min(timeout, max(self.min_timeout, estimator.timeout(self.k)))
+
+    def check_after(self, address, elapsed, timeout):
+        """ Returns how long a probe to `address` waiting for `elapsed` seconds
+        should wait before checking its timeout again, or 0 if it timed out.
+
+        The estimates can go down while a probe waits: the wait is split in
+        steps growing with the time already waited (half of it), so that a
+        probe does not wait more than 1.5 times its final timeout.
+        """
+
+        limit = self.timeout(address, timeout)
+        if elapsed >= limit:
+            return 0
+        return min(limit - elapsed, max(self.min_timeout, elapsed / 2))
+
+    def stats(self):
+        """ Returns the number of hosts and subnets tracked. """
+
+        return {
+            'hosts': len(self.hosts),
+            'subnets': len(self.subnets),
+        }
+
+
+def get_adaptive(adaptive):
+    """ Returns the `AdaptiveTimeout` of an `adaptive` parameter (`None`,
+    `False`, `True` or an `AdaptiveTimeout`), or `None`.
+    """
+
+    if adaptive is True:
+        return AdaptiveTimeout()
+    return adaptive or None
+
+
+def wait(waiter, address, timeout, adaptive):
+    """ Returns the value of `waiter` (a `gevent.event.AsyncResult`) for a
+    probe to `address`, or raises `gevent.Timeout` once the probe timed out.
+
+    Without `adaptive`, this is `waiter.get(timeout=timeout)`.
+    """
+
+    if adaptive is None:
+        return waiter.get(timeout=timeout)
+
+    started = time.monotonic()
+    while True:
+        step = adaptive.check_after(address, time.monotonic() - started, timeout)
+        if step <= 0:
+            raise gevent.Timeout()
+        try:
+            return waiter.get(timeout=step)
+        except gevent.Timeout:
+            pass
@@ -0,0 +1,379 @@
+# -*- coding: utf-8 -*-
+
+import gevent
+import importlib
+import itertools
+import struct
+import time
+from gevent import socket
+from gevent.event import AsyncResult
+from gevent.pool import Pool
+from gaico.net import metrics
+from gaico.net.bpf import attach_filter, icmp_error_filter
+from gaico.net.ping import (ICMPV4_ECHO_REPLY, ICMPV4_ECHO_REQUEST, ICMPV6_ECHO_REPLY,
+                            ICMPV6_ECHO_REQUEST, RECEIVE_BUFFER_SIZE, TRANSPORT_RAW,
+                            ICMPEngine, PingPacket)
+from gaico.net.scheduler import SendScheduler
+from gaico.net.socket import default_resolver, getaddrinfo_iter
+from gaico.net.targets import expand_hosts
+
+"""
+    Traceroute of many hosts at once, with ICMP echo requests.
+
+    The probes of every hop of every host are sent together, each with its
+    own TTL (hop limit), so that the paths of thousands of hosts are found
+    in about the time of the slowest round trip. The routers answer a probe
+    whose TTL expired with an ICMP time exceeded message, which quotes the
+    beginning of the probe: its (identifier, sequence, destination) gives
+    the probe it answers, whatever the router.
+
+    Probes are Paris traceroute probes: load balancers choose a path from
+    the fields of the first words of the packet (addresses, and the ICMP
+    type, code and checksum), and all the probes to a host have the same
+    identifier and the same checksum (the payload compensates the sequence,
+    which encodes the TTL), so that they all follow the same path.
+
+    Routers rate limit their ICMP messages: with many hosts behind the same
+    first hops, `rate` spreads the probes over time.
+
+    Requires root: ICMP error messages are only delivered to raw sockets.
+"""
+
+ICMPV4_DEST_UNREACHABLE = 3
+ICMPV4_TIME_EXCEEDED = 11
+ICMPV6_DEST_UNREACHABLE = 1
+ICMPV6_TIME_EXCEEDED = 3
+
+# offsets in the quoted IPv4 and IPv6 headers of an error
+IPV4_PROTOCOL_OFFSET = 9
+IPV4_DESTINATION_OFFSET = 16
+IPV6_NEXT_HEADER_OFFSET = 6
+IPV6_DESTINATION_OFFSET = 24
+IPV6_HEADER_SIZE = 40
+
+# the sequence of a probe is (attempt << 8 | TTL)
+MAX_HOPS = 255
+MAX_COUNT = 256
+
+# ICMP header, and the word compensating the sequence in the checksum
+PROBE_HEADER_SIZE = 10
+
+
+def build_probe(identifier, sequence, packet_size, ipv6=False):
+    """ Returns an echo request whose checksum does not depend on `sequence`.
+
+    The payload starts with the one's complement of the sequence: their sum
+    is constant, and so is the checksum.
+    """
+
+    payload = struct.pack("!H", 0xFFFF - sequence)
+    payload = payload + ((packet_size - 8) - len(payload)) * b"Q"
+    return PingPacket(identifier, sequence, payload, ipv6).pack()
+
+
+class TracerouteEngine(ICMPEngine):
+    """ ICMP engine sending TTL-limited echo requests, and matching the ICMP
+    time exceeded and destination unreachable messages to their probes.
+
+    The TTL is given for each probe (ancillary data of `sendmsg`), all the
+    probes go through a single raw socket.
+    """
+
+    def __init__(self, family):
+        super(TracerouteEngine, self).__init__(family, TRANSPORT_RAW)
+
+        if self.ipv6:
+            self.reply_type = ICMPV6_ECHO_REPLY
+            self.request_type = ICMPV6_ECHO_REQUEST
+            self.error_types = (ICMPV6_TIME_EXCEEDED, ICMPV6_DEST_UNREACHABLE)
+            self.ttl_option = (socket.IPPROTO_IPV6, socket.IPV6_HOPLIMIT)
+        else:
+            self.reply_type = ICMPV4_ECHO_REPLY
+            self.request_type = ICMPV4_ECHO_REQUEST
+            self.error_types = (ICMPV4_TIME_EXCEEDED, ICMPV4_DEST_UNREACHABLE)
+            self.ttl_option = (socket.IPPROTO_IP, socket.IP_TTL)
+
+        # each traced host takes the next identifier: the same address can
+        # be traced several times at once without mixing the answers
+        self.counter = itertools.count()
+
+    def _open_socket(self, transport):
+        """ Create the raw socket used to send probes and receive the replies and errors. """
+
+        icmp = socket.getprotobyname('icmp')
+        error_types = (ICMPV4_TIME_EXCEEDED, ICMPV4_DEST_UNREACHABLE)
+        reply_type = ICMPV4_ECHO_REPLY
+        if self.ipv6:
+            icmp = socket.getprotobyname('ipv6-icmp')
+            error_types = (ICMPV6_TIME_EXCEEDED, ICMPV6_DEST_UNREACHABLE)
+            reply_type = ICMPV6_ECHO_REPLY
+
+        try:
+            my_socket = self.socket_module.socket(self.family, socket.SOCK_RAW, icmp)
+        except PermissionError:
+            msg = "Traceroutes can only be done from processes running as root."
+            raise PermissionError(msg)
+
+        # the identifiers of the pings (`gaico.net.ping` is also the name of the function)
+        self.identifiers = importlib.import_module('gaico.net.ping').identifiers
+        attach_filter(my_socket, icmp_error_filter(reply_type, error_types, self.identifiers,
+                                                   not self.ipv6))
+        my_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER_SIZE)
+
+        if metrics.enabled:
+            metrics.count('icmp.socket_opens')
+        return my_socket, TRANSPORT_RAW
+
+    def pick_identifier(self):
+        """ Returns the identifier of the probes of a new traced host. """
+
+        return self.identifiers[next(self.counter) % len(self.identifiers)]
+
+    def send(self, addr_info, identifier, ttl, attempt, packet_size):
+        """ Send a probe with the given `ttl` and return the key and the waiter of its answer. """
+
+        sequence = attempt << 8 | ttl
+        key = (identifier, sequence, addr_info[4][0])
+        waiter = AsyncResult()
+        self.waiters[key] = (waiter, time.monotonic_ns())
+
+        if self.reader is None or self.reader.dead:
+            self.reader = gevent.spawn(self._read_loop)
+
+        packet = build_probe(identifier, sequence, packet_size, self.ipv6)
+        level, option = self.ttl_option
+        try:
+            self.socket.sendmsg([packet], [(level, option, struct.pack('i', ttl))], 0,
+                                addr_info[4])
+        except OSError:
+            self.waiters.pop(key, None)
+            raise
+        if metrics.enabled:
+            metrics.count('icmp.sent')
+
+        return key, waiter
+
+    def wait(self, key, waiter, timeout):
+        """ Returns the (address, delay, ICMP type, ICMP code) of the answer, or
+        `None` on timeout.
+        """
+
+        try:
+            return waiter.get(timeout=timeout)
+        except gevent.Timeout:
+            if metrics.enabled:
+                metrics.count('icmp.timeouts')
+            return None
+        finally:
+            self.waiters.pop(key, None)
+            if not self.waiters:
+                self.stop_reading()
+
+    def cancel(self, keys):
+        """ Forget the probes of `keys`, whose answers are no longer awaited. """
+
+        for key in keys:
+            self.waiters.pop(key, None)
+        if not self.waiters:
+            self.stop_reading()
+
+    def dispatch(self, received_packet, addr, time_received):
+        """ Parse one packet and wake up the probe it answers (if any). """
+
+        if metrics.enabled:
+            metrics.count('icmp.received')
+        if self.filter_counter is not None:
+            self.filter_counter.received = self.filter_counter.received + 1
+
+        if not self.ipv6:
+            # IP header is included only with IPv4 raw sockets (remove it)
+            header_length = (received_packet[0] & 0x0F) * 4
+            received_packet = received_packet[header_length:]
+
+        key = None
+        if len(received_packet) >= 8 and received_packet[0] == self.reply_type:
+            # the host itself
+            identifier, sequence = struct.unpack("!HH", received_packet[4:8])
+            key = (identifier, sequence, addr[0])
+        elif len(received_packet) >= 8 and received_packet[0] in self.error_types:
+            # a router (or the host), quoting our probe
+            key = self.parse_quote(received_packet[8:])
+
+        entry = None
+        if key is not None:
+            entry = self.waiters.pop(key, None)
+        if entry is None:
+            # late answer, our own requests, or an error about other packets
+            if metrics.enabled:
+                metrics.count('icmp.discarded')
+            return
+
+        waiter, time_sent = entry
+        waiter.set((addr[0], (time_received - time_sent) / 1e9, received_packet[0],
+                    received_packet[1]))
+
+    def parse_quote(self, quote):
+        """ Returns the (identifier, sequence, destination) of the echo request
+        quoted by an ICMP error, or `None`.
+        """
+
+        if self.ipv6:
+            if len(quote) < IPV6_HEADER_SIZE + 8 or \
+                    quote[IPV6_NEXT_HEADER_OFFSET] != socket.IPPROTO_ICMPV6:
+                return None
+            destination = quote[IPV6_DESTINATION_OFFSET:IPV6_DESTINATION_OFFSET + 16]
+            destination = socket.inet_ntop(socket.AF_INET6, destination)
+            request = quote[IPV6_HEADER_SIZE:]
+        else:
+            if len(quote) < 20 or quote[IPV4_PROTOCOL_OFFSET] != socket.IPPROTO_ICMP:
+                return None
+            destination = quote[IPV4_DESTINATION_OFFSET:IPV4_DESTINATION_OFFSET + 4]
+            destination = socket.inet_ntoa(destination)
+            request = quote[(quote[0] & 0x0F) * 4:]
+
+        if len(request) < 8 or request[0] != self.request_type:
+            return None
+        identifier, sequence = struct.unpack("!HH", request[4:8])
+        return identifier, sequence, destination
+
+
+_engines = {}
+
+
+def get_engine(family):
+    """ Returns the shared `TracerouteEngine` of the address family. """
+
+    engine = _engines.get(family)
+    if engine is None:
+        engine = _engines[family] = TracerouteEngine(family)
+    return engine
+
+
+def close_engines():
+    """ Close all the shared traceroute engines. """
+
+    while _engines:
+        _, engine = _engines.popitem()
+        engine.close()
+
+
+def traceroute_worker(addr_info, max_hops, first_hop, count, timeout, packet_size,
+                      scheduler=None):
+    """ Send the probes of all the hops of a host at once, and returns its path. """
+
+    own_scheduler = scheduler is None
+    if own_scheduler:
+        scheduler = SendScheduler()
+
+    engine = get_engine(addr_info[0])
+    address = addr_info[4][0]
+    # the same identifier, and so the same flow, for all the probes of a host
+    identifier = engine.pick_identifier()
+
+    hops = [{'ttl': ttl, 'address': None, 'delays': [None] * count}
+            for ttl in range(first_hop, max_hops + 1)]
+    reached = False
+    last_ttl = max_hops
+
+    probes = []
+    try:
+        for attempt in range(count):
+            for ttl in range(first_hop, max_hops + 1):
+                scheduler.wait(time.monotonic())
+                probes.append((ttl, attempt) + engine.send(addr_info, identifier, ttl, attempt,
+                                                           packet_size))
+
+        # every probe is in flight: they share the same deadline
+        deadline = time.monotonic() + timeout
+        for ttl, attempt, key, waiter in probes:
+            answer = engine.wait(key, waiter, max(0, deadline - time.monotonic()))
+            if answer is None:
+                continue
+
+            hop_address, delay, message_type, code = answer
+            hop = hops[ttl - first_hop]
+            hop['delays'][attempt] = delay
+            if hop['address'] is None:
+                hop['address'] = hop_address
+
+            if message_type == engine.reply_type:
+                reached = True
+                last_ttl = min(last_ttl, ttl)
+            elif message_type == engine.error_types[1]:
+                # no route beyond this hop, or the host did not take the probe
+                hop['unreachable'] = code
+                last_ttl = min(last_ttl, ttl)
+    finally:
+        # a failed send, or a killed worker, leaves probes in flight
+        engine.cancel([key for _, _, key, _ in probes])
+        if own_scheduler:
+            scheduler.close()
+
+    return {
+        'host': address,
+        'reached': reached,
+        'hops': hops[:last_ttl - first_hop + 1],
+    }
+
+
+def traceroute(hosts, max_hops=30, first_hop=1, count=1, timeout=2, packet_size=64, rate=None,
+               resolver=default_resolver, concurrency=None):
+    """ Find the path to many hosts at once (requires root).
+
+    :param hosts: hosts to trace (ip addresses, hostnames, CIDR blocks or
+    ranges, see `gaico.net.targets`)
+    :param max_hops: TTL (hop limit) of the farthest probe (default: 30)
+    :param first_hop: TTL of the nearest probe (default: 1)
+    :param count: number of probes per hop (default: 1)
+    :param timeout: timeout in second to wait for the answers, once the probes
+    of a host are sent (default: 2)
+    :param packet_size: the number of bytes to send (default: 64)
+    :param rate: maximum number of probes per second sent to all the hosts
+    (default: no limit)
+    :param resolver: `gaico.net.socket.Resolver` used to resolve the hosts, or
+    `None` to bypass the cache (default: the shared resolver cache)
+    :param concurrency: maximum number of hosts traced at once (default: no limit)
+
+    Returns an Exception or a dictionary for each host with the following fields:
+        `host`: *string*; the IP address traced
+        `reached`: *bool*; `True` if the host answered
+        `hops`: *list*; a dictionary for each TTL, up to the host (or up to a
+        destination unreachable message), with the following fields:
+            `ttl`: *int*; the TTL of the probes
+            `address`: *string*; the IP address that answered, or `None`
+            `delays`: *list*; the round trip time in seconds of each probe,
+            or `None` if it timed out
+            `unreachable`: *int*; the code of the destination unreachable
+            message answered by this hop (only when there is one)
+    """
+
+    if not 1 <= first_hop <= max_hops <= MAX_HOPS:
+        raise ValueError("Hops must be between 1 and {}.".format(MAX_HOPS))
+    if not 1 <= count <= MAX_COUNT:
+        raise ValueError("Count must be between 1 and {}.".format(MAX_COUNT))
+    if packet_size < PROBE_HEADER_SIZE:
+        raise ValueError("Packet size must be at least {}.".format(PROBE_HEADER_SIZE))
+
+    scheduler = SendScheduler(rate)
+    results = {}
+
+    def worker(host, addr_info):
+        try:
+            results[host] = traceroute_worker(addr_info, max_hops, first_hop, count, timeout,
+                                              packet_size, scheduler)
+        except Exception as e:
+            results[host] = e
+
+    jobs = Pool(concurrency)
+    try:
+        for host, addr_info in getaddrinfo_iter(expand_hosts(hosts), None, resolver=resolver):
+            if addr_info is None or isinstance(addr_info, Exception):
+                results[host] = addr_info
+            else:
+                jobs.spawn(worker, host, addr_info[0])
+        jobs.join()
+    finally:
+        jobs.kill()
+        scheduler.close()
+
+    return results
@@ -25,7 +25,9 @@ setup(
     packages=find_packages(),
     include_package_data=True,
     zip_safe=False,
+    python_requires='>=3.7',
     install_requires=['gevent>=1.1.0'],
+    extras_require={'numpy': ['numpy']},
     test_suite="tests",
     classifiers=[
         'Development Status :: 4 - Beta',
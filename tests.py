@@ -6,8 +6,47 @@
 
 """
 
+import asyncio
+import gc
+import gevent
+import ipaddress
+import os
+import socket
+import struct
+import tempfile
+import time
 import unittest
-from gaico.net.ping import PingPacket, ICMPV4_ECHO_REQUEST, ICMPV6_ECHO_REQUEST
+from gevent import socket as gevent_socket
+from gevent.event import AsyncResult
+from gevent.server import StreamServer
+from gaico.bench.responder import SimulatedNetwork, answer
+from gaico.net import aio, check_ports_state, metrics, ping, ping_iter
+from gaico.net.arp import (ARPTimeoutException, NeighborCache, _engines as arp_engines,
+                           arp_request, build_request, close_engines, get_engine, parse_frame,
+                           parse_reply)
+from gaico.net.batch import BatchReceiver, BatchSender, decode_address, encode_address
+from gaico.net.bpf import (BPF_RET, BPF_K, ACCEPT, DROP, FilterCounter, PacketCounter,
+                           arp_reply_filter, attach_filter, icmp_error_filter, stmt)
+from gaico.net.checks import FD_RESERVE, _check_ports_greenlets, _interleave, available_fds
+from gaico.net.results import PingResults
+from gaico.net.scan import PollScanner
+from gaico.net.scheduler import SendScheduler
+from gaico.net.shard import split
+from gaico.net.socket import Resolver, getaddrinfo, getaddrinfo_iter, race, sort_addresses
+from gaico.net.stats import LatencyHistogram, RollingStatistics
+from gaico.net.targets import expand_hosts, expand_ports
+from gaico.net.traceroute import (TracerouteEngine, build_probe,
+                                  close_engines as close_traceroute_engines,
+                                  get_engine as get_traceroute_engine, traceroute,
+                                  traceroute_worker)
+from gaico.net.timeouts import AdaptiveTimeout, RTTEstimator, get_adaptive, wait
+from gaico.net.monitor import PingMonitor
+from gaico.net.probes import BannerProbe, HTTPProbe, ProbeException, read
+from gaico.net.ping import (ICMPEngine, PingPacket, PacketTemplate, PingStatistics,
+                            _engines as icmp_engines, close_engines as close_icmp_engines,
+                            get_engine as get_icmp_engine, get_template, internet_checksum,
+                            pick_identifier, ICMPV4_ECHO_REQUEST, ICMPV6_ECHO_REQUEST,
+                            TRANSPORT_DGRAM, TRANSPORT_RAW)
 
 
 class PingPacketIPV4TestCase(unittest.TestCase):
@@ -19,15 +58,15 @@ class PingPacketIPV4TestCase(unittest.TestCase):
         self.sequence = 7
         self.checksum = 0x7044
         self.ipv6 = False
-        self.payload = "\x41\xd5\x19\x96\xb5\xb6\xc3\xad\x51\x51\x51\x51\x51\x51\x51\x51" \
-                       "\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51" \
-                       "\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51"
+        self.payload = b"\x41\xd5\x19\x96\xb5\xb6\xc3\xad\x51\x51\x51\x51\x51\x51\x51\x51" \
+                       b"\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51" \
+                       b"\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51"
         self.pp = PingPacket(self.identifier, self.sequence, self.payload, self.ipv6)
 
-        final_packet = "\x08\x00\x70\x44\x58\x8a\x00\x07\x41\xd5\x19\x96\xb5\xb6\xc3\xad" \
-                       "\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51" \
-                       "\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51" \
-                       "\x51\x51\x51\x51\x51\x51\x51\x51"
+        final_packet = b"\x08\x00\x70\x44\x58\x8a\x00\x07\x41\xd5\x19\x96\xb5\xb6\xc3\xad" \
+                       b"\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51" \
+                       b"\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51" \
+                       b"\x51\x51\x51\x51\x51\x51\x51\x51"
         self.final_packet = final_packet
 
     def test_init(self):
@@ -66,18 +105,1391 @@ class PingPacketIPV6TestCase(PingPacketIPV4TestCase):
         self.sequence = 9
         self.checksum = 0  # the checksum is calculated by the IPv6 stack
         self.ipv6 = True
-        self.payload = "\x41\xd5\x1b\x67\x5e\xd1\x9f\x5a\x51\x51\x51\x51\x51\x51\x51\x51" \
-                       "\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51" \
-                       "\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51" \
-                       "\x51\x51\x51\x51\x51\x51\x51\x51"
+        self.payload = b"\x41\xd5\x1b\x67\x5e\xd1\x9f\x5a\x51\x51\x51\x51\x51\x51\x51\x51" \
+                       b"\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51" \
+                       b"\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51" \
+                       b"\x51\x51\x51\x51\x51\x51\x51\x51"
         self.pp = PingPacket(self.identifier, self.sequence, self.payload, self.ipv6)
 
-        final_packet = "\x80\x00\x00\x00\xda\x25\x00\x09\x41\xd5\x1b\x67\x5e\xd1\x9f\x5a" \
-                       "\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51" \
-                       "\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51" \
-                       "\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51"
+        final_packet = b"\x80\x00\x00\x00\xda\x25\x00\x09\x41\xd5\x1b\x67\x5e\xd1\x9f\x5a" \
+                       b"\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51" \
+                       b"\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51" \
+                       b"\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51\x51"
         self.final_packet = final_packet
 
 
+class InternetChecksumTestCase(unittest.TestCase):
+    """ Tests for the `gaico.net.ping.internet_checksum` function. """
+
+    def reference_checksum(self, data):
+        if len(data) % 2 == 1:
+            data = data + b'\0'
+        checksum = sum(int.from_bytes(data[i:i+2], 'big') for i in range(0, len(data), 2))
+        checksum = (checksum >> 16) + (checksum & 0xFFFF)
+        checksum = checksum + (checksum >> 16)
+        return ~checksum & 0xFFFF
+
+    def test_known_values(self):
+        self.assertEqual(internet_checksum(b''), 0xFFFF)
+        self.assertEqual(internet_checksum(b'\x00\x00\x00\x00'), 0xFFFF)
+        self.assertEqual(internet_checksum(b'\xff\xff'), 0)
+        self.assertEqual(internet_checksum(b'\x12\x34\xed\xcb'), 0)
+
+    def test_odd_length(self):
+        data = b'\x01\x02\x03'
+        self.assertEqual(internet_checksum(data), self.reference_checksum(data))
+
+    def test_reference(self):
+        for data in (bytes(range(256)), b'\x08\x00' * 33, b'\xfe\xdc\xba\x98\x76'):
+            self.assertEqual(internet_checksum(data), self.reference_checksum(data))
+
+
+class PacketTemplateTestCase(unittest.TestCase):
+    """ Tests for the `gaico.net.ping.PacketTemplate` class. """
+
+    def test_build_ipv4(self):
+        for packet_size in (16, 18, 64, 65, 1500):
+            template = PacketTemplate(22666, packet_size)
+            for sequence, timestamp in ((0, 0), (7, 1446573868841600000), (0xFFFF, 2 ** 64 - 1)):
+                packet = template.build(sequence, timestamp)
+                expected = PingPacket(22666, sequence, packet[8:]).pack()
+                self.assertEqual(packet, expected)
+                self.assertEqual(internet_checksum(packet), 0)
+
+    def test_build_without_checksum(self):
+        templates = (PacketTemplate(0xda25, 64, ipv6=True), PacketTemplate(1, 64, checksum=False))
+        for template in templates:
+            packet = template.build(9, 1446573868841600000)
+            self.assertEqual(packet[2:4], b'\x00\x00')
+            self.assertEqual(PingPacket.fromdata(packet).sequence, 9)
+
+    def test_payload(self):
+        packet = PacketTemplate(22666, 64).build(7, 1446573868841600000)
+        self.assertEqual(len(packet), 64)
+        self.assertEqual(packet[8:18], b'\x14\x13CD\xf9\xaa\x84\x00X\x8a')
+        self.assertEqual(packet[18:], b'Q' * 46)
+
+    def test_get_template(self):
+        self.assertIs(get_template(22666, 64), get_template(22666, 64))
+        self.assertIsNot(get_template(22666, 64), get_template(22666, 64, checksum=False))
+
+
+class PingTestCase(unittest.TestCase):
+    """ Tests for the `gaico.net.ping` function on the loopback. """
+
+    def setUp(self):
+        close_icmp_engines()
+
+    def tearDown(self):
+        close_icmp_engines()
+
+    def test_overlapping(self):
+        hosts = [['127.0.0.2', '127.0.0.3'], ['127.0.0.4', '127.0.0.5']]
+        jobs = [gevent.spawn(ping, part, count=3, interval=0.01, timeout=1) for part in hosts]
+        gevent.joinall(jobs, raise_error=True)
+
+        # both calls share the engine, and each reply reaches its own ping
+        self.assertEqual(len(icmp_engines), 1)
+        engine = get_icmp_engine(socket.AF_INET)
+        self.assertIs(next(iter(icmp_engines.values())), engine)
+        self.assertEqual(engine.waiters, {})
+        for part, job in zip(hosts, jobs):
+            self.assertEqual(sorted(job.value), part)
+            for host, result in job.value.items():
+                self.assertEqual(result['host'], host)
+                self.assertEqual((result['sent'], result['received']), (3, 3))
+
+    def test_same_key(self):
+        engine = get_icmp_engine(socket.AF_INET)
+        addr_info = socket.getaddrinfo('127.0.0.1', None, socket.AF_INET)[0]
+        identifier = pick_identifier(0)
+
+        # each reply wakes up one of the pings waiting for the same key
+        jobs = [gevent.spawn(engine.ping, addr_info, identifier, 7, 1, 64) for _ in range(2)]
+        gevent.joinall(jobs, raise_error=True)
+        for job in jobs:
+            self.assertIsNotNone(job.value)
+        self.assertEqual(engine.waiters, {})
+        self.assertIsNone(engine.reader)
+
+    def test_reader_stopped(self):
+        engine = get_icmp_engine(socket.AF_INET)
+        addr_info = socket.getaddrinfo('0.0.0.0', None, socket.AF_INET)[0]
+
+        # the reader does not wait for the reply once the ping timed out
+        self.assertIsNone(engine.ping(addr_info, pick_identifier(0), 1, 0.05, 64))
+        self.assertEqual(engine.waiters, {})
+        self.assertIsNone(engine.reader)
+
+    def test_ping_iter(self):
+        # the replies to 0.0.0.0 come from 127.0.0.1: it is the last to complete
+        hosts = ['0.0.0.0', '127.0.0.2', '127.0.0.3']
+        events = list(ping_iter(hosts, count=2, interval=0.01, timeout=0.2, probes=False))
+        self.assertEqual([event.type for event in events], ['summary'] * 3)
+        self.assertEqual(events[-1].host, '0.0.0.0')
+
+        results = ping(hosts, count=2, interval=0.01, timeout=0.2)
+        self.assertEqual(set((event.host, event.result['sent'], event.result['received'])
+                             for event in events),
+                         set((host, result['sent'], result['received'])
+                             for host, result in results.items()))
+        self.assertEqual(results['0.0.0.0']['received'], 0)
+
+    def check_transport(self, transport):
+        result = ping(['127.0.0.1'], count=2, interval=0.01, timeout=1,
+                      transport=transport)['127.0.0.1']
+        self.assertEqual(result['received'], 2)
+        self.assertEqual(get_icmp_engine(socket.AF_INET, transport).transport, transport)
+
+    def test_dgram(self):
+        try:
+            get_icmp_engine(socket.AF_INET, TRANSPORT_DGRAM)
+        except OSError:
+            self.skipTest("ping sockets are not allowed")
+        self.check_transport(TRANSPORT_DGRAM)
+
+    @unittest.skipUnless(os.geteuid() == 0, "raw sockets require root")
+    def test_raw(self):
+        self.check_transport(TRANSPORT_RAW)
+
+    @unittest.skipUnless(os.geteuid() == 0, "raw sockets require root")
+    def test_auto_fallback(self):
+        class NoPingSockets(object):
+            @staticmethod
+            def socket(family, type, proto):
+                if type == socket.SOCK_DGRAM:
+                    raise PermissionError("ping sockets are not allowed")
+                return gevent_socket.socket(family, type, proto)
+
+        class Engine(ICMPEngine):
+            socket_module = NoPingSockets
+
+        engine = Engine(socket.AF_INET)
+        try:
+            self.assertEqual(engine.transport, TRANSPORT_RAW)
+            addr_info = socket.getaddrinfo('127.0.0.1', None, socket.AF_INET)[0]
+            self.assertIsNotNone(engine.ping(addr_info, pick_identifier(0), 0, 1, 64))
+        finally:
+            engine.close()
+
+
+class PingMonitorTestCase(unittest.TestCase):
+    """ Tests for the `gaico.net.monitor.PingMonitor` class. """
+
+    def test_add_remove(self):
+        probes = []
+        monitor = PingMonitor(['127.0.0.2'], interval=0.02, timeout=1, jitter=0,
+                              on_probe=lambda *probe: probes.append(probe))
+        with monitor:
+            gevent.sleep(0.1)
+            monitor.add('127.0.0.3')
+            gevent.sleep(0.1)
+            monitor.remove('127.0.0.2')
+            removed = len([probe for probe in probes if probe[0] == '127.0.0.2'])
+            gevent.sleep(0.1)
+
+            self.assertEqual(monitor.hosts, ['127.0.0.3'])
+            result = monitor.result('127.0.0.3')
+            self.assertEqual(result['host'], '127.0.0.3')
+            self.assertGreater(result['received'], 0)
+            self.assertEqual(result['received'], result['sent'])
+
+        # no probe of a removed host, and every probe of a host in sequence
+        self.assertEqual(len([probe for probe in probes if probe[0] == '127.0.0.2']), removed)
+        for host in ('127.0.0.2', '127.0.0.3'):
+            host_probes = [probe for probe in probes if probe[0] == host]
+            self.assertGreater(len(host_probes), 1)
+            self.assertEqual([probe[1] for probe in host_probes], list(range(len(host_probes))))
+            self.assertTrue(all(probe[2] is not None for probe in host_probes))
+
+        # stop() ends the greenlets of the hosts
+        self.assertEqual(len(monitor.jobs), 0)
+        self.assertEqual(monitor.workers, {})
+        count = len(probes)
+        gevent.sleep(0.05)
+        self.assertEqual(len(probes), count)
+
+
+class SendSchedulerTestCase(unittest.TestCase):
+    """ Tests for the `gaico.net.scheduler.SendScheduler` class. """
+
+    def test_wait_until(self):
+        scheduler = SendScheduler()
+        when = time.monotonic() + 0.05
+        scheduler.wait(when)
+        self.assertGreaterEqual(time.monotonic(), when)
+        scheduler.close()
+
+    def test_order(self):
+        scheduler = SendScheduler()
+        now = time.monotonic()
+        woken = []
+
+        def worker(delay):
+            scheduler.wait(now + delay)
+            woken.append(delay)
+
+        gevent.joinall([gevent.spawn(worker, delay) for delay in (0.03, 0.01, 0.02)])
+        self.assertEqual(woken, [0.01, 0.02, 0.03])
+        scheduler.close()
+
+    def test_rate(self):
+        scheduler = SendScheduler(rate=1000, burst=1)
+        started = time.monotonic()
+        jobs = [gevent.spawn(scheduler.wait, started) for _ in range(50)]
+        gevent.joinall(jobs)
+        self.assertGreaterEqual(time.monotonic() - started, 0.049)
+        scheduler.close()
+
+    def test_wakeups(self):
+        scheduler = SendScheduler(rate=10, burst=1)
+        metrics.reset()
+        metrics.enable()
+        try:
+            started = time.monotonic()
+            # the driver sleeps until each waiter is due, not every tick
+            scheduler.wait(started + 0.2)
+            gevent.joinall([gevent.spawn(scheduler.wait, started) for _ in range(3)])
+        finally:
+            metrics.disable()
+        self.assertGreaterEqual(time.monotonic() - started, 0.4)
+        self.assertLessEqual(metrics.snapshot()['counters']['scheduler.wakeups'], 10)
+        metrics.reset()
+        scheduler.close()
+
+    def test_earlier_waiter(self):
+        scheduler = SendScheduler()
+        now = time.monotonic()
+        later = gevent.spawn(scheduler.wait, now + 1)
+        gevent.sleep(0.01)
+        # the driver sleeps until `now + 1`, a waiter due sooner wakes it up
+        scheduler.wait(now + 0.05)
+        self.assertLess(time.monotonic() - now, 0.5)
+        later.kill()
+        scheduler.close()
+
+    def test_jitter(self):
+        scheduler = SendScheduler(jitter=2)
+        now = time.monotonic()
+        start_times = [scheduler.start_time() - now for _ in range(100)]
+        self.assertTrue(all(0 <= start_time <= 2.1 for start_time in start_times))
+        self.assertGreater(max(start_times) - min(start_times), 0.5)
+
+
+class CheckPortsStateHelpersTestCase(unittest.TestCase):
+    """ Tests for the helpers of `gaico.net.checks.check_ports_state`. """
+
+    def test_interleave(self):
+        pairs = list(_interleave([('a', [1, 2, 3]), ('b', []), ('c', [4])]))
+        self.assertEqual(pairs, [('a', 1), ('c', 4), ('a', 2), ('a', 3)])
+
+    def test_available_fds(self):
+        self.assertGreaterEqual(available_fds(), 1)
+        self.assertEqual(available_fds(reserve=0) - available_fds(), FD_RESERVE)
+
+    def test_greenlets_released(self):
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        port = listener.getsockname()[1]
+        listener.close()
+        targets = {'host{}'.format(i): socket.getaddrinfo('127.0.0.1', None)[0]
+                   for i in range(200)}
+        finished = []
+
+        def pairs():
+            for host in targets:
+                yield host, port
+            gevent.sleep(0.1)
+            # the greenlets of the finished checks are not kept until the end
+            finished.append(sum(1 for obj in gc.get_objects()
+                                if isinstance(obj, gevent.Greenlet) and obj.dead))
+
+        results = _check_ports_greenlets(targets, pairs(), 1, 10, None)
+        self.assertEqual(len(results), 200)
+        self.assertTrue(all(isinstance(value, Exception) for value in results.values()))
+        self.assertLess(finished[0], 100)
+
+
+class PollScannerTestCase(unittest.TestCase):
+    """ Tests for the `gaico.net.scan.PollScanner` class. """
+
+    def setUp(self):
+        self.listener = socket.socket()
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(16)
+        self.open_port = self.listener.getsockname()[1]
+
+        closed = socket.socket()
+        closed.bind(('127.0.0.1', 0))
+        self.closed_port = closed.getsockname()[1]
+        closed.close()
+
+        self.addr_info = socket.getaddrinfo('127.0.0.1', None)[0]
+
+    def tearDown(self):
+        self.listener.close()
+
+    def test_scan(self):
+        targets = [
+            ('a', self.addr_info, self.open_port),
+            ('a', self.addr_info, self.closed_port),
+            ('b', self.addr_info, self.open_port),
+        ]
+        for concurrency, per_host in ((None, None), (1, None), (None, 1), (2, 1)):
+            results = PollScanner(1, concurrency, per_host).scan(targets)
+            self.assertEqual(len(results), 3)
+            self.assertIs(results[('a', self.open_port)], True)
+            self.assertIs(results[('b', self.open_port)], True)
+            self.assertIsInstance(results[('a', self.closed_port)], ConnectionRefusedError)
+
+
+class ARPFrameTestCase(unittest.TestCase):
+    """ Tests for the ARP frames of `gaico.net.arp`. """
+
+    source_mac = b'\x02\x00\x00\x00\x00\x01'
+    source_ip = b'\x0a\x00\x00\x01'
+    destination_mac = b'\x02\x00\x00\x00\x00\x02'
+    destination_ip = b'\x0a\x00\x00\x02'
+
+    def test_build_request(self):
+        frame = build_request(self.source_mac, self.source_ip, self.destination_ip)
+        self.assertEqual(len(frame), 42)
+        self.assertEqual(frame[0:6], b'\xff' * 6)
+        self.assertEqual(frame[6:12], self.source_mac)
+        self.assertEqual(frame[12:14], b'\x08\x06')
+        self.assertEqual(frame[20:22], b'\x00\x01')
+        self.assertEqual(frame[28:32], self.source_ip)
+        self.assertEqual(frame[38:42], self.destination_ip)
+
+        # a request is not a reply
+        self.assertIsNone(parse_reply(frame))
+
+    def test_parse_reply(self):
+        frame = self.source_mac + self.destination_mac + b'\x08\x06' + \
+            b'\x00\x01\x08\x00\x06\x04\x00\x02' + \
+            self.destination_mac + self.destination_ip + self.source_mac + self.source_ip
+        self.assertEqual(parse_reply(frame),
+                         (self.destination_mac, self.destination_ip, self.source_ip))
+
+        # truncated frame
+        self.assertIsNone(parse_reply(frame[:-1]))
+
+    def test_parse_frame(self):
+        frame = build_request(self.source_mac, self.source_ip, self.destination_ip)
+        self.assertEqual(parse_frame(frame),
+                         (b'\x00\x01', self.source_mac, self.source_ip, self.destination_ip))
+        self.assertIsNone(parse_frame(b'\x00' * 42))
+
+
+class NeighborCacheTestCase(unittest.TestCase):
+    """ Tests for the `gaico.net.arp.NeighborCache` class. """
+
+    ip = b'\xc0\x00\x02\x01'
+
+    def test_hit(self):
+        cache = NeighborCache()
+        self.assertIsNone(cache.get('eth0', self.ip))
+        cache.add('eth0', self.ip, '020000000001')
+        self.assertEqual(cache.get('eth0', self.ip), '020000000001')
+        self.assertIsNone(cache.get('eth1', self.ip))
+        self.assertEqual(cache.stats()['hits'], 1)
+
+    def test_expiration(self):
+        cache = NeighborCache(ttl=0.01, negative_ttl=0)
+        cache.add('eth0', self.ip, '020000000001')
+        cache.add('eth0', b'\xc0\x00\x02\x02', ARPTimeoutException())
+        self.assertEqual(len(cache.cache), 1)
+        time.sleep(0.02)
+        self.assertIsNone(cache.get('eth0', self.ip))
+
+    def test_negative(self):
+        cache = NeighborCache()
+        cache.add('eth0', self.ip, ARPTimeoutException())
+        self.assertIsInstance(cache.get('eth0', self.ip), ARPTimeoutException)
+
+    def test_eviction(self):
+        cache = NeighborCache(maxsize=2)
+        for i in range(3):
+            cache.add('eth0', bytes([192, 0, 2, i]), '02000000000{}'.format(i))
+        self.assertIsNone(cache.get('eth0', bytes([192, 0, 2, 0])))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_seed(self):
+        with tempfile.NamedTemporaryFile('w') as table:
+            table.write(
+                'IP address       HW type     Flags       HW address            Mask     Device\n'
+                '192.0.2.1        0x1         0x2         02:00:00:00:00:01     *        eth0\n'
+                '192.0.2.2        0x1         0x0         00:00:00:00:00:00     *        eth0\n'
+                '192.0.2.3        0x1         0x2         02:00:00:00:00:03     *        eth1\n'
+            )
+            table.flush()
+            cache = NeighborCache()
+            cache.seed('eth0', table.name)
+
+        self.assertEqual(cache.get('eth0', self.ip), '020000000001')
+        self.assertEqual(len(cache.cache), 1)
+
+    @unittest.skipUnless(os.geteuid() == 0, "packet sockets require root")
+    def test_gratuitous(self):
+        cache = NeighborCache()
+        engine = get_engine('lo')
+        # the cache learns while one of its requests is in flight
+        job = gevent.spawn(engine.request, b'\x7f\x00\x00\x01', b'\xc0\x00\x02\x03', 0.5, 1,
+                           cache=cache)
+        gevent.sleep(0.01)
+
+        mac = b'\x02\x00\x00\x00\x00\x2a'
+        sender = socket.socket(socket.AF_PACKET, socket.SOCK_RAW)
+        try:
+            sender.bind(('lo', 0x0806))
+            # an ordinary request, then a host announcing itself
+            request = build_request(mac, self.ip, b'\xc0\x00\x02\x02')
+            sender.send(request)
+            sender.send(request[:38] + self.ip)
+            gevent.sleep(0.1)
+        finally:
+            sender.close()
+            job.join()
+            close_engines()
+
+        self.assertEqual(cache.get('lo', self.ip), mac.hex())
+        self.assertEqual(cache.stats()['learned'], 1)
+        self.assertIsInstance(job.value, ARPTimeoutException)
+        self.assertEqual(engine.caches, {})
+
+    @unittest.skipUnless(os.geteuid() == 0, "packet sockets require root")
+    def test_engine_shared_by_caches(self):
+        try:
+            for i in range(3):
+                result = arp_request(['127.0.0.2'], '127.0.0.1', 'lo', timeout=0.05,
+                                     cache=NeighborCache())
+                self.assertIsInstance(result['127.0.0.2'], ARPTimeoutException)
+
+            # a single engine, whose reader stops with the last request
+            self.assertEqual(len(arp_engines), 1)
+            self.assertIsNone(get_engine('lo').reader)
+        finally:
+            close_engines()
+
+
+class ARPEngineTestCase(unittest.TestCase):
+    """ Tests for the shared `gaico.net.arp.ARPEngine`. """
+
+    def setUp(self):
+        self.network = SimulatedNetwork(ipaddress.ip_network('127.0.0.0/8'),
+                                        ipaddress.IPv4Address('127.0.0.1'))
+
+    def tearDown(self):
+        close_engines()
+
+    @unittest.skipUnless(os.geteuid() == 0, "packet sockets require root")
+    def test_get_engine(self):
+        engine = get_engine('lo')
+        self.assertIs(get_engine('lo'), engine)
+        self.assertIsNot(get_engine('lo', bpf=False), engine)
+
+    @unittest.skipUnless(os.geteuid() == 0, "packet sockets require root")
+    def test_dispatch(self):
+        engine = get_engine('lo')
+        source_ip = bytes([127, 0, 0, 1])
+        waiter, other_waiter = AsyncResult(), AsyncResult()
+        engine.waiters[(bytes([127, 0, 0, 2]), source_ip)] = [waiter]
+        engine.waiters[(bytes([127, 0, 0, 3]), source_ip)] = [other_waiter]
+
+        try:
+            # the reply of 127.0.0.2 to 127.0.0.1
+            request = build_request(engine.mac_address, source_ip, bytes([127, 0, 0, 2]))
+            engine.dispatch(answer(request, self.network))
+            self.assertEqual(waiter.get(timeout=0), '02007f000002')
+            self.assertFalse(other_waiter.ready())
+        finally:
+            engine.waiters.clear()
+
+
+class BPFTestCase(unittest.TestCase):
+    """ Tests for the `gaico.net.bpf` module. """
+
+    def send_receive(self, program):
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            receiver.bind(('127.0.0.1', 0))
+            receiver.settimeout(0.1)
+            attach_filter(receiver, program)
+            sender.sendto(b'gaico', receiver.getsockname())
+            try:
+                return receiver.recv(1024)
+            except socket.timeout:
+                return None
+        finally:
+            receiver.close()
+            sender.close()
+
+    def test_attach_filter(self):
+        self.assertEqual(self.send_receive([stmt(BPF_RET | BPF_K, ACCEPT)]), b'gaico')
+        self.assertIsNone(self.send_receive([stmt(BPF_RET | BPF_K, DROP)]))
+
+    def test_arp_reply_filter(self):
+        program = arp_reply_filter(b'\x02\x00\x00\x00\x00\x01')
+        self.assertEqual(len(program), 10)
+        # every check jumps to the final drop
+        for i in range(1, 8, 2):
+            self.assertEqual(i + 1 + program[i][2], 9)
+
+        program = arp_reply_filter(b'\x02\x00\x00\x00\x00\x01', gratuitous=True)
+        self.assertEqual(len(program), 15)
+        # the Ethernet type check jumps to the final drop, the others to the
+        # gratuitous test
+        self.assertEqual(2 + program[1][2], 14)
+        for i in range(3, 8, 2):
+            self.assertEqual(i + 1 + program[i][2], 9)
+        self.assertEqual(program[-2:], [stmt(BPF_RET | BPF_K, ACCEPT), stmt(BPF_RET | BPF_K, DROP)])
+
+    def test_icmp_error_filter(self):
+        program = icmp_error_filter(0, (11, 3), range(10, 20))
+        self.assertEqual(len(program), 10)
+        # the error types jump to the accept, the identifier checks to the drop
+        self.assertEqual(3 + program[2][1], 8)
+        self.assertEqual(4 + program[3][1], 8)
+        self.assertEqual(5 + program[4][2], 9)
+        self.assertEqual(program[-2:], [stmt(BPF_RET | BPF_K, ACCEPT), stmt(BPF_RET | BPF_K, DROP)])
+
+    def test_filter_counter(self):
+        totals = [10]
+        counter = FilterCounter(lambda: totals[0])
+        counter.received = 5
+        totals[0] = 25
+        self.assertEqual(counter.collect(), 10)
+        self.assertEqual(counter.collect(), 0)
+
+    @unittest.skipUnless(os.geteuid() == 0, "packet sockets require root")
+    def test_packet_counter(self):
+        counter = PacketCounter('lo', 0x0806)
+        sender = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, 0)
+        udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            # other protocols of the interface are not counted
+            for i in range(10):
+                udp.sendto(b'payload', ('127.0.0.1', 9))
+            self.assertEqual(counter(), 0)
+
+            sender.bind(('lo', 0))
+            request = build_request(b'\x00' * 6, bytes([127, 0, 0, 1]), bytes([127, 0, 0, 2]))
+            for i in range(50):
+                sender.send(request)
+            # more frames than the shadow socket can hold
+            self.assertGreaterEqual(counter(), 50)
+        finally:
+            counter.close()
+            sender.close()
+            udp.close()
+
+    @unittest.skipUnless(os.geteuid() == 0, "raw sockets require root")
+    def test_icmp_reply_filter(self):
+        metrics.reset()
+        metrics.enable()
+        try:
+            result = ping(['127.0.0.1'], count=2, interval=0.01, timeout=1,
+                          transport='raw')['127.0.0.1']
+        finally:
+            metrics.disable()
+        counters = metrics.snapshot()['counters']
+        metrics.reset()
+
+        self.assertEqual(result['received'], 2)
+        # our own requests go through the loopback and are dropped by the filter
+        self.assertGreaterEqual(counters['icmp.filtered'], 2)
+        self.assertNotIn('icmp.discarded', counters)
+
+
+class AsyncPingTestCase(unittest.TestCase):
+    """ Tests for the `gaico.net.aio.ping` coroutine. """
+
+    def test_ping(self):
+        results = asyncio.run(aio.ping(['127.0.0.1'], count=2, interval=0.01, timeout=1))
+        self.assertEqual(results['127.0.0.1']['received'], 2)
+
+    async def sendto(self, data):
+        class OldLoop(object):
+            # an event loop without `sock_sendto` (before Python 3.11)
+            def __init__(self, loop):
+                self.loop = loop
+
+            def __getattr__(self, name):
+                if name == 'sock_sendto':
+                    raise AttributeError(name)
+                return getattr(self.loop, name)
+
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            receiver.bind(('127.0.0.1', 0))
+            sender.setblocking(False)
+            loop = OldLoop(asyncio.get_running_loop())
+            await aio.sock_sendto(loop, sender, data, receiver.getsockname())
+            return receiver.recv(1024)
+        finally:
+            receiver.close()
+            sender.close()
+
+    def test_sock_sendto(self):
+        self.assertEqual(asyncio.run(self.sendto(b'payload')), b'payload')
+
+
+class AsyncARPRequestTestCase(unittest.TestCase):
+    """ Tests for the `gaico.net.aio.arp_request` coroutine. """
+
+    async def arp_request(self, hosts):
+        # answers the ARP requests seen on the loopback for 127.0.0.0/8
+        network = SimulatedNetwork(ipaddress.ip_network('127.0.0.0/8'),
+                                   ipaddress.IPv4Address('127.0.0.1'))
+        responder = socket.socket(socket.AF_PACKET, socket.SOCK_RAW)
+        responder.bind(('lo', 0x0806))
+        responder.setblocking(False)
+
+        def read_ready():
+            while True:
+                try:
+                    reply = answer(responder.recv(1024), network)
+                except BlockingIOError:
+                    return
+                if reply is not None:
+                    responder.send(reply)
+
+        loop = asyncio.get_running_loop()
+        loop.add_reader(responder.fileno(), read_ready)
+        try:
+            return await aio.arp_request(hosts, '127.0.0.1', 'lo', timeout=1)
+        finally:
+            loop.remove_reader(responder.fileno())
+            responder.close()
+
+    @unittest.skipUnless(os.geteuid() == 0, "packet sockets require root")
+    def test_same_address(self):
+        # two hosts with the same address
+        results = asyncio.run(self.arp_request(['127.0.0.2', '127.0.0.02']))
+        self.assertEqual(results, {'127.0.0.2': '02007f000002', '127.0.0.02': '02007f000002'})
+
+
+class AsyncCheckPortsStateTestCase(unittest.TestCase):
+    """ Tests for the `gaico.net.aio.check_ports_state` coroutine. """
+
+    async def check_ports_state(self):
+        # a port nobody listens on
+        closed = socket.socket()
+        closed.bind(('127.0.0.1', 0))
+        closed_port = closed.getsockname()[1]
+        closed.close()
+
+        server = await asyncio.start_server(lambda reader, writer: writer.close(), '127.0.0.1', 0)
+        open_port = server.sockets[0].getsockname()[1]
+        try:
+            return open_port, closed_port, await aio.check_ports_state(
+                {'127.0.0.1': [open_port, closed_port], 'invalid.invalid': [80]}, timeout=1
+            )
+        finally:
+            server.close()
+
+    def test_check_ports_state(self):
+        open_port, closed_port, results = asyncio.run(self.check_ports_state())
+        self.assertEqual(results['127.0.0.1']['host'], '127.0.0.1')
+        self.assertIs(results['127.0.0.1'][open_port], True)
+        self.assertIsInstance(results['127.0.0.1'][closed_port], ConnectionRefusedError)
+        self.assertIsInstance(results['invalid.invalid'], Exception)
+
+
+class ResolverTestCase(unittest.TestCase):
+    """ Tests for the `gaico.net.socket.Resolver` cache. """
+
+    def test_hit(self):
+        resolver = Resolver()
+        first = resolver.getaddrinfo('127.0.0.1', None)
+        self.assertEqual(resolver.getaddrinfo('127.0.0.1', None), first)
+        self.assertEqual(resolver.stats()['misses'], 1)
+        self.assertEqual(resolver.stats()['hits'], 1)
+
+    def test_negative(self):
+        resolver = Resolver()
+        # numeric lookups of an invalid address fail without querying a DNS server
+        for i in range(2):
+            with self.assertRaises(socket.gaierror):
+                resolver.getaddrinfo('not an address', None, flags=socket.AI_NUMERICHOST)
+        self.assertEqual(resolver.stats()['misses'], 1)
+        self.assertEqual(resolver.stats()['hits'], 1)
+
+    def test_expiration(self):
+        resolver = Resolver(ttl=0.01)
+        resolver.getaddrinfo('127.0.0.1', None)
+        time.sleep(0.02)
+        resolver.getaddrinfo('127.0.0.1', None)
+        self.assertEqual(resolver.stats()['misses'], 2)
+
+    def test_eviction(self):
+        resolver = Resolver(maxsize=1)
+        resolver.getaddrinfo('127.0.0.1', None)
+        resolver.getaddrinfo('127.0.0.2', None)
+        self.assertEqual(resolver.stats()['evictions'], 1)
+        self.assertEqual(resolver.stats()['size'], 1)
+
+    def test_coalesced(self):
+        resolver = Resolver()
+        jobs = [gevent.spawn(resolver.getaddrinfo, 'localhost', None) for i in range(10)]
+        gevent.joinall(jobs)
+        self.assertEqual(resolver.stats()['misses'], 1)
+        self.assertEqual(resolver.stats()['coalesced'] + resolver.stats()['hits'], 9)
+
+    def test_leader_killed(self):
+        resolver = Resolver()
+        leader = gevent.spawn(resolver.getaddrinfo, 'localhost', None)
+        gevent.sleep(0)
+        follower = gevent.spawn(resolver.getaddrinfo, 'localhost', None)
+        gevent.sleep(0)
+        leader.kill()
+
+        follower.join(timeout=1)
+        self.assertTrue(follower.ready())
+        self.assertIsInstance(follower.exception, socket.gaierror)
+        self.assertEqual(resolver.stats()['coalesced'], 1)
+        # the failure is not cached
+        self.assertEqual(resolver.stats()['size'], 0)
+
+    def test_lookup(self):
+        lookups = []
+
+        def lookup(host, port, family=0, socktype=0, proto=0, flags=0):
+            lookups.append(host)
+            return socket.getaddrinfo('127.0.0.1', port, family, socktype, proto, flags)
+
+        resolver = Resolver(lookup=lookup)
+        results = getaddrinfo(['example.invalid', 'example.invalid', '::1'], None,
+                              resolver=resolver)
+        self.assertEqual(results['example.invalid'][0][4][0], '127.0.0.1')
+        resolver.getaddrinfo('example.invalid', None)
+        self.assertEqual(lookups, ['example.invalid'])
+
+    def test_literal(self):
+        # literal addresses never go through the resolver
+        resolver = Resolver()
+        results = getaddrinfo(['127.0.0.1', '::1'], None, resolver=resolver)
+        self.assertEqual(results['127.0.0.1'][0][4][0], '127.0.0.1')
+        self.assertEqual(results['::1'][0][4][0], '::1')
+        self.assertEqual(resolver.stats()['misses'], 0)
+
+    def test_iter(self):
+        hosts = ('127.0.0.{}'.format(i) for i in range(1, 6))
+        results = list(getaddrinfo_iter(hosts, None, chunk_size=2))
+        self.assertEqual([host for host, addr_info in results],
+                         ['127.0.0.{}'.format(i) for i in range(1, 6)])
+
+
+class TargetsTestCase(unittest.TestCase):
+    """ Tests for the `gaico.net.targets` module. """
+
+    def test_cidr(self):
+        self.assertEqual(list(expand_hosts(['192.0.2.0/30'])), ['192.0.2.1', '192.0.2.2'])
+        self.assertEqual(list(expand_hosts([ipaddress.ip_network('192.0.2.1/32')])),
+                         ['192.0.2.1'])
+        self.assertEqual(list(expand_hosts(['192.0.2.1/32', '2001:db8::1/128'])),
+                         ['192.0.2.1', '2001:db8::1'])
+        self.assertEqual(list(expand_hosts(['192.0.2.0/31'])), ['192.0.2.0', '192.0.2.1'])
+        self.assertEqual(len(list(expand_hosts(['2001:db8::/120']))), 255)
+
+    def test_range(self):
+        self.assertEqual(list(expand_hosts(['192.0.2.254-192.0.3.1'])),
+                         ['192.0.2.254', '192.0.2.255', '192.0.3.0', '192.0.3.1'])
+        self.assertEqual(list(expand_hosts(['192.0.2.1-3'])),
+                         ['192.0.2.1', '192.0.2.2', '192.0.2.3'])
+        self.assertEqual(list(expand_hosts(['2001:db8::1-2'])), ['2001:db8::1', '2001:db8::2'])
+
+        for host in ('192.0.2.5-1', '192.0.2.5-192.0.2.1'):
+            with self.assertRaises(ValueError):
+                list(expand_hosts([host]))
+
+    def test_unchanged(self):
+        hosts = ['localhost', 'my-host.example.com', '192.0.2.1-::1']
+        self.assertEqual(list(expand_hosts(hosts)), hosts)
+
+    def test_lazy(self):
+        hosts = expand_hosts(['10.0.0.0/8'])
+        self.assertEqual(next(hosts), '10.0.0.1')
+
+    def test_ports(self):
+        self.assertEqual(list(expand_ports([22, '80-82', range(443, 445), '8080'])),
+                         [22, 80, 81, 82, 443, 444, 8080])
+
+
+class RollingStatisticsTestCase(unittest.TestCase):
+    """ Tests for the `gaico.net.stats.RollingStatistics` class. """
+
+    def test_empty(self):
+        result = RollingStatistics().result('127.0.0.1')
+        self.assertEqual(result['sent'], 0)
+        self.assertIsNone(result['packet_loss'])
+        self.assertIsNone(result['avgping'])
+        self.assertIsNone(result['jitter'])
+
+    def test_window(self):
+        statistics = RollingStatistics(window=4)
+        for delay in [10, None, 1, 2, 3, None]:
+            statistics.add(delay)
+
+        # only the last 4 round trips are kept
+        result = statistics.result('127.0.0.1')
+        self.assertEqual(result['sent'], 4)
+        self.assertEqual(result['received'], 3)
+        self.assertEqual(result['minping'], 1)
+        self.assertEqual(result['maxping'], 3)
+        self.assertEqual(result['avgping'], 2)
+        self.assertEqual(result['packet_loss'], 25)
+
+    def test_jitter(self):
+        statistics = RollingStatistics()
+        for delay in [1, 2, 2]:
+            statistics.add(delay)
+        self.assertEqual(statistics.result('127.0.0.1')['jitter'], 1 - 1 / 16)
+
+
+class PingResultsTestCase(unittest.TestCase):
+    """ Tests for the `gaico.net.results.PingResults` class. """
+
+    def setUp(self):
+        self.results = PingResults(['a', 'b', 'c'], 3, keep_delays=True)
+        self.results.addresses = ['127.0.0.1', '127.0.0.2', None]
+        for sequence, delay in enumerate([2, None, 1]):
+            self.results.add('a', sequence, delay)
+        self.results.add('b', 0, None)
+        self.results.errors['c'] = socket.gaierror()
+
+    def test_mapping(self):
+        self.assertEqual(list(self.results), ['a', 'b', 'c'])
+        self.assertEqual(self.results['a'], {
+            'host': '127.0.0.1',
+            'sent': 3,
+            'received': 2,
+            'minping': 1,
+            'maxping': 2,
+            'avgping': 1.5,
+            'packet_loss': 100 - 200 / 3,
+        })
+        self.assertIsNone(self.results['b']['minping'])
+        self.assertIsNone(self.results['b']['avgping'])
+        self.assertIsInstance(self.results['c'], socket.gaierror)
+
+    def test_columns(self):
+        columns = self.results.columns(use_numpy=False)
+        self.assertEqual(list(columns['sent']), [3, 1, 0])
+        self.assertEqual(columns['avgping'][0], 1.5)
+        self.assertEqual(columns['packet_loss'][1], 100)
+        self.assertEqual(len(columns['delays']), 9)
+
+    def test_round_trips(self):
+        delays = self.results.round_trips('a')
+        self.assertEqual(delays[0], 2)
+        self.assertNotEqual(delays[1], delays[1])
+        self.assertEqual(delays[2], 1)
+
+    def test_concatenate(self):
+        other = PingResults(['d'], 3, keep_delays=True)
+        other.add('d', 0, 3)
+        results = PingResults.concatenate([self.results, other])
+
+        self.assertEqual(list(results), ['a', 'b', 'c', 'd'])
+        self.assertEqual(results['a'], self.results['a'])
+        self.assertEqual(results['d']['maxping'], 3)
+        self.assertIsInstance(results['c'], socket.gaierror)
+        self.assertEqual(results.round_trips('d')[0], 3)
+
+
+class LatencyHistogramTestCase(unittest.TestCase):
+    """ Tests for the `gaico.net.stats.LatencyHistogram` class. """
+
+    def test_empty(self):
+        self.assertIsNone(LatencyHistogram().percentile(50))
+
+    def test_percentiles(self):
+        histogram = LatencyHistogram()
+        delays = [i / 10000 for i in range(1, 1001)]
+        for delay in delays:
+            histogram.add(delay)
+
+        for percent in (1, 50, 95, 99, 100):
+            expected = delays[int(percent * len(delays) / 100) - 1]
+            self.assertAlmostEqual(histogram.percentile(percent), expected,
+                                   delta=expected / 2 ** histogram.precision)
+
+    def test_merge(self):
+        first = LatencyHistogram()
+        second = LatencyHistogram()
+        for i in range(100):
+            first.add(0.001)
+            second.add(1)
+
+        first.merge(second)
+        self.assertEqual(first.count, 200)
+        self.assertAlmostEqual(first.percentile(50), 0.001, delta=0.001 / 32)
+        self.assertAlmostEqual(first.percentile(51), 1, delta=1 / 32)
+        self.assertEqual(sum(count for low, high, count in first.buckets()), 200)
+
+    def test_ping_statistics(self):
+        statistics = PingStatistics()
+        for delay in [0.001, None, 0.003]:
+            statistics.add(delay)
+
+        result = statistics.result('127.0.0.1')
+        self.assertAlmostEqual(result['mdev'], 0.001)
+        self.assertAlmostEqual(result['jitter'], 0.002)
+        self.assertEqual(result['histogram'].count, 2)
+
+
+class MultipleAddressesTestCase(unittest.TestCase):
+    """ Tests for the `gaico.net.socket.sort_addresses` and `race` functions. """
+
+    def addr_info(self, address):
+        family = socket.AF_INET6 if ':' in address else socket.AF_INET
+        return (family, socket.SOCK_STREAM, socket.IPPROTO_TCP, '', (address, 0))
+
+    def test_sort_addresses(self):
+        addresses_info = [self.addr_info(address) for address in
+                          ['::1', '::2', '::3', '10.0.0.1', '10.0.0.1', '10.0.0.2']]
+        addresses = [addr_info[4][0] for addr_info in sort_addresses(addresses_info)]
+        self.assertEqual(addresses, ['::1', '10.0.0.1', '::2', '10.0.0.2', '::3'])
+
+    def test_race(self):
+        delays = {'10.0.0.1': (1, True), '10.0.0.2': (0.01, False), '10.0.0.3': (0.01, True)}
+
+        def attempt(addr_info):
+            delay, success = delays[addr_info[4][0]]
+            gevent.sleep(delay)
+            return success, addr_info[4][0]
+
+        addresses_info = [self.addr_info(address) for address in sorted(delays)]
+        started = time.monotonic()
+        addr_info, value = race(addresses_info, attempt, delay=0.1)
+
+        # the third attempt starts as soon as the second one failed
+        self.assertEqual(value, '10.0.0.3')
+        self.assertLess(time.monotonic() - started, 0.5)
+
+    def test_race_raised(self):
+        def attempt(addr_info):
+            if addr_info[4][0] == '10.0.0.1':
+                raise OSError("unreachable")
+            return False, addr_info[4][0]
+
+        for addresses in (['10.0.0.1'], ['10.0.0.1', '10.0.0.2']):
+            addresses_info = [self.addr_info(address) for address in addresses]
+            with gevent.Timeout(1):
+                addr_info, value = race(addresses_info, attempt)
+            self.assertEqual(addr_info, addresses_info[0])
+            self.assertIsInstance(value, OSError)
+
+    def test_race_failed(self):
+        def attempt(addr_info):
+            return False, addr_info[4][0]
+
+        addresses_info = [self.addr_info(address) for address in ['10.0.0.1', '10.0.0.2']]
+        self.assertEqual(race(addresses_info, attempt), (addresses_info[0], '10.0.0.1'))
+
+
+class TapResponderTestCase(unittest.TestCase):
+    """ Tests for the replies of the `gaico.bench.responder` simulated hosts. """
+
+    def setUp(self):
+        network = ipaddress.IPv4Network('10.98.0.0/16')
+        self.network = SimulatedNetwork(network, ipaddress.IPv4Address('10.98.0.1'))
+        self.mac = b'\x02\x00\x00\x00\x00\x01'
+
+    def test_arp(self):
+        request = build_request(self.mac, bytes([10, 98, 0, 1]), bytes([10, 98, 1, 2]))
+        self.assertEqual(parse_reply(answer(request, self.network)),
+                         (b'\x02\x00\x0a\x62\x01\x02', bytes([10, 98, 1, 2]),
+                          bytes([10, 98, 0, 1])))
+
+        # the address of the tap device itself is not simulated
+        request = build_request(self.mac, bytes([10, 98, 1, 2]), bytes([10, 98, 0, 1]))
+        self.assertIsNone(answer(request, self.network))
+
+    def test_icmp(self):
+        icmp = PingPacket(1, 2, b'payload').pack()
+        header = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(icmp), 0, 0, 64,
+                             socket.IPPROTO_ICMP, 0, bytes([10, 98, 0, 1]),
+                             bytes([10, 98, 1, 2]))
+        frame = b'\x02' * 6 + self.mac + b'\x08\x00' + header + icmp
+
+        reply = answer(frame, self.network)
+        self.assertEqual(reply[26:34], bytes([10, 98, 1, 2, 10, 98, 0, 1]))
+        self.assertEqual(reply[34], 0)
+        packet = PingPacket.fromdata(reply[34:])
+        self.assertEqual((packet.sequence, packet.payload), (2, b'payload'))
+        self.assertEqual(internet_checksum(reply[34:]), 0)
+
+
+class MetricsTestCase(unittest.TestCase):
+    """ Tests for the `gaico.net.metrics` module. """
+
+    def setUp(self):
+        metrics.reset()
+        metrics.enable()
+
+    def tearDown(self):
+        metrics.disable()
+        metrics.reset()
+
+    def test_snapshot(self):
+        metrics.count('icmp.sent')
+        metrics.count('icmp.sent', 2)
+        metrics.record('resolver.lookup', 0.5)
+        metrics.record('resolver.lookup', 1.5)
+
+        self.assertEqual(metrics.snapshot(), {
+            'counters': {'icmp.sent': 3},
+            'timers': {'resolver.lookup': {'count': 2, 'total': 2.0, 'max': 1.5}},
+        })
+
+    def test_hooks(self):
+        calls = []
+        metrics.add_hook(lambda name, value: calls.append((name, value)))
+        try:
+            metrics.count('icmp.sent')
+            with metrics.timed('resolver.lookup'):
+                pass
+        finally:
+            del metrics.hooks[:]
+
+        self.assertEqual(calls[0], ('icmp.sent', 1))
+        self.assertEqual(calls[1][0], 'resolver.lookup')
+
+    def test_resolver(self):
+        resolver = Resolver()
+        resolver.getaddrinfo('127.0.0.1', None)
+        resolver.getaddrinfo('127.0.0.1', None)
+
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot['counters'], {'resolver.misses': 1, 'resolver.hits': 1})
+        self.assertEqual(snapshot['timers']['resolver.lookup']['count'], 1)
+
+    def test_ping(self):
+        ping(['127.0.0.1'], count=2, interval=0.01, timeout=1)
+        counters = metrics.snapshot()['counters']
+        self.assertEqual(counters['icmp.sent'], 2)
+        self.assertEqual(counters['icmp.received'], 2)
+        # at least one wakeup per reply, as they are sent one after the other
+        self.assertGreaterEqual(counters['icmp.wakeups'], 2)
+
+    def test_disabled(self):
+        metrics.disable()
+        Resolver().getaddrinfo('127.0.0.1', None)
+        self.assertEqual(metrics.snapshot(), {'counters': {}, 'timers': {}})
+
+    def test_merge(self):
+        metrics.count('icmp.sent')
+        metrics.record('resolver.lookup', 0.5)
+        metrics.merge({
+            'counters': {'icmp.sent': 2},
+            'timers': {'resolver.lookup': {'count': 2, 'total': 2.0, 'max': 1.5}},
+        })
+
+        self.assertEqual(metrics.snapshot(), {
+            'counters': {'icmp.sent': 3},
+            'timers': {'resolver.lookup': {'count': 3, 'total': 2.5, 'max': 1.5}},
+        })
+
+
+class ShardTestCase(unittest.TestCase):
+    """ Tests for the `gaico.net.shard` module. """
+
+    def test_split(self):
+        self.assertEqual(split(list(range(5)), 2), [[0, 1], [2, 3, 4]])
+        self.assertEqual(split(range(0x10000), 4)[1], range(0x4000, 0x8000))
+        self.assertEqual(split([1], 2), [[], [1]])
+
+    def test_ping(self):
+        hosts = ['127.0.0.{}'.format(i) for i in range(1, 6)]
+        results = ping(hosts, count=1, timeout=1, processes=2)
+        self.assertEqual(sorted(results), hosts)
+        self.assertEqual(results['127.0.0.5']['received'], 1)
+
+    def test_exception(self):
+        with self.assertRaises(ValueError):
+            ping(['127.0.0.1', '127.0.0.2'], count=1, timeout=1, addresses='unknown',
+                 processes=2)
+
+
+class BatchTestCase(unittest.TestCase):
+    """ Tests for the `gaico.net.batch` module. """
+
+    def setUp(self):
+        self.receiver_socket = gevent_socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.receiver_socket.bind(('127.0.0.1', 0))
+        self.sender_socket = gevent_socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def tearDown(self):
+        self.receiver_socket.close()
+        self.sender_socket.close()
+
+    def test_address(self):
+        for family, address in [(socket.AF_INET, ('192.0.2.1', 80)),
+                                (socket.AF_INET6, ('2001:db8::1', 443, 0, 0))]:
+            self.assertEqual(decode_address(encode_address(address, family)), address)
+        self.assertIsNone(decode_address(b''))
+
+    def test_round_trip(self):
+        address = self.receiver_socket.getsockname()
+        sender = BatchSender(self.sender_socket, batch=4)
+        for i in range(10):
+            sender.send(struct.pack('!H', i), address)
+        sender.flush()
+
+        receiver = BatchReceiver(self.receiver_socket, batch=4)
+        packets = []
+        while True:
+            batch = receiver.receive()
+            packets.extend(batch)
+            if len(batch) < receiver.batch:
+                break
+
+        self.assertEqual([data for data, _, _ in packets],
+                         [struct.pack('!H', i) for i in range(10)])
+        self.assertEqual({source for _, source, _ in packets},
+                         {('127.0.0.1', self.sender_socket.getsockname()[1])})
+        self.assertIsNone(packets[0][2])
+        self.assertEqual(receiver.receive(), [])
+
+    def test_timestamps(self):
+        receiver = BatchReceiver(self.receiver_socket, timestamps=True)
+        sender = BatchSender(self.sender_socket)
+        before = time.monotonic_ns()
+        for i in range(3):
+            sender.send(lambda: struct.pack('!Q', time.monotonic_ns()),
+                        self.receiver_socket.getsockname())
+        sender.flush()
+        time.sleep(0.01)
+
+        packets = receiver.receive()
+        self.assertEqual(len(packets), 3)
+        for data, _, timestamp in packets:
+            # received by the kernel after the send, and long before now
+            self.assertGreater(timestamp, struct.unpack('!Q', data)[0])
+            self.assertLess(timestamp, time.monotonic_ns() - 5000000)
+        self.assertGreater(packets[0][2], before)
+
+    def test_large_datagram(self):
+        sender = BatchSender(self.sender_socket, size=16)
+        sender.send(b'x' * 32, self.receiver_socket.getsockname())
+        sender.send(b'y', self.receiver_socket.getsockname())
+        sender.flush()
+        self.assertEqual(self.receiver_socket.recvfrom(64)[0], b'x' * 32)
+        self.assertEqual(self.receiver_socket.recvfrom(64)[0], b'y')
+
+    def test_error(self):
+        errors = []
+        sender = BatchSender(self.sender_socket)
+        sender.send(b'x', ('255.255.255.255', 9), errors.append)
+        sender.send(b'y', self.receiver_socket.getsockname(), errors.append)
+        sender.flush()
+
+        self.assertEqual(len(errors), 1)
+        self.assertIsInstance(errors[0], PermissionError)
+        self.assertEqual(self.receiver_socket.recvfrom(16)[0], b'y')
+
+
+class AdaptiveTimeoutTestCase(unittest.TestCase):
+    """ Tests for the `gaico.net.timeouts` module. """
+
+    def test_estimator(self):
+        estimator = RTTEstimator()
+        estimator.add(0.1)
+        self.assertEqual((estimator.srtt, estimator.rttvar), (0.1, 0.05))
+        self.assertAlmostEqual(estimator.timeout(4), 0.3)
+        estimator.add(0.2)
+        self.assertAlmostEqual(estimator.rttvar, 0.75 * 0.05 + 0.25 * 0.1)
+        self.assertAlmostEqual(estimator.srtt, 0.875 * 0.1 + 0.125 * 0.2)
+
+    def test_timeout(self):
+        adaptive = AdaptiveTimeout(min_timeout=0.1)
+        # nothing known: the user timeout
+        self.assertEqual(adaptive.timeout('192.0.2.1', 10), 10)
+
+        adaptive.add('192.0.2.1', 0.5)
+        self.assertAlmostEqual(adaptive.timeout('192.0.2.1', 10), 1.5)
+        self.assertEqual(adaptive.timeout('192.0.2.1', 1), 1)
+        # same subnet, or not
+        self.assertAlmostEqual(adaptive.timeout('192.0.2.2', 10), 1.5)
+        self.assertEqual(adaptive.timeout('198.51.100.1', 10), 10)
+
+        adaptive.add('2001:db8::1', 0.001)
+        self.assertEqual(adaptive.timeout('2001:db8::2', 10), 0.1)
+        self.assertEqual(adaptive.stats(), {'hosts': 2, 'subnets': 2})
+
+    def test_check_after(self):
+        adaptive = AdaptiveTimeout(min_timeout=0.1)
+        self.assertEqual(adaptive.check_after('192.0.2.1', 0, 10), 0.1)
+        self.assertEqual(adaptive.check_after('192.0.2.1', 4, 10), 2)
+        self.assertEqual(adaptive.check_after('192.0.2.1', 9, 10), 1)
+        self.assertEqual(adaptive.check_after('192.0.2.1', 10, 10), 0)
+
+        # the estimate of the subnet also applies to a probe already waiting
+        adaptive.add('192.0.2.2', 0.5)
+        self.assertEqual(adaptive.check_after('192.0.2.1', 4, 10), 0)
+
+    def test_get_adaptive(self):
+        adaptive = AdaptiveTimeout()
+        self.assertIs(get_adaptive(adaptive), adaptive)
+        self.assertIsInstance(get_adaptive(True), AdaptiveTimeout)
+        self.assertIsNone(get_adaptive(None))
+        self.assertIsNone(get_adaptive(False))
+
+    def test_wait(self):
+        adaptive = AdaptiveTimeout(min_timeout=0.05)
+        adaptive.add('192.0.2.2', 0.01)
+
+        started = time.monotonic()
+        with self.assertRaises(gevent.Timeout):
+            wait(AsyncResult(), '192.0.2.1', 10, adaptive)
+        self.assertLess(time.monotonic() - started, 1)
+
+        waiter = AsyncResult()
+        gevent.spawn_later(0.01, waiter.set, 'reply')
+        self.assertEqual(wait(waiter, '192.0.2.1', 10, adaptive), 'reply')
+
+    def test_ping(self):
+        adaptive = AdaptiveTimeout(min_timeout=0.1)
+        result = ping(['127.0.0.1'], count=2, interval=0.01, timeout=1,
+                      adaptive=adaptive)['127.0.0.1']
+        self.assertEqual(result['received'], 2)
+        self.assertIn('127.0.0.1', adaptive.hosts)
+
+
+class ServiceProbesTestCase(unittest.TestCase):
+    """ Tests for the `gaico.net.probes` module. """
+
+    def test_read(self):
+        a, b = gevent_socket.socketpair()
+        b.sendall(b'SSH-2.0-test\r\nmore')
+        self.assertEqual(read(a, 1024, 1, b'\n'), b'SSH-2.0-test\r\nmore')
+        b.sendall(b'x' * 100)
+        self.assertEqual(read(a, 10, 1), b'x' * 10)
+        self.assertEqual(read(a, 1024, 0.01), b'x' * 90)
+        with self.assertRaises(socket.timeout):
+            read(a, 1024, 0.01, b'\n')
+        a.close()
+        b.close()
+
+    def test_http_parse(self):
+        result = HTTPProbe.parse(b'HTTP/1.1 404 Not Found\r\nServer: test\r\n\r\nbody')
+        self.assertEqual(result, {'version': 'HTTP/1.1', 'status': 404, 'reason': 'Not Found',
+                                  'headers': {'server': 'test'}})
+        with self.assertRaises(ProbeException):
+            HTTPProbe.parse(b'SSH-2.0-test\r\n')
+
+    def test_check_ports_state(self):
+        def handle(s, address):
+            s.sendall(b'220 ready\r\n')
+            s.recv(1024)
+            s.sendall(b'HTTP/1.0 200 OK\r\nServer: test\r\n\r\n')
+
+        server = StreamServer(('127.0.0.1', 0), handle)
+        server.start()
+        closed = socket.socket()
+        closed.bind(('127.0.0.1', 0))
+        closed_port = closed.getsockname()[1]
+        closed.close()
+
+        try:
+            result = check_ports_state(
+                {'127.0.0.1': [server.server_port, closed_port]}, timeout=1,
+                probes=[BannerProbe(timeout=0.5), HTTPProbe(timeout=0.5)]
+            )['127.0.0.1']
+        finally:
+            server.stop()
+
+        self.assertIs(result[server.server_port], True)
+        self.assertIsInstance(result[closed_port], ConnectionRefusedError)
+        services = result['services']
+        self.assertEqual(list(services), [server.server_port])
+        self.assertEqual(services[server.server_port]['banner'], b'220 ready\r\n')
+        self.assertEqual(services[server.server_port]['http']['status'], 200)
+
+        with self.assertRaises(ValueError):
+            check_ports_state({'127.0.0.1': [closed_port]}, method='poll', probes=[HTTPProbe()])
+
+
+class TracerouteTestCase(unittest.TestCase):
+    """ Tests for the `gaico.net.traceroute` module. """
+
+    def test_build_probe(self):
+        probes = [build_probe(1234, sequence, 64) for sequence in (1, 2, 1 << 8 | 30)]
+        self.assertEqual(len(probes[0]), 64)
+        # same flow: the checksum does not depend on the sequence
+        self.assertEqual(len(set(probe[2:4] for probe in probes)), 1)
+        self.assertEqual(internet_checksum(probes[2]), 0)
+
+    @unittest.skipUnless(os.geteuid() == 0, "raw sockets require root")
+    def test_dispatch(self):
+        engine = TracerouteEngine(socket.AF_INET)
+        try:
+            probe = build_probe(1234, 3, 64)
+            # time exceeded from 198.51.100.1, quoting a probe to 192.0.2.1
+            quote = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 84, 0, 0, 1, 1, 0,
+                                socket.inet_aton('198.51.100.2'),
+                                socket.inet_aton('192.0.2.1')) + probe[:8]
+            header = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 56, 0, 0, 64, 1, 0,
+                                 socket.inet_aton('198.51.100.1'),
+                                 socket.inet_aton('198.51.100.2'))
+            error = bytes([11, 0, 0, 0, 0, 0, 0, 0]) + quote
+
+            waiter = AsyncResult()
+            engine.waiters[(1234, 3, '192.0.2.1')] = (waiter, 1000)
+            engine.dispatch(header + error, ('198.51.100.1', 0), 3000)
+            self.assertEqual(waiter.get(timeout=0), ('198.51.100.1', 2e-06, 11, 0))
+            self.assertEqual(engine.waiters, {})
+
+            # an error quoting another packet
+            engine.dispatch(header + error, ('198.51.100.1', 0), 3000)
+        finally:
+            engine.close()
+
+    @unittest.skipUnless(os.geteuid() == 0, "raw sockets require root")
+    def test_traceroute(self):
+        result = traceroute(['127.0.0.1'], max_hops=4, timeout=1)['127.0.0.1']
+        self.assertTrue(result['reached'])
+        self.assertEqual(len(result['hops']), 1)
+        self.assertEqual(result['hops'][0]['address'], '127.0.0.1')
+        self.assertIsNotNone(result['hops'][0]['delays'][0])
+
+        with self.assertRaises(ValueError):
+            traceroute(['127.0.0.1'], max_hops=256)
+
+    @unittest.skipUnless(os.geteuid() == 0, "raw sockets require root")
+    def test_send_failed(self):
+        engine = get_traceroute_engine(socket.AF_INET)
+
+        def send(addr_info, identifier, ttl, attempt, packet_size):
+            # the probes are in flight until the third one fails
+            if ttl == 3:
+                raise OSError("No buffer space available")
+            key = (identifier, attempt << 8 | ttl, addr_info[4][0])
+            waiter = engine.waiters[key] = AsyncResult()
+            return key, waiter
+
+        engine.send = send
+        try:
+            addr_info = socket.getaddrinfo('127.0.0.1', None, socket.AF_INET)[0]
+            with self.assertRaises(OSError):
+                traceroute_worker(addr_info, 4, 1, 1, 1, 64)
+            self.assertEqual(engine.waiters, {})
+        finally:
+            close_traceroute_engines()
+
+    @unittest.skipUnless(os.geteuid() == 0, "raw sockets require root")
+    def test_same_address(self):
+        addr_info = socket.getaddrinfo('127.0.0.1', None, socket.AF_INET)[0]
+        jobs = [gevent.spawn(traceroute_worker, addr_info, 2, 1, 1, 1, 64) for _ in range(2)]
+        gevent.joinall(jobs)
+        for job in jobs:
+            self.assertTrue(job.value['reached'])
+            self.assertIsNotNone(job.value['hops'][0]['delays'][0])
+
+
 if __name__ == '__main__':
     unittest.main()